@@ -1,5 +1,5 @@
 from tastypie.resources import ModelResource, ALL, ALL_WITH_RELATIONS	
 from tastypie.api import Api
 from tastypie.authentication import BasicAuthentication
-from tastypie.authhorization import Authorization
+from tastypie.authorization import Authorization
 from ga_ows.tastyhacks import GeoResource
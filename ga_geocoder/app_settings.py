@@ -19,3 +19,52 @@ NOMINATIM_URLS=[
     'http://nominatim.openstreetmap.org', # bad for bulk geocoding!!!
 ]
 
+#: The most concurrent requests made to each Nominatim server by bulk geocoding.
+NOMINATIM_MAX_IN_FLIGHT=4
+
+#: The most requests per second made to each Nominatim server, or None for no limit.  The public server allows 1.
+NOMINATIM_RATE=1
+
+#: The number of times a failed request to a Nominatim server is retried, with exponential backoff.
+NOMINATIM_RETRIES=3
+
+#: The number of decimal places coordinates are rounded to when caching Nominatim reverse geocoding responses.
+NOMINATIM_REVERSE_PRECISION=5
+
+#: Where geocoding metrics are sent: None to turn them off, or the dotted path of a sink class, optionally paired with a
+#: dict of arguments, e.g. ('ga_geocoder.instrumentation.StatsdSink', {'host' : 'localhost', 'port' : 8125})
+METRICS_SINK=None
+
+#: The storage backend of the exact and trigram geocoders, as the dotted path of a class in ga_geocoder.backends,
+#: optionally paired with a dict of arguments.  SQLiteBackend keeps each geocoder in a local file in GEO_INDEX_PATH.
+GEOCODER_BACKEND='ga_geocoder.backends.MongoBackend'
+
+#: The number of chunks of codes ExactGeocoder.bulk_geocode fetches ahead of its caller, on as many threads.  0 fetches
+#: each chunk only once the caller has consumed the last.
+BULK_PREFETCH=2
+
+#: The number of seconds bulk geocoding aims to spend fetching each chunk of codes, as it sizes its chunks.
+BULK_CHUNK_SECONDS=0.25
+
+#: The most bytes of GeoJSON bulk geocoding aims to fetch in each chunk of codes, as it sizes its chunks.
+BULK_CHUNK_BYTES=8 * 1024 * 1024
+
+#: The number of inputs from a list in each shard of a distributed geocoding job, in ga_geocoder.tasks
+TASK_SHARD_SIZE=10000
+
+#: The number of bytes of an input file in each shard of a distributed geocoding job
+TASK_SHARD_BYTES=4 * 1024 * 1024
+
+#: The number of times a failed shard of a distributed geocoding job is retried before the job fails.
+TASK_RETRIES=3
+
+#: The number of seconds before a failed shard's first retry.  The delay doubles with each retry.
+TASK_RETRY_DELAY=10
+
+#: The geocoders served over HTTP, by name.  Each is a dict of the kind of geocoder and the arguments to open it with,
+#: e.g. { 'osm' : { 'kind' : 'osm' } }, or None for the geocoder stored under that name, e.g. { 'tracts' : None }.
+#: Names not listed here are never served.
+GEOCODER_SERVICES={}
+
+#: The number of seconds clients and caches may keep the results of single lookups over HTTP.
+GEOCODER_HTTP_MAX_AGE=3600
@@ -0,0 +1,358 @@
+from django.conf import settings
+from importlib import import_module
+from ga_geocoder import app_settings
+from ga_geocoder.spatial import parse_geometry
+from ga_geocoder.sqlite import LocalConnection
+import json
+import os
+import sqlite3
+
+from logging import getLogger
+
+log = getLogger(__name__)
+
+# Storage backends for the geocoders.  A backend holds a geocoder's metadata, its features keyed by code, and for
+# approximate geocoders the trigram postings, as (ngram, code, count) triples.  Metadata is read and written like a
+# dict; features go through these methods:
+#
+#   feature(code, variant=None)               the feature stored for a code, or None
+#   features(codes=None, variant=None)        the features stored for a collection of codes, or every feature
+#   codes()                                   every stored code
+#   count()                                   the number of stored codes, without reading them
+#   existing(codes)                           the set of a collection of codes that are stored
+#   insert(features)                          store a list of features, each with its code as '_id'
+#   remove(code)                              delete the feature stored for a code
+#   remove_many(codes)                        delete the features stored for a collection of codes
+#   overlapping(geometry)                     the features whose envelopes overlap that of a GEOS geometry
+#   postings(ngrams=None)                     the (ngram, code, count) postings of a collection of ngrams, or all
+#   add_postings(postings)                    store a list of new (ngram, code, count) postings
+#   increment_postings(deltas)                add a list of (ngram, code, delta) changes to postings' counts, creating
+#                                             postings as needed and deleting those whose counts fall to zero
+#   drop()                                    delete everything
+#
+# and a classmethod, exists(name), that says whether a geocoder has been stored under a name without creating it.
+#
+# A feature may carry alternate geometries, such as simplified ones, in a dict under 'variants'.  Features are read
+# without their variants, and with variant=name a feature is read with that variant as its geometry instead, so only
+# one geometry is ever transferred and decoded.
+
+def _mongo_db():
+    return settings.MONGODB_ROUTES['ga_geocoder'] if 'ga_geocoder' in settings.MONGODB_ROUTES else settings.MONGODB_ROUTES['default']
+
+class MongoBackend(object):
+    """Features in a ga_spatialnosql GeoJSONCollection, and postings in a plain collection beside it, in the database
+    routed to ga_geocoder in settings.MONGODB_ROUTES"""
+
+    def __init__(self, name, srid=4326, fc=None, clear=False):
+        from ga_spatialnosql.db.mongo import GeoJSONCollection
+
+        db = _mongo_db()
+        self.code_store = GeoJSONCollection(
+            db=db,
+            collection=name,
+            index_path=app_settings.GEO_INDEX_PATH,
+            srid=srid,
+            fc=fc,
+            clear=clear
+        )
+        self.ngram_store = db[name + "_ngrams"]
+        if clear:
+            self.ngram_store.drop()
+        self._indexed = False
+
+    @classmethod
+    def exists(cls, name):
+        return name in _mongo_db().collection_names()
+
+    @property
+    def srid(self):
+        return self.code_store.srid
+
+    def __getitem__(self, key):
+        return self.code_store[key]
+
+    def __setitem__(self, key, value):
+        self.code_store[key] = value
+
+    def __contains__(self, key):
+        return key in self.code_store
+
+    def _fields(self, variant):
+        return ['type', 'properties', 'geometry' if variant is None else 'variants.' + variant]
+
+    def _feature(self, doc, variant=None):
+        if doc is not None:
+            variants = doc.pop('variants', {})
+            if variant is not None:
+                doc['geometry'] = variants.get(variant)
+        return doc
+
+    def feature(self, code, variant=None):
+        return self._feature(self.code_store.coll.find_one(code, self._fields(variant)), variant)
+
+    def features(self, codes=None, variant=None):
+        spec = {} if codes is None else {'_id' : { '$in' : list(codes) }}
+        return (self._feature(doc, variant) for doc in self.code_store.coll.find(spec, self._fields(variant)))
+
+    def codes(self):
+        return self.code_store.coll.distinct('_id')
+
+    def count(self):
+        return self.code_store.coll.count()
+
+    def existing(self, codes):
+        return set(doc['_id'] for doc in self.code_store.coll.find({'_id' : { '$in' : list(codes) }}, ['_id']))
+
+    def insert(self, features):
+        self.code_store.insert_features({
+            'type' : "FeatureCollection",
+            'features' : features
+        })
+
+    def remove(self, code):
+        self.code_store.coll.remove(code)
+
+    def remove_many(self, codes):
+        self.code_store.coll.remove({'_id' : { '$in' : list(codes) }})
+
+    def overlapping(self, geometry):
+        return (self._feature(doc) for doc in self.code_store.find_features(geo_query={'bboverlaps' : geometry}))
+
+    def postings(self, ngrams=None):
+        spec = {} if ngrams is None else {'ngram' : { '$in' : list(ngrams) }}
+        for doc in self.ngram_store.find(spec, ['ngram', 'code', 'count']):
+            yield doc['ngram'], doc['code'], doc['count']
+
+    def _ensure_index(self):
+        if not self._indexed:
+            self.ngram_store.ensure_index([('ngram', 1), ('code', 1)])
+            self._indexed = True
+
+    def add_postings(self, postings):
+        postings = [{ "ngram" : ngram, "code" : code, "count" : count } for ngram, code, count in postings]
+        if postings:
+            self.ngram_store.insert(postings)
+            self._ensure_index()
+
+    def increment_postings(self, deltas):
+        if not deltas:
+            return
+        self._ensure_index()
+        if hasattr(self.ngram_store, 'initialize_unordered_bulk_op'):
+            bulk = self.ngram_store.initialize_unordered_bulk_op()
+            for ngram, code, delta in deltas:
+                bulk.find({'ngram' : ngram, 'code' : code}).upsert().update({'$inc' : {'count' : delta}})
+            bulk.execute()
+        else:
+            # pymongo before 2.7 has no bulk writes.
+            for ngram, code, delta in deltas:
+                self.ngram_store.update({'ngram' : ngram, 'code' : code}, {'$inc' : {'count' : delta}}, upsert=True)
+        self.ngram_store.remove({'code' : { '$in' : list(set(code for ngram, code, delta in deltas)) }, 'count' : { '$lte' : 0 }})
+
+    def drop(self):
+        self.code_store.drop()
+        self.ngram_store.drop()
+
+class SQLiteBackend(object):
+    """Everything in a single local SQLite database file, so that a geocoder can run in-process without a database
+    server.  Geometries are stored as WKB, and their envelopes in an R-tree for reverse geocoding.
+
+    :param name: the geocoder's name.  The database is name.sqlite in app_settings.GEO_INDEX_PATH unless path is given.
+    :param path: the database file.
+    :param timeout: the number of seconds to wait for another process's lock on the database.
+    """
+
+    @staticmethod
+    def _path(name):
+        return os.path.join(app_settings.GEO_INDEX_PATH, name + '.sqlite')
+
+    @classmethod
+    def exists(cls, name):
+        return os.path.exists(cls._path(name))
+
+    def __init__(self, name, srid=4326, fc=None, clear=False, path=None, timeout=30):
+        self.path = path or self._path(name)
+        self.timeout = timeout
+        self._connection = LocalConnection(self.path, timeout)
+
+        with self._db as db:
+            if clear:
+                for table in ('meta', 'features', 'variants', 'envelopes', 'postings'):
+                    db.execute('DROP TABLE IF EXISTS {table}'.format(table=table))
+            db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            db.execute('CREATE TABLE IF NOT EXISTS features (id INTEGER PRIMARY KEY, code TEXT UNIQUE, geometry BLOB, properties TEXT)')
+            db.execute('CREATE TABLE IF NOT EXISTS variants (id INTEGER, name TEXT, geometry BLOB, PRIMARY KEY (id, name))')
+            db.execute('CREATE TABLE IF NOT EXISTS postings (ngram TEXT, code TEXT, count INTEGER, PRIMARY KEY (ngram, code))')
+            db.execute('CREATE INDEX IF NOT EXISTS postings_code ON postings (code)')
+            try:
+                db.execute('CREATE VIRTUAL TABLE IF NOT EXISTS envelopes USING rtree (id, xmin, xmax, ymin, ymax)')
+            except sqlite3.OperationalError:
+                # sqlite was built without the R-tree module.  A plain table answers the same queries, by scanning.
+                log.warning('sqlite has no rtree module; reverse geocoding {path} will scan'.format(path=self.path))
+                db.execute('CREATE TABLE IF NOT EXISTS envelopes (id INTEGER PRIMARY KEY, xmin REAL, xmax REAL, ymin REAL, ymax REAL)')
+
+        if 'srid' not in self:
+            self['srid'] = srid
+        self.srid = self['srid']
+
+        if fc and fc.get('features'):
+            self.insert(fc['features'])
+
+    @property
+    def _db(self):
+        return self._connection.get()
+
+    def __getitem__(self, key):
+        row = self._db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def __setitem__(self, key, value):
+        with self._db as db:
+            db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    def __contains__(self, key):
+        return self._db.execute('SELECT 1 FROM meta WHERE key = ?', (key,)).fetchone() is not None
+
+    def _feature(self, row):
+        code, wkb, properties = row
+        return {
+            '_id' : code,
+            'type' : 'Feature',
+            'geometry' : json.loads(parse_geometry(wkb).json) if wkb is not None else None,
+            'properties' : json.loads(properties),
+        }
+
+    def _select(self, variant, where, params):
+        if variant is None:
+            sql = 'SELECT code, geometry, properties FROM features f'
+        else:
+            sql = 'SELECT f.code, v.geometry, f.properties FROM features f LEFT JOIN variants v ON v.id = f.id AND v.name = ?'
+            params = [variant] + list(params)
+        return self._db.execute(sql + where, params)
+
+    def feature(self, code, variant=None):
+        row = self._select(variant, ' WHERE f.code = ?', [code]).fetchone()
+        return self._feature(row) if row else None
+
+    def features(self, codes=None, variant=None):
+        if codes is None:
+            return (self._feature(row) for row in self._select(variant, '', []))
+
+        codes = list(codes)
+        found = []
+        # stay under sqlite's limit of 999 parameters per statement.
+        for i in xrange(0, len(codes), 500):
+            batch = codes[i:i+500]
+            found.extend(self._select(variant, ' WHERE f.code IN ({params})'.format(params=','.join('?' * len(batch))), batch))
+        return [self._feature(row) for row in found]
+
+    def codes(self):
+        return [code for code, in self._db.execute('SELECT code FROM features')]
+
+    def count(self):
+        return self._db.execute('SELECT COUNT(*) FROM features').fetchone()[0]
+
+    def existing(self, codes):
+        codes = list(codes)
+        found = set()
+        for i in xrange(0, len(codes), 500):
+            batch = codes[i:i+500]
+            found.update(code for code, in self._db.execute('SELECT code FROM features WHERE code IN ({params})'.format(
+                params=','.join('?' * len(batch))), batch))
+        return found
+
+    def insert(self, features):
+        with self._db as db:
+            for feature in features:
+                geometry = feature.get('geometry')
+                if geometry is not None:
+                    geometry = parse_geometry(json.dumps(geometry), self.srid)
+                    wkb = buffer(geometry.wkb)
+                else:
+                    wkb = None
+
+                self._remove(db, feature['_id'])
+                cursor = db.execute('INSERT INTO features (code, geometry, properties) VALUES (?, ?, ?)',
+                    (feature['_id'], wkb, json.dumps(feature.get('properties', {}))))
+                if geometry is not None:
+                    xmin, ymin, xmax, ymax = geometry.extent
+                    db.execute('INSERT INTO envelopes (id, xmin, xmax, ymin, ymax) VALUES (?, ?, ?, ?, ?)',
+                        (cursor.lastrowid, xmin, xmax, ymin, ymax))
+                for name, variant in feature.get('variants', {}).items():
+                    db.execute('INSERT INTO variants (id, name, geometry) VALUES (?, ?, ?)',
+                        (cursor.lastrowid, name, buffer(parse_geometry(json.dumps(variant), self.srid).wkb)))
+
+    def _remove(self, db, code):
+        row = db.execute('SELECT id FROM features WHERE code = ?', (code,)).fetchone()
+        if row is not None:
+            db.execute('DELETE FROM envelopes WHERE id = ?', row)
+            db.execute('DELETE FROM variants WHERE id = ?', row)
+            db.execute('DELETE FROM features WHERE id = ?', row)
+
+    def remove(self, code):
+        with self._db as db:
+            self._remove(db, code)
+
+    def remove_many(self, codes):
+        with self._db as db:
+            for code in codes:
+                self._remove(db, code)
+
+    def overlapping(self, geometry):
+        if geometry.srid is not None and geometry.srid != self.srid:
+            geometry = geometry.transform(self.srid, clone=True)
+        xmin, ymin, xmax, ymax = geometry.extent
+        rows = self._db.execute(
+            'SELECT f.code, f.geometry, f.properties FROM envelopes e JOIN features f ON f.id = e.id '
+            'WHERE e.xmin <= ? AND e.xmax >= ? AND e.ymin <= ? AND e.ymax >= ?', (xmax, xmin, ymax, ymin))
+        return (self._feature(row) for row in rows)
+
+    def postings(self, ngrams=None):
+        if ngrams is None:
+            for row in self._db.execute('SELECT ngram, code, count FROM postings'):
+                yield row
+            return
+
+        ngrams = list(ngrams)
+        for i in xrange(0, len(ngrams), 500):
+            batch = ngrams[i:i+500]
+            for row in self._db.execute('SELECT ngram, code, count FROM postings WHERE ngram IN ({params})'.format(
+                    params=','.join('?' * len(batch))), batch):
+                yield row
+
+    def add_postings(self, postings):
+        with self._db as db:
+            db.executemany('INSERT OR REPLACE INTO postings (ngram, code, count) VALUES (?, ?, ?)', postings)
+
+    def increment_postings(self, deltas):
+        with self._db as db:
+            db.executemany('INSERT OR IGNORE INTO postings (ngram, code, count) VALUES (?, ?, 0)',
+                [(ngram, code) for ngram, code, delta in deltas])
+            db.executemany('UPDATE postings SET count = count + ? WHERE ngram = ? AND code = ?',
+                [(delta, ngram, code) for ngram, code, delta in deltas])
+            db.executemany('DELETE FROM postings WHERE code = ? AND count <= 0',
+                [(code,) for code in set(code for ngram, code, delta in deltas)])
+
+    def drop(self):
+        self._connection.close()
+        for path in (self.path, self.path + '-wal', self.path + '-shm'):
+            if os.path.exists(path):
+                os.remove(path)
+
+def _backend_class():
+    setting = app_settings.GEOCODER_BACKEND
+    path, kwargs = setting if isinstance(setting, (list, tuple)) else (setting, {})
+    module, cls = path.rsplit('.', 1)
+    return getattr(import_module(module), cls), kwargs
+
+def open_backend(name, srid=4326, fc=None, clear=False):
+    """Open the storage for a named geocoder with the backend class named by app_settings.GEOCODER_BACKEND"""
+    cls, kwargs = _backend_class()
+    return cls(name, srid=srid, fc=fc, clear=clear, **kwargs)
+
+def backend_exists(name):
+    """Whether a geocoder has been stored under a name with the backend class named by app_settings.GEOCODER_BACKEND"""
+    cls, kwargs = _backend_class()
+    return cls.exists(name)
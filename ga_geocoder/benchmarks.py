@@ -0,0 +1,247 @@
+from contextlib import contextmanager
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from ga_geocoder import app_settings, geocoder
+from ga_geocoder.parsers import en_us
+from ga_geocoder.testing import StubNominatim
+import json
+import platform
+import random
+import shutil
+import tempfile
+import time
+
+from logging import getLogger
+
+log = getLogger(__name__)
+
+STREETS = ['Swarthmore', 'Europa', 'Damen', 'Main', 'Franklin', 'Rosemary', 'Hillsborough', 'Duke', 'Erwin', 'Cornwallis',
+           'Chapel Hill', 'Roxboro', 'Alston', 'Fayetteville', 'Guess', 'Hope Valley', 'University', 'Anderson']
+SUFFIXES = ['St', 'Rd', 'Ave', 'Dr', 'Blvd', 'Ln', 'Ct', 'Way', 'Pkwy']
+CITIES = [('Durham', 'NC', '27707'), ('Chapel Hill', 'NC', '27514'), ('Raleigh', 'NC', '27601'), ('Chicago', 'IL', '60622')]
+
+def tract_features(n, seed=0, origin=(-79.0, 35.9), size=0.01):
+    """Generate n census-tract-like codes and GeoJSON polygons: a grid of jittered, non-overlapping 16-sided cells, each
+    coded with a FIPS-like 11 digit code.  Returns a list of (code, GeoJSON text) pairs."""
+    rnd = random.Random(seed)
+    side = int(n ** 0.5) + 1
+    features = []
+    for i in range(n):
+        col, row = i % side, i // side
+        x0, y0 = origin[0] + col * size, origin[1] + row * size
+        ring = []
+        for k in range(16):
+            # walk the cell boundary, jittering inwards so neighbouring cells never overlap.
+            t = k / 4.0
+            edge, f = int(t), t - int(t)
+            x, y = [(f, 0), (1, f), (1 - f, 1), (0, 1 - f)][edge]
+            jx = rnd.uniform(0.0, 0.1) * (1 if x < 0.5 else -1)
+            jy = rnd.uniform(0.0, 0.1) * (1 if y < 0.5 else -1)
+            ring.append([x0 + (x + jx) * size, y0 + (y + jy) * size])
+        ring.append(ring[0])
+        code = '37063{n:06d}'.format(n=i)
+        features.append((code, json.dumps({ 'type' : 'Polygon', 'coordinates' : [ring] })))
+    return features
+
+def tract_points(features, n, seed=0):
+    """Pick n points, most of them near the centres of the given tract features"""
+    rnd = random.Random(seed)
+    points = []
+    for _ in range(n):
+        ring = json.loads(rnd.choice(features)[1])['coordinates'][0]
+        xs, ys = zip(*ring)
+        points.append((sum(xs) / len(xs) + rnd.uniform(-1e-4, 1e-4), sum(ys) / len(ys) + rnd.uniform(-1e-4, 1e-4)))
+    return points
+
+def address_corpus(n, seed=0):
+    """Generate n distinct street addresses"""
+    rnd = random.Random(seed)
+    addresses = set()
+    while len(addresses) < n:
+        city, state, zipcode = rnd.choice(CITIES)
+        addresses.add('{number} {street} {suffix} {city} {state} {zipcode}'.format(
+            number=rnd.randint(1, 9999), street=rnd.choice(STREETS), suffix=rnd.choice(SUFFIXES), city=city, state=state, zipcode=zipcode))
+    return sorted(addresses)
+
+def misspell(address, rnd):
+    """Drop, double or swap a letter in an address, as a fuzzy query"""
+    i = rnd.randint(0, len(address) - 2)
+    return rnd.choice([
+        address[:i] + address[i+1:],
+        address[:i] + address[i] + address[i:],
+        address[:i] + address[i+1] + address[i] + address[i+2:],
+    ])
+
+def percentile(samples, q):
+    """The q-th quantile (0 <= q <= 1) of a sorted list of samples, by the nearest rank"""
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(round(q * (len(samples) - 1))))]
+
+def _quietly(func):
+    """Wrap a lookup so that misses return None instead of raising KeyError"""
+    def lookup(item):
+        try:
+            return func(item)
+        except KeyError:
+            return None
+    return lookup
+
+def measure(name, size, func, inputs):
+    """Call func once per input, timing each call, and summarize the throughput and latency percentiles"""
+    latencies = []
+    started = time.time()
+    for item in inputs:
+        t = time.time()
+        func(item)
+        latencies.append(time.time() - t)
+    return summarize(name, size, len(latencies), time.time() - started, latencies)
+
+def measure_batch(name, size, func, n):
+    """Time a single call to func that processes n items, and summarize its throughput"""
+    started = time.time()
+    func()
+    return summarize(name, size, n, time.time() - started, [])
+
+def summarize(name, size, ops, seconds, latencies):
+    latencies = sorted(latencies)
+    result = {
+        'name' : name,
+        'size' : size,
+        'ops' : ops,
+        'seconds' : seconds,
+        'throughput' : ops / seconds if seconds else None,
+    }
+    for q in (50, 95, 99):
+        p = percentile(latencies, q / 100.0)
+        result['p{q}_ms'.format(q=q)] = p * 1000 if p is not None else None
+    log.info('{name} [{size}]: {throughput:.0f} ops/sec'.format(**dict(result, throughput=result['throughput'] or 0)))
+    return result
+
+def has_mongomock():
+    """Whether mongomock, the in-process Mongo stand-in that the exact and trigram benchmarks run against, is installed.
+    It is not a dependency of ga_geocoder itself: pip install mongomock"""
+    try:
+        import mongomock
+    except ImportError:
+        return False
+    return True
+
+@contextmanager
+def mongo_stand_in():
+    """Route the geocoders to an in-process mongomock database and a temporary spatial index directory"""
+    import mongomock
+
+    db = mongomock.MongoClient().ga_geocoder_benchmarks
+    routes = getattr(settings, 'MONGODB_ROUTES', None)
+    index_path = app_settings.GEO_INDEX_PATH
+    tmp = tempfile.mkdtemp()
+    settings.MONGODB_ROUTES = { 'default' : db, 'ga_geocoder' : db }
+    app_settings.GEO_INDEX_PATH = tmp
+    try:
+        yield db
+    finally:
+        settings.MONGODB_ROUTES = routes
+        app_settings.GEO_INDEX_PATH = index_path
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def bench_parsers(size, queries):
+    addresses = address_corpus(size)
+    return [
+        measure('parsers.address_trigrams', size, en_us.address_trigrams, addresses[:queries]),
+        measure('parsers.address_trigrams_naive', size, en_us.address_trigrams_naive, addresses[:queries]),
+    ]
+
+def bench_exact(size, queries):
+    results = []
+    features = tract_features(size)
+    rnd = random.Random(size)
+    codes = [rnd.choice(features)[0] for _ in range(queries)]
+    points = tract_points(features, queries)
+
+    coder = geocoder.ExactGeocoder('bench_exact_{size}'.format(size=size), clear=True)
+    try:
+        results.append(measure_batch('exact.bulk_load', size, lambda: coder.bulk_load(features, lambda x: x), len(features)))
+        results.append(measure('exact.getitem', size, _quietly(coder.__getitem__), codes))
+        results.append(measure_batch('exact.bulk_geocode', size, lambda: list(coder.bulk_geocode(codes)), len(codes)))
+        results.append(measure('exact.reverse_geocode', size, lambda xy: coder.reverse_geocode(Point(xy[0], xy[1], srid=4326)), points[:min(queries, 100)]))
+
+        coder.spatial_index = True
+        coder.spatial
+        results.append(measure('exact.reverse_geocode.indexed', size, lambda xy: coder.reverse_geocode(Point(xy[0], xy[1], srid=4326)), points))
+        results.append(measure_batch('exact.bulk_reverse_geocode', size, lambda: list(coder.bulk_reverse_geocode(points)), len(points)))
+    finally:
+        coder.drop()
+    return results
+
+def bench_trigram(size, queries):
+    results = []
+    addresses = address_corpus(size)
+    geometry = json.dumps({ 'type' : 'Point', 'coordinates' : [-78.9597, 35.93484] })
+    rnd = random.Random(size)
+    fuzzy = [misspell(rnd.choice(addresses), rnd) for _ in range(queries)]
+
+    coder = geocoder.TrigramGeocoder('bench_trigram_{size}'.format(size=size), clear=True)
+    try:
+        results.append(measure_batch('trigram.bulk_load', size, lambda: coder.bulk_load(dict((a, geometry) for a in addresses), lambda x: x), size))
+        results.append(measure('trigram.getitem.fuzzy', size, _quietly(coder.__getitem__), fuzzy[:min(queries, 100)]))
+        results.append(measure_batch('trigram.bulk_geocode.fuzzy', size, lambda: list(coder.bulk_geocode(fuzzy)), len(fuzzy)))
+
+        coder.memory_index = True
+        coder.index
+        results.append(measure('trigram.getitem.fuzzy.memory_index', size, _quietly(coder.__getitem__), fuzzy))
+    finally:
+        coder.drop()
+    return results
+
+def bench_osm(size, queries):
+    addresses = address_corpus(queries)
+    with StubNominatim() as nominatim:
+        coder = geocoder.OpenStreetMapGeocoder(urls=[nominatim.url], rate=None)
+        return [
+            measure('osm.getitem', size, _quietly(coder.__getitem__), addresses),
+            measure_batch('osm.bulk_geocode', size, lambda: list(coder.bulk_geocode(addresses)), len(addresses)),
+            measure_batch('osm.bulk_geocode_concurrent', size, lambda: list(coder.bulk_geocode_concurrent(addresses)), len(addresses)),
+        ]
+
+BENCHMARKS = {
+    'parsers' : bench_parsers,
+    'exact' : bench_exact,
+    'trigram' : bench_trigram,
+    'osm' : bench_osm,
+}
+
+#: The benchmarks that run against the Mongo stand-in, and are skipped if mongomock is not installed.
+MONGO_BENCHMARKS = ('exact', 'trigram')
+
+@contextmanager
+def _no_stand_in():
+    yield None
+
+def run(sizes=(1000, 10000), queries=1000, benchmarks=None):
+    """Run the named benchmarks, or all of them, at each corpus size against an in-process Mongo stand-in and a stub
+    Nominatim server, returning the results as a JSON-serializable dict.  If mongomock is not installed, the benchmarks
+    that need it are skipped with a warning and listed in the results as skipped."""
+    names = sorted(benchmarks or BENCHMARKS)
+    mongo = [name for name in names if name in MONGO_BENCHMARKS]
+    skipped = []
+    if mongo and not has_mongomock():
+        log.warning('skipping the {names} benchmarks, which need mongomock: pip install mongomock'.format(names=', '.join(mongo)))
+        names = [name for name in names if name not in mongo]
+        skipped, mongo = mongo, []
+
+    results = []
+    with mongo_stand_in() if mongo else _no_stand_in():
+        for size in sizes:
+            for name in names:
+                results.extend(BENCHMARKS[name](size, queries))
+
+    return {
+        'python' : platform.python_version(),
+        'platform' : platform.platform(),
+        'started' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'sizes' : list(sizes),
+        'queries' : queries,
+        'results' : results,
+        'skipped' : skipped,
+    }
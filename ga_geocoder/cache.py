@@ -0,0 +1,210 @@
+from collections import OrderedDict
+from threading import RLock
+from ga_geocoder.sqlite import LocalConnection
+import json
+import time
+
+class LRUCache(object):
+    """A bounded, thread-safe cache that evicts the least recently used entries once it holds more than max_entries
+    entries or more than max_bytes of values, and optionally expires entries ttl seconds after they were stored.
+
+    Values are shared between everyone who reads them from the cache, so they should be treated as read-only.
+
+    :param max_entries: the most entries to hold, or None for no limit.
+    :param max_bytes: the most bytes of values to hold, or None for no limit.
+    :param ttl: the number of seconds an entry stays valid, or None to keep entries until they are evicted.
+    :param sizeof: a function returning the size of a value in bytes.  Defaults to the length of its JSON encoding.
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=None, ttl=None, sizeof=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof or (lambda value: len(json.dumps(value)))
+
+        self._entries = OrderedDict()
+        self._lock = RLock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Return the value stored for key, or default if it is not cached or has expired"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, expires, size = entry
+            if expires is not None and expires < time.time():
+                self.bytes -= size
+                self.misses += 1
+                return default
+
+            self._entries[key] = entry
+            self.hits += 1
+            return value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        size = self.sizeof(value) if self.max_bytes else 0
+        expires = time.time() + self.ttl if self.ttl else None
+
+        with self._lock:
+            self.pop(key)
+            self._entries[key] = (value, expires, size)
+            self.bytes += size
+
+            while self._entries and (
+                (self.max_entries and len(self._entries) > self.max_entries) or
+                (self.max_bytes and self.bytes > self.max_bytes)
+            ):
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        """Remove key from the cache, returning its value or default"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            self.bytes -= entry[2]
+            return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """Return a dict of the cache's hit, miss and eviction counters and its current size"""
+        return {
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'evictions' : self.evictions,
+            'entries' : len(self._entries),
+            'bytes' : self.bytes,
+        }
+
+class SQLiteCache(object):
+    """A persistent cache of JSON-serializable values in a SQLite database, which survives restarts and can be shared by
+    any number of processes and threads.  Entries expire ttl seconds after they were stored, and once the cache holds
+    more than max_entries entries the least recently used are evicted.  Hit and miss counters are kept per instance.
+
+    :param path: the database file.
+    :param ttl: the number of seconds an entry stays valid, or None to keep entries until they are evicted.
+    :param max_entries: the most entries to hold, or None for no limit.
+    :param timeout: the number of seconds to wait for another process's lock on the database.
+    :param touch_interval: how many seconds out of date an entry's last use may be recorded as.  A hit only writes its
+        time of use once the recorded one is older than this, so that hits rarely take the database's write lock.  Uses
+        are not recorded at all when there is no max_entries.
+    """
+
+    # how many writes go by between checks of the cache's size.
+    EVICTION_INTERVAL = 100
+
+    def __init__(self, path, ttl=None, max_entries=None, timeout=30, touch_interval=60):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.touch_interval = touch_interval
+
+        self._connection = LocalConnection(path, timeout)
+        self._lock = RLock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        with self._db as db:
+            db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires REAL, accessed REAL)')
+            db.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+
+    @property
+    def _db(self):
+        return self._connection.get()
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    def get(self, key, default=None):
+        """Return the value stored for key, or default if it is not cached or has expired"""
+        now = time.time()
+        with self._db as db:
+            row = db.execute('SELECT value, expires, accessed FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] < now):
+                self._count('misses')
+                return default
+            if self.max_entries and row[2] < now - self.touch_interval:
+                db.execute('UPDATE cache SET accessed = ? WHERE key = ?', (now, key))
+
+        self._count('hits')
+        return json.loads(row[0])
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        now = time.time()
+        with self._db as db:
+            db.execute('INSERT OR REPLACE INTO cache (key, value, expires, accessed) VALUES (?, ?, ?, ?)',
+                (key, json.dumps(value), now + self.ttl if self.ttl else None, now))
+
+        with self._lock:
+            self._writes += 1
+            evict = self.max_entries and self._writes % self.EVICTION_INTERVAL == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Delete expired entries, then the least recently used entries beyond max_entries"""
+        with self._db as db:
+            evicted = db.execute('DELETE FROM cache WHERE expires < ?', (time.time(),)).rowcount
+            if self.max_entries:
+                excess = db.execute('SELECT COUNT(*) FROM cache').fetchone()[0] - self.max_entries
+                if excess > 0:
+                    evicted += db.execute('DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed LIMIT ?)', (excess,)).rowcount
+
+        with self._lock:
+            self.evictions += evicted
+
+    def pop(self, key, default=None):
+        """Remove key from the cache, returning its value or default"""
+        value = self.get(key, default)
+        with self._db as db:
+            db.execute('DELETE FROM cache WHERE key = ?', (key,))
+        return value
+
+    def clear(self):
+        with self._db as db:
+            db.execute('DELETE FROM cache')
+
+    def stats(self):
+        """Return a dict of this instance's hit, miss and eviction counters, its hit rate, and the size of the cache"""
+        lookups = self.hits + self.misses
+        return {
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'evictions' : self.evictions,
+            'hit_rate' : float(self.hits) / lookups if lookups else 0.0,
+            'entries' : len(self),
+        }
@@ -1,167 +1,733 @@
-from collections import Counter
-from django.contrib.gis.geos.geometry import GEOSGeometry, Point, Polygon
-from django.conf import settings
+from collections import Counter, OrderedDict, defaultdict, deque
 import app_settings
 import UserDict
-from ga_spatialnosql.db.mongo import GeoJSONCollection
 from ga_geocoder.parsers.independent import ci_code, ci_shortcode, cs_code, cs_shortcode
 from ga_geocoder import parsers
+from ga_geocoder.backends import open_backend
+from ga_geocoder.index import TrigramIndex, document_frequencies, normalize, rank, similarity, stop_ngrams
+from ga_geocoder.instrumentation import metrics
+from ga_geocoder.reproject import reproject_features, reproject_points
+from ga_geocoder.snapshot import Snapshot, write_snapshot
+from ga_geocoder.spatial import SpatialIndex, parse_geometry, points_in_geometry
+from itertools import islice
 import json
 from logging import getLogger
-import requests
+import numpy
+from operator import itemgetter
+import Queue
+import threading
+import time
 
 log = getLogger(__name__)
 
 def _chunk(seq, size=1000):
+    """Split an iterable into lists of size items.  Each chunk is a new list, so consumers may keep them."""
     chunk = []
-    N = 0
     for it in seq:
         chunk.append(it)
-        N += 1
-        if N == size:
+        if len(chunk) == size:
             yield chunk
-            N=0
-            del chunk[:]
+            chunk = []
     if chunk:
         yield chunk
 
-class ExactGeocoder(object, UserDict.DictMixin):
-    def __init__(self, name, case_sensitive=False, long_codes=False, srid=4326, fc=None, clear=False):
-        self.code_store = GeoJSONCollection(
-            db=settings.MONGODB_ROUTES['ga_geocoder'] if 'ga_geocoder' in settings.MONGODB_ROUTES else settings.MONGODB_ROUTES['default'],
-            collection=name,
-            index_path=app_settings.GEO_INDEX_PATH,
-            srid=srid,
-            fc=fc,
-            clear=clear
-        )
-        self.code_store['kind'] = 'exact'
+class _ChunkSizer(object):
+    """Sizes the chunks of a bulk job from what fetching earlier chunks cost, growing them while a chunk takes less than
+    seconds to fetch and returns less than max_bytes, and shrinking them when it takes more.  Each observation moves the
+    size halfway to the ideal, so one slow chunk does not halve the next."""
+
+    def __init__(self, size=1000, minimum=100, maximum=20000, seconds=app_settings.BULK_CHUNK_SECONDS, max_bytes=app_settings.BULK_CHUNK_BYTES):
+        self.size = size
+        self.minimum = minimum
+        self.maximum = maximum
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def observe(self, n, seconds, document_size):
+        """Record that fetching n items took seconds and returned documents of about document_size bytes each"""
+        if not n:
+            return
+        ideal = self.maximum
+        if seconds > 0:
+            ideal = min(ideal, self.seconds * n / seconds)
+        if document_size:
+            ideal = min(ideal, self.max_bytes / document_size)
+        with self._lock:
+            self.size = int(max(self.minimum, min(self.maximum, (self.size + ideal) / 2)))
+
+    def chunks(self, seq):
+        """Split an iterable into new lists of the current size"""
+        seq = iter(seq)
+        while True:
+            chunk = list(islice(seq, self.size))
+            if not chunk:
+                return
+            yield chunk
+
+def _prefetch(chunks, fetch, depth, timeout=10):
+    """Yield (chunk, fetch(chunk)) for each chunk, in order, with the next depth chunks fetched on as many threads while
+    the caller consumes the current one.  Chunks are read from the iterable on the caller's thread, and an exception
+    raised by fetch is raised here.  When the caller stops, the threads are waited for, for at most timeout seconds in
+    all, to finish the fetches they have started."""
+    if not depth:
+        for chunk in chunks:
+            yield chunk, fetch(chunk)
+        return
+
+    tasks = Queue.Queue()
+    stopped = threading.Event()
+
+    def work():
+        for chunk, result in iter(tasks.get, None):
+            if stopped.is_set():
+                continue
+            try:
+                result.put((fetch(chunk), None))
+            except Exception as e:
+                result.put((None, e))
+
+    workers = [threading.Thread(target=work) for _ in range(depth)]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+
+    pending = deque()
+    chunks = iter(chunks)
+    try:
+        while True:
+            # keep depth chunks in flight beyond the one the caller is waiting for.
+            while len(pending) <= depth:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                result = Queue.Queue(maxsize=1)
+                tasks.put((chunk, result))
+                pending.append((chunk, result))
+            if not pending:
+                return
+            chunk, result = pending.popleft()
+            value, error = result.get()
+            if error is not None:
+                raise error
+            yield chunk, value
+    finally:
+        stopped.set()
+        for _ in workers:
+            tasks.put(None)
+        deadline = time.time() + timeout
+        for thread in workers:
+            thread.join(max(0, deadline - time.time()))
+
+def _settle(store, legacy=None, **values):
+    """Return a geocoder's stored metadata for the keys of values.  A new store, one without a kind, is given the values.
+    An existing store's values win, so opening an existing geocoder reads its settings and writes nothing.
+
+    :param legacy: what a key that an existing store was created without means, such as the value a setting had before
+        it could be chosen.  Keys not in legacy take the given value.  Neither is stored.
+    """
+    new = 'kind' not in store
+    meta = {}
+    for key, value in values.items():
+        if key in store:
+            meta[key] = store[key]
+        elif new:
+            meta[key] = store[key] = value
+        else:
+            meta[key] = (legacy or {}).get(key, value)
+    return meta
+
+def _code_parser(case_sensitive, long_codes):
+    if case_sensitive and long_codes:
+        return ci_shortcode
+    elif case_sensitive:
+        return ci_code
+    elif long_codes:
+        return cs_shortcode
+    else:
+        return cs_code
+
+class _SpatialIndexMixin(object):
+    """Reverse geocoding for geocoders with a storage backend.  If spatial_index is set, queries are answered from an
+    in-process SpatialIndex of the store, built on first use.  Geocoders must reset _spatial whenever they write."""
+
+    spatial_index = False
+    _spatial = None
+
+    @property
+    def spatial(self):
+        """The in-memory SpatialIndex, built from the code store on first use"""
+        if self._spatial is None:
+            self._spatial = SpatialIndex(self.store.features(), self.store.srid)
+        return self._spatial
+
+    def flush(self):
+        """Write any buffered changes to the store.  Geocoders that buffer writes override this."""
+        pass
+
+    def reverse_geocode(self, geometry):
+        self.flush()
+        if self.spatial_index:
+            with metrics.timer('reverse.index'):
+                return self.spatial.query(geometry)
+
+        with metrics.timer('reverse.db'):
+            for feature in self.store.overlapping(geometry):
+                metrics.incr('reverse.db.docs')
+                return feature
+            return None
+
+    def bulk_reverse_geocode(self, points, srid=None, chunk_size=100000):
+        """Reverse geocode many points at once against the in-memory spatial index, which is built if need be.
+
+        :param points: an (N, 2) array or an iterable of (x, y) coordinates.
+        :param srid: the srid of the points, if it is not that of the geocoder.
+        :param chunk_size: the number of points joined against the index at a time.
+        :return: an iterator of (index, code) pairs in input order, where code is None if no feature contains the point.
+        """
+        self.flush()
+        if hasattr(points, 'shape'):
+            chunks = (points[i:i+chunk_size] for i in xrange(0, len(points), chunk_size))
+        else:
+            chunks = _chunk(points, chunk_size)
+
+        offset = 0
+        for chunk in chunks:
+            xy = numpy.asarray(chunk, dtype=float)[:, :2]
+            if srid and srid != self.store.srid:
+                xy = reproject_points(xy, srid, self.store.srid)[:, :2]
+
+            for i, feature in enumerate(self.spatial.join(xy[:, 0], xy[:, 1])):
+                yield offset + i, feature['_id'] if feature is not None else None
+            offset += len(xy)
+
+class ExactGeocoder(_SpatialIndexMixin, UserDict.DictMixin):
+    # levels of detail, besides the full geometry (None) and the simplified geometries, which are numbered by tolerance.
+    CENTROID='centroid'
+    BBOX='bbox'
+
+    def __init__(self, name, case_sensitive=False, long_codes=False, srid=4326, fc=None, clear=False, cache=None, spatial_index=False, backend=None, tolerances=None):
+        """
+        :param backend: the geocoder's storage, from ga_geocoder.backends.  Defaults to a new store of the kind named by
+            app_settings.GEOCODER_BACKEND.
+        :param tolerances: if given, features are stored with a centroid, a bounding box and a geometry simplified to
+            each of these tolerances, in the units of srid, as levels of detail to return instead of the full geometry.
+        """
+        self.store = backend if backend is not None else open_backend(name, srid=srid, fc=fc, clear=clear)
+        meta = _settle(self.store, legacy={ 'tolerances' : None },
+            kind='exact', name=name, case_sensitive=case_sensitive, long_codes=long_codes, tolerances=tolerances)
 
         self.serialize = lambda x: x.json
-        self.deserialize = lambda x: GEOSGeometry(x, srid=self.code_store.srid)
+        self.deserialize = lambda x: parse_geometry(x, self.store.srid)
+
+        #
+        # setup parser and levels of detail, as they were when the geocoder was created
+        #
+        self.parse = _code_parser(meta['case_sensitive'], meta['long_codes'])
+        self.tolerances = meta['tolerances']
 
         #
-        # setup parser
+        # setup cache.  Entries are keyed by (code, srid, variant), so we track the (srid, variant) pairs we have cached
+        # to invalidate a code.  bulk_geocode caches from its prefetch threads, so the pairs are guarded by a lock.
         #
-        case_sensitive = self.code_store['case_sensitive'] if 'case_sensitive' in self.code_store else case_sensitive
-        long_codes = self.code_store['long_codes'] if 'long_codes' in self.code_store else long_codes
-
-        self.code_store['name'] = name
-        self.code_store['case_sensitive'] = case_sensitive
-        self.code_store['long_codes'] = long_codes
-
-        if case_sensitive and long_codes:
-            self.parse = ci_shortcode
-        elif case_sensitive:
-            self.parse = ci_code
-        elif long_codes:
-            self.parse = cs_shortcode
+        self.cache = cache
+        self._cached_variants = set()
+        self._variants_lock = threading.Lock()
+        self.spatial_index = spatial_index
+
+    def _invalidate(self, code=None):
+        """Drop the spatial index, and a parsed code, or everything if code is None, from the cache"""
+        self._spatial = None
+        if self.cache is None:
+            return
+        if code is None:
+            self.cache.clear()
         else:
-            self.parse = cs_code
+            with self._variants_lock:
+                variants = list(self._cached_variants)
+            for srid, variant in variants:
+                self.cache.pop((code, srid, variant))
+
+    def _cache(self, code, srid, variant, feature):
+        if self.cache is not None:
+            with self._variants_lock:
+                self._cached_variants.add((srid, variant))
+            self.cache[code, srid, variant] = feature
+
+    def _variant(self, detail):
+        """The name of the stored variant for a level of detail: None for the full geometry, CENTROID, BBOX, or the index
+        of a simplification tolerance"""
+        if detail is None:
+            return None
+        if self.tolerances is None:
+            raise ValueError('{name} was not loaded with levels of detail'.format(name=self.store['name']))
+        if detail in (self.CENTROID, self.BBOX):
+            return detail
+        if isinstance(detail, int) and 0 <= detail < len(self.tolerances):
+            return 'simplified_{i}'.format(i=detail)
+        raise ValueError('no level of detail {detail}'.format(detail=detail))
+
+    def _variants(self, geom):
+        """Compute the levels of detail of a GeoJSON geometry"""
+        with metrics.timer('exact.simplify'):
+            g = parse_geometry(json.dumps(geom), self.store.srid)
+            variants = {
+                self.CENTROID : json.loads(g.centroid.json),
+                self.BBOX : json.loads(g.envelope.json),
+            }
+            for i, tolerance in enumerate(self.tolerances):
+                variants['simplified_{i}'.format(i=i)] = json.loads(g.simplify(tolerance, preserve_topology=True).json)
+            return variants
+
+    def _feature(self, code, orig, geom):
+        feature = {
+            '_id' : code,
+            'type' : 'Feature',
+            'geometry' : geom,
+            'properties' : { 'code' : code, 'name' : orig }
+        }
+        if self.tolerances is not None and geom is not None:
+            feature['variants'] = self._variants(geom)
+        return feature
 
     def __setitem__(self, code, geometry):
         orig = code
         code = self.parse(code)
 
-        self.code_store.insert_features({
-            "_id" : code,
-            'type' : 'Feature',
-            'properties' : { 'code' : code, 'name' : orig },
-            'geometry' : self.serialize(geometry)
-        })
+        self.store.insert([self._feature(code, orig, json.loads(self.serialize(geometry)))])
+        self._invalidate(code)
 
-    def bulk_load(self, code_to_geom, geom_serializer=None):
-        fc = {
-          'type' : "FeatureCollection",
-        }
+    def _load_features(self, code_to_geom, geom_serializer=None):
+        for code, geom in code_to_geom:
+            with metrics.timer('exact.serialize'):
+                if geom_serializer:
+                    geom = json.loads(geom_serializer(geom))
+                else:
+                    geom = json.loads(self.serialize(geom))
 
-        log.debug("Beginning bulk load of {name}".format(name=self.code_store['name']))
+            yield self._feature(self.parse(code), code, geom)
 
-        features = []
-        for code, geom in code_to_geom.items():
-            if geom_serializer:
-                geom = json.loads(geom_serializer(geom))
-            else:
-                geom = json.loads(self.serialize(geom))
+    def bulk_load(self, code_to_geom, geom_serializer=None, batch_size=1000, progress=None):
+        """Load a dict, or any iterable of (code, geometry) pairs, into the geocoder.  Features are serialized and
+        written batch_size at a time as they are pulled from the iterable, so memory use does not depend on the size of
+        the input.
 
-            orig = code
-            code = self.parse(code)
-            features.append({
-                '_id' : code,
-                'geometry' : geom,
-                'properties' : { 'code' : code, 'name' : orig }
-            })
+        :param geom_serializer: a function turning a geometry into GeoJSON text.  Defaults to self.serialize
+        :param progress: if given, called as progress(features, batches) after every batch is written.
+        :return: the number of features loaded.
+        """
+        if hasattr(code_to_geom, 'iteritems'):
+            code_to_geom = code_to_geom.iteritems()
 
-        log.debug('bulk_load got {n} features'.format(n=len(features)))
+        log.debug("Beginning bulk load of {name}".format(name=self.store['name']))
 
+        n = 0
+        batches = 0
+        for features in _chunk(self._load_features(code_to_geom, geom_serializer), batch_size):
+            with metrics.timer('exact.db.insert'):
+                self.store.insert(features)
+            metrics.incr('exact.load.features', len(features))
+            n += len(features)
+            batches += 1
+            if progress:
+                progress(n, batches)
 
-        fc['features'] = features
-        self.code_store.insert_features(fc)
+        log.debug('bulk_load got {n} features in {batches} batches'.format(n=n, batches=batches))
+        self._invalidate()
+        return n
 
     def __getitem__(self, code):
+        """Return the feature for a code, for a (code, srid) pair with the geometry transformed to srid, or for a
+        (code, srid, detail) triple with the geometry at a level of detail: CENTROID, BBOX, the index of a
+        simplification tolerance, or None for the full geometry.  If the geocoder has a cache, features returned from
+        it are shared and should not be modified."""
         srid=None
+        detail=None
         if isinstance(code, tuple):
-            code, srid = code
+            if len(code) == 3:
+                code, srid, detail = code
+            else:
+                code, srid = code
+        code = self.parse(code)
+        variant = self._variant(detail)
+
+        if self.cache is not None:
+            val = self.cache.get((code, srid, variant))
+            if val is not None:
+                metrics.incr('exact.cache.hit')
+                return val
+            metrics.incr('exact.cache.miss')
 
-        val = self.code_store.coll.find_one(code)
+        with metrics.timer('exact.db.find'):
+            val = self.store.feature(code, variant)
         if val:
+            metrics.incr('exact.db.docs')
             if srid:
-                g = GEOSGeometry(json.dumps(val['geometry']), srid=self.code_store.srid)
-                g.transform(srid)
-                val['geometry'] = json.loads(g.json)
+                with metrics.timer('exact.reproject'):
+                    val = reproject_features([val], self.store.srid, srid)[0]
+            self._cache(code, srid, variant, val)
             return val
         else:
             raise KeyError(code)
 
 
     def __delitem__(self, code):
-        self.code_store.coll.remove(code)
+        code = self.parse(code)
+        self.store.remove(code)
+        self._invalidate(code)
 
     def keys(self):
-        return self.code_store.keys()
+        return self.store.codes()
 
-    def bulk_geocode(self, codes, srid=None):
-        chunks = _chunk(codes)
-        for chunk in chunks:
-            features = self.code_store.find_features(spec={ "_id" : { "$in" : chunk }})
+    def _bulk_features(self, codes, srid, variant):
+        """Return a dict of the features found for a list of distinct parsed codes, answering what we can from the cache
+        and going to the database once for the rest"""
+        found = {}
+        if self.cache is not None:
+            misses = []
+            for code in codes:
+                feature = self.cache.get((code, srid, variant))
+                if feature is None:
+                    misses.append(code)
+                else:
+                    found[code] = feature
+            metrics.incr('exact.cache.hit', len(codes) - len(misses))
+            metrics.incr('exact.cache.miss', len(misses))
+            codes = misses
+
+        if codes:
+            with metrics.timer('exact.db.find'):
+                features = list(self.store.features(codes, variant))
+            metrics.incr('exact.db.docs', len(features))
             if srid:
-                for feature in features:
-                    g = GEOSGeometry(json.dumps(feature['geometry']), srid=self.code_store.srid)
-                    g.transform(srid)
-                    feature['geometry'] = json.loads(g.json)
-                    yield feature['_id'], feature
+                with metrics.timer('exact.reproject'):
+                    features = reproject_features(features, self.store.srid, srid)
+            for feature in features:
+                self._cache(feature['_id'], srid, variant, feature)
+                found[feature['_id']] = feature
+        return found
+
+    def bulk_geocode(self, codes, srid=None, detail=None, ordered=False, prefetch=app_settings.BULK_PREFETCH, chunk_size=None):
+        """Geocode an iterable of codes, optionally with the geometries transformed to srid or at a level of detail as
+        for __getitem__.  Codes are parsed, and each distinct code is fetched once per chunk of the input however often
+        it repeats.
+
+        :param ordered: if True, yield an (input, feature) pair for every input, in input order, with None as the
+            feature of inputs that are not found, so results can be joined to the input by position.  Otherwise yield a
+            (code, feature) pair for each distinct parsed code that is found.  Repeated inputs share one feature.
+        :param prefetch: the number of chunks fetched ahead on as many threads while the caller consumes the current one.
+        :param chunk_size: the number of codes fetched at a time.  By default chunks are sized from the latency and the
+            size of the features of the chunks fetched so far.
+        """
+        variant = self._variant(detail)
+        sizer = _ChunkSizer(chunk_size, chunk_size, chunk_size) if chunk_size else _ChunkSizer()
+
+        def fetch(chunk):
+            started = time.time()
+            parsed = [self.parse(code) for code in chunk]
+            distinct = list(OrderedDict.fromkeys(parsed))
+            found = self._bulk_features(distinct, srid, variant)
+            # one feature is enough to estimate the size of the rest.
+            sample = next(found.itervalues(), None)
+            sizer.observe(len(distinct), time.time() - started, len(json.dumps(sample)) if sample is not None else 0)
+            return parsed, distinct, found
+
+        for chunk, (parsed, distinct, found) in _prefetch(sizer.chunks(codes), fetch, prefetch):
+            if ordered:
+                for code, key in zip(chunk, parsed):
+                    yield code, found.get(key)
+            else:
+                for key in distinct:
+                    if key in found:
+                        yield key, found[key]
+
+    def export_snapshot(self, path):
+        """Write every feature, with its full geometry only, to an immutable snapshot file, to be served by a
+        SnapshotGeocoder.
+
+        :return: the number of features written.
+        """
+        return write_snapshot(path, self.store.features(), self.store.srid, {
+            'name' : self.store['name'],
+            'case_sensitive' : self.store['case_sensitive'],
+            'long_codes' : self.store['long_codes'],
+        })
+
+    def drop(self):
+        self.store.drop()
+        self.store = None
+        self._invalidate()
+
+class SnapshotGeocoder(object, UserDict.DictMixin):
+    """A read-only exact geocoder over a snapshot file written by ExactGeocoder.export_snapshot.  The file is memory
+    mapped, so any number of processes can share one copy of it in the page cache, and opening it costs nothing.
+    Features are decoded from the file on every lookup and belong to the caller.  Snapshots hold only full geometries,
+    not the levels of detail of the geocoder they were exported from."""
+
+    def __init__(self, path):
+        self.snapshot = Snapshot(path)
+        self.srid = self.snapshot.srid
+        self.parse = _code_parser(self.snapshot.metadata.get('case_sensitive', False), self.snapshot.metadata.get('long_codes', False))
+
+    def _check_detail(self, detail):
+        if detail is not None:
+            raise ValueError('snapshots hold only full geometries, not level of detail {detail}'.format(detail=detail))
+
+    def __getitem__(self, code):
+        """Return the feature for a code, or for a (code, srid) pair with the geometry transformed to srid.  A (code,
+        srid, detail) triple raises ValueError unless detail is None, for the full geometry."""
+        srid=None
+        if isinstance(code, tuple):
+            if len(code) == 3:
+                code, srid, detail = code
+                self._check_detail(detail)
+            else:
+                code, srid = code
+        code = self.parse(code)
+
+        i = self.snapshot.find(code)
+        if i < 0:
+            raise KeyError(code)
+        val = self.snapshot.feature(i)
+        if srid:
+            val = reproject_features([val], self.srid, srid)[0]
+        return val
+
+    def __setitem__(self, code, geometry):
+        raise TypeError('snapshot geocoders are read-only')
+
+    def __delitem__(self, code):
+        raise TypeError('snapshot geocoders are read-only')
+
+    def __len__(self):
+        return len(self.snapshot)
+
+    def keys(self):
+        return self.snapshot.keys()
+
+    def raw(self, code):
+        """Return the GeoJSON text of the feature for a code as a buffer onto the snapshot, without decoding or copying it"""
+        i = self.snapshot.find(self.parse(code))
+        if i < 0:
+            raise KeyError(code)
+        return self.snapshot.payload(i)
+
+    def bulk_geocode(self, codes, srid=None, detail=None, ordered=False):
+        """Geocode an iterable of codes as ExactGeocoder.bulk_geocode does, decoding each distinct code once per chunk.
+        Raises ValueError if detail is not None."""
+        self._check_detail(detail)
+        for chunk in _chunk(codes):
+            parsed = [self.parse(code) for code in chunk]
+            distinct = list(OrderedDict.fromkeys(parsed))
+            found = []
+            for key in distinct:
+                i = self.snapshot.find(key)
+                if i >= 0:
+                    found.append(self.snapshot.feature(i))
+            if srid:
+                found = reproject_features(found, self.srid, srid)
+            if ordered:
+                found = dict((feature['_id'], feature) for feature in found)
+                for code, key in zip(chunk, parsed):
+                    yield code, found.get(key)
             else:
-                for feature in features:
+                for feature in found:
                     yield feature['_id'], feature
 
     def reverse_geocode(self, geometry):
-        val = self.code_store.find_features(geo_query={'bboverlaps' : geometry})
-        try:
-            return val.next()
-        except StopIteration:
-            return None
+        """Return the first feature containing a point, or intersecting any other geometry, or None"""
+        if geometry.srid is not None and geometry.srid != self.srid:
+            geometry = geometry.transform(self.srid, clone=True)
 
-    def drop(self):
-        self.code_store.drop()
-        self.code_store = None
-
-class TrigramGeocoder(object):
-    def __init__(self, name, srid=4326, n=3, fc=None, clear=False):
-        self.code_store = GeoJSONCollection(
-            db=settings.MONGODB_ROUTES['ga_geocoder'] if 'ga_geocoder' in settings.MONGODB_ROUTES else settings.MONGODB_ROUTES['default'],
-            collection=name,
-            index_path=app_settings.GEO_INDEX_PATH,
-            srid=srid,
-            fc=fc,
-            clear=clear
-        )
-        self.ngram_store = settings.MONGODB_ROUTES['ga_geocoder'][name + "_ngrams"]
-        self.code_store['kind'] = 'trigram'
-        self.code_store['ngrams'] = name + "_ngrams"
+        for i in self.snapshot.overlapping(geometry.extent):
+            feature = self.snapshot.feature(i)
+            inside = None
+            if geometry.geom_type == 'Point':
+                inside = points_in_geometry(numpy.array([geometry.x]), numpy.array([geometry.y]), feature['geometry'])
+            if inside is not None:
+                if inside[0]:
+                    return feature
+            elif parse_geometry(json.dumps(feature['geometry']), self.srid).intersects(geometry):
+                return feature
+        return None
+
+class TrigramGeocoder(_SpatialIndexMixin):
+    def __init__(self, name, srid=4326, n=3, fc=None, clear=False, memory_index=False, candidates=10, spatial_index=False, backend=None, flush_size=1, flush_interval=5, stop_fraction=0.1, rerank=None, threshold=0.5):
+        """
+        :param candidates: the number of approximate matches returned for a code.
+        :param stop_fraction: ngrams found in more than this fraction of codes are stop ngrams, which say too little
+            about a query to be worth searching for.  Stop ngrams are found again whenever codes are added or removed.
+        :param rerank: if given, this many of the best candidates by ngrams are reranked by the edit similarity of their
+            names to the query's.
+        :param threshold: the lowest edit similarity, from 0 to 1, of a reranked candidate that is returned.
+        :param flush_size: the number of codes whose single item writes and deletes are buffered and then written to
+            the store together.  The default of 1 writes every change through.  With a larger size, reads flush first,
+            but callers must call flush() once they have finished writing, or the last changes are lost.
+        :param flush_interval: the most seconds a buffered change waits before the next write flushes the buffer.
+        """
+        self.store = backend if backend is not None else open_backend(name, srid=srid, fc=fc, clear=clear)
+        _settle(self.store, kind='trigram', ngrams=name + "_ngrams")
         self.serialize = lambda x: x.json
-        self.deserialize = lambda x: GEOSGeometry(x, srid=self.code_store.srid)
+        self.deserialize = lambda x: parse_geometry(x, self.store.srid)
         self.parser = parsers.en_us.address_trigrams
 
+        #
+        # setup fuzzy matching
+        #
+        self.memory_index = memory_index
+        self.candidates = candidates
+        self._index = None
+        self.spatial_index = spatial_index
+        self.stop_fraction = stop_fraction
+        self.rerank = rerank
+        self.threshold = threshold
+        self.stats = self.store['ngram_stats'] if 'ngram_stats' in self.store else None
+        self._stop = None
+        self._df = None
+        self._size = None
+
+        #
+        # setup write buffer.  Pending changes are kept as code -> feature, or None for a delete, so that only the last
+        # change to a code is written.
+        #
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._pending_since = None
+        self._lock = threading.RLock()
+
+    def _invalidate(self):
+        """Drop the in-memory indexes after a write, to be rebuilt on next use"""
+        self._index = None
+        self._spatial = None
+
+    @property
+    def index(self):
+        """The in-memory TrigramIndex, built from the ngram store on first use"""
+        self.flush()
+        if self._index is None:
+            self._index = TrigramIndex.from_postings(self.store.postings())
+        return self._index
+
+    def _postings(self, ngrams):
+        """Fetch the (code, count) postings of a set of ngrams from the store in one query"""
+        postings = defaultdict(list)
+        n = 0
+        with metrics.timer('trigram.db.postings'):
+            for ngram, code, count in self.store.postings(ngrams):
+                postings[ngram].append((code, count))
+                n += 1
+        metrics.incr('trigram.db.postings.docs', n)
+        return postings
+
+    def _document_frequencies(self):
+        """The stored number of codes each ngram is found in.  Geocoders loaded before these were kept count them once,
+        from their postings."""
+        if 'ngram_df' in self.store:
+            return Counter(dict(self.store['ngram_df']))
+        return document_frequencies(self.store.postings())
+
+    def _update_stats(self, df):
+        """Count the codes and find the stop ngrams from the document frequencies of their ngrams, and keep them all in
+        the geocoder's metadata"""
+        with metrics.timer('trigram.stats'):
+            codes = self.store.count()
+            stop = stop_ngrams(df, codes, self.stop_fraction)
+        self.stats = { 'codes' : codes, 'stop' : sorted(stop) }
+        self.store['ngram_stats'] = self.stats
+        # as pairs rather than a dict, since ngrams need not be valid Mongo keys.
+        self.store['ngram_df'] = sorted((ngram, n) for ngram, n in df.iteritems() if n > 0)
+        self._stop = None
+        self._df = df
+        log.debug('{n} of the ngrams of {codes} codes are stop ngrams'.format(n=len(stop), codes=codes))
+
+    @property
+    def stop(self):
+        """The set of stop ngrams, found when codes were last added or removed"""
+        if self._stop is None:
+            self._stop = frozenset(self.stats['stop']) if self.stats else frozenset()
+        return self._stop
+
+    @property
+    def df(self):
+        """The number of codes each ngram is found in, read from the store on first use"""
+        if self._df is None:
+            self._df = self._document_frequencies()
+        return self._df
+
+    def _corpus_size(self):
+        if self.stats:
+            return self.stats['codes']
+        if self._size is None:
+            self._size = self.store.count()
+        return self._size
+
+    def _query_ngrams(self, ngrams):
+        """Drop the stop ngrams from a query's ngrams, unless none of the ngrams left is found in any code, as happens
+        when a query is misspelled, and there would be nothing to search for"""
+        kept = [ngram for ngram in ngrams if ngram not in self.stop]
+        if len(kept) < len(ngrams) and any(self.df[ngram] for ngram in kept):
+            return kept
+        return ngrams
+
+    def _rank(self, ngrams, postings=None, limit=None):
+        """Return the best (code, score) pairs for a list of query ngrams, best first, scored by IDF weighted ngram
+        counts.  If postings have already been fetched for a batch of queries, they can be passed in to avoid another
+        trip to the ngram store.
+
+        :param limit: the number of pairs to return.  Defaults to self.candidates
+        """
+        limit = limit or self.candidates
+        ngrams = self._query_ngrams(ngrams)
+        if self.memory_index:
+            with metrics.timer('trigram.rank'):
+                return self.index.ranked(ngrams, limit)
+
+        if postings is None:
+            postings = self._postings(set(ngrams))
+        with metrics.timer('trigram.rank'):
+            return rank(ngrams, postings, self._corpus_size(), limit)
+
+    def _fetch(self, codes, srid=None):
+        """Fetch features for a collection of codes in one query, returning a dict of code to feature"""
+        with metrics.timer('trigram.db.find'):
+            features = list(self.store.features(codes))
+        metrics.incr('trigram.db.docs', len(features))
+        if srid:
+            with metrics.timer('trigram.reproject'):
+                features = reproject_features(features, self.store.srid, srid)
+        return dict((f['_id'], f) for f in features)
+
+    def _rerank(self, code, ranked, limit):
+        """Rescore (code, score) candidates by the edit similarity of their names to a query, dropping those below the
+        threshold, and return the best limit of them"""
+        query = normalize(code)
+        with metrics.timer('trigram.rerank'):
+            scored = []
+            for candidate, score in ranked:
+                score = similarity(query, normalize(candidate), self.threshold)
+                if score is not None:
+                    scored.append((candidate, score))
+            scored.sort(key=itemgetter(1), reverse=True)
+        return scored[:limit]
+
+    def _candidates(self, code, ngrams, postings=None, limit=None):
+        """Return the best (code, score) candidates for a query, best first, reranked if the geocoder reranks"""
+        limit = limit or self.candidates
+        if not self.rerank:
+            return self._rank(ngrams, postings, limit)
+        return self._rerank(code, self._rank(ngrams, postings, max(self.rerank, limit)), limit)
+
+    def _scored(self, feature, score):
+        return dict(feature, properties=dict(feature.get('properties', {}), score=score))
+
+    def _features(self, ranked, srid=None):
+        """Fetch the features for a ranked list of (code, score) pairs in one query, preserving rank order, with their
+        scores in their properties"""
+        codes = [code for code, score in ranked]
+        found = self._fetch(codes, srid)
+        return [self._scored(found[code], score) for code, score in ranked if code in found]
+
     def __getitem__(self, code):
         """
         Returns a feature if an exact match is found or a feature collection if an approximate match is found
@@ -174,74 +740,98 @@ class TrigramGeocoder(object):
         if isinstance(code, tuple):
             code, srid = code
 
-        val = self.code_store.coll.find_one(code)
+        self.flush()
+        with metrics.timer('trigram.db.find'):
+            val = self.store.feature(code)
         if val:
+            metrics.incr('trigram.db.docs')
             if srid:
-                g = GEOSGeometry(json.dumps(val['geometry']), srid=self.code_store.srid)
-                g.transform(srid)
-                val['geometry'] = json.loads(g.json)
+                with metrics.timer('trigram.reproject'):
+                    val = reproject_features([val], self.store.srid, srid)[0]
             return val
         else:
-            val = { 'type' : "FeatureCollection" }
-            features = []
-            ngrams = self.parser(code)
-            scores = {}
-            for ngram in ngrams:
-                counts = self.ngram_store.find({'ngram' : ngram})
-                for count in counts:
-                    if count['code'] not in scores:
-                        scores[ count['code'] ] += count['count']
-
-            for code, ct in sorted(scores.items(), key=lambda x,y: y):
-                features.append(self.code_store.coll.find_one(code))
-            if len(features):
-                val['features'] = features
+            val = self.query(code, srid)
+            if len(val['features']):
                 return val
             else:
                 raise KeyError(code)
 
-    def __delitem__(self, code):
+    def query(self, code, srid=None, limit=None):
+        """Return a feature collection of the best approximate matches for a code, best first.
+
+        :param limit: the most matches to return.  Defaults to self.candidates
+        :return: a feature collection of matches, each with its score in its properties.
+        """
+        self.flush()
         ngrams = self.parser(code)
-        if self.code_store.coll.find_one(code):
-            self.code_store.coll.remove(code)
-            for ngram in ngrams:
-                doc = self.ngram_store.find_one(ngram)
-                doc['count'] -= 1
-                self.ngram_store.save(doc)
+        return {
+            'type' : "FeatureCollection",
+            'features' : self._features(self._candidates(code, ngrams, limit=limit), srid) if ngrams else []
+        }
 
+    def _buffer(self, code, feature):
+        """Buffer a change to a code: a feature to write, or None to delete it"""
+        with self._lock:
+            if not self._pending:
+                self._pending_since = time.time()
+            self._pending[code] = feature
+            if len(self._pending) >= self.flush_size or time.time() - self._pending_since >= self.flush_interval:
+                self.flush()
 
-    def __setitem__(self, code, geom, geom_serializer=None):
-        del self[code]
+    def flush(self):
+        """Write buffered changes to the store.  The features of the changed codes are deleted and written in one batch
+        each, and their postings are changed by one batch of count increments, computed from which codes were stored
+        before and which are after.  If any code was added or removed, the document frequencies of its ngrams and the
+        stats are updated to match."""
+        with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
 
-        fc = { "type" : "GeometryCollection" }
-        features = []
+            with metrics.timer('trigram.flush'):
+                existing = self.store.existing(pending)
+                deltas = Counter()
+                df = None
+                for code, feature in pending.items():
+                    change = (feature is not None) - (code in existing)
+                    if change:
+                        ngrams = self.parser(code) or ()
+                        for ngram in ngrams:
+                            deltas[ngram, code] += change
+                        if df is None:
+                            df = self.df
+                        for ngram in set(ngrams):
+                            df[ngram] += change
 
-        index = {}
-        ngrams = self.parser(code)
-        for ngram in ngrams:
-            if not ngram in index:
-                index[ngram] = Counter()
-            index[ngram][code] += 1
+                features = [feature for feature in pending.values() if feature is not None]
+                if existing:
+                    self.store.remove_many(existing)
+                if features:
+                    self.store.insert(features)
+                self.store.increment_postings([(ngram, code, delta) for (ngram, code), delta in deltas.items()])
+                if df is not None:
+                    self._update_stats(df)
+            metrics.incr('trigram.flush.codes', len(pending))
+            self._invalidate()
+
+    def __delitem__(self, code):
+        self._buffer(code, None)
 
+    def __setitem__(self, code, geom, geom_serializer=None):
         if geom_serializer:
             geom = json.loads(geom_serializer(geom))
         else:
             geom = json.loads(self.serialize(geom))
 
-        orig = code
-        features.append({
+        self._buffer(code, {
             '_id' : code,
             'geometry' : geom,
-            'properties' : { 'name' : orig }
+            'properties' : { 'name' : code }
         })
-        self.code_store.insert_features(fc)
-        for ngram, counter in index.items():
-            self.ngram_store.insert([{ "ngram" : ngram, "code" : code, "count" : count } for code, count in counter.items() ])
-        self.ngram_store.ensure_index('ngram')
 
     def bulk_load(self, code_to_geom, geom_serializer=None):
+        self.flush()
         index = {}
-        fc = { 'type' : 'GeometryCollection' }
         features = []
 
         for code, geom in code_to_geom.items():
@@ -265,68 +855,194 @@ class TrigramGeocoder(object):
 
         log.debug('bulk_load got {n} features'.format(n=len(features)))
 
-        fc['features'] = features
-        self.code_store.insert_features(fc)
-        for ngram, counter in index.items():
-            self.ngram_store.insert([{ "ngram" : ngram, "code" : code, "count" : count } for code, count in counter.items() ])
-        self.code_store.create_index('ngram')
+        # add the codes that are new to the store to the document frequencies of their ngrams, rather than recounting
+        # every posting.  Codes being reloaded are counted already.
+        new = set(code_to_geom)
+        for codes in _chunk(code_to_geom):
+            new.difference_update(self.store.existing(codes))
+        df = self.df
+        for ngram, counter in index.iteritems():
+            df[ngram] += sum(1 for code in counter if code in new)
+
+        self.store.insert(features)
+        self._spatial = None
+        if self.memory_index:
+            if len(new) < len(code_to_geom):
+                # reloaded codes already have postings in the in-memory index, so it is rebuilt from the store on next use.
+                self._index = None
+            else:
+                # extend the in-memory index directly rather than re-reading the postings we are about to write.
+                self.index.update(index)
+        self.store.add_postings([(ngram, code, count) for ngram, counter in index.items() for code, count in counter.items()])
+        self._update_stats(df)
 
     def bulk_geocode(self, codes, srid=None):
-        return (self[code] for code in codes)
+        """Geocode an iterable of codes a chunk at a time, yielding (code, result) pairs in input order.  A result is a
+        feature for an exact match or a feature collection of candidates for an approximate match.  Codes with no match
+        at all are skipped.
 
-    def reverse_geocode(self, geometry):
-        val = self.code_store.find_features(geo_query={'bboverlaps' : geometry})
-        try:
-            return val.next()
-        except StopIteration:
-            return None
+        Each chunk costs one query for the exact matches, one for the postings of all the misses' ngrams (none if the
+        in-memory index is used), and one for all the winning candidates."""
+        self.flush()
+        for chunk in _chunk(codes):
+            exact = self._fetch(set(chunk), srid)
+
+            queries = {}
+            for code in set(chunk):
+                if code not in exact:
+                    ngrams = self.parser(code)
+                    if ngrams:
+                        queries[code] = self._query_ngrams(ngrams)
+
+            postings = None
+            if queries and not self.memory_index:
+                postings = self._postings(set(ngram for ngrams in queries.values() for ngram in ngrams))
+            rankings = dict((code, self._candidates(code, ngrams, postings)) for code, ngrams in queries.items())
+            candidates = self._fetch(set(c for ranked in rankings.values() for c, score in ranked), srid) if rankings else {}
+
+            for code in chunk:
+                if code in exact:
+                    yield code, exact[code]
+                elif code in rankings:
+                    features = [self._scored(candidates[c], score) for c, score in rankings[code] if c in candidates]
+                    if features:
+                        yield code, { 'type' : "FeatureCollection", 'features' : features }
 
     def drop(self):
-        self.code_store.drop()
-        self.ngram_store.drop()
+        with self._lock:
+            self._pending = {}
+        self.store.drop()
+        self._invalidate()
+        self.stats = self._stop = self._df = self._size = None
+
+
+def _json(response):
+    """The decoded body of a requests response; requests 1.0 turned Response.json from a property into a method"""
+    return response.json() if callable(response.json) else response.json
+
+class _NominatimEndpoint(object):
+    """A Nominatim server with a persistent, pooled HTTP session, a request rate limit and retry with backoff"""
+
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, url, max_in_flight, rate=None, retries=3, backoff=0.5):
+        self.url = url
+        self.max_in_flight = max_in_flight
+        self.interval = 1.0 / rate if rate else 0
+        self.retries = retries
+        self.backoff = backoff
 
+        import requests
+        self.session = requests.Session()
+        try:
+            from requests.adapters import HTTPAdapter
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+        except ImportError:
+            pass
+
+        self._lock = threading.Lock()
+        self._next_slot = 0
+
+    def _throttle(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+    def get(self, path, params):
+        """GET a path on the server, retrying connection errors and overload responses with exponential backoff"""
+        from requests import ConnectionError, Timeout
+        for attempt in range(self.retries + 1):
+            self._throttle()
+            try:
+                with metrics.timer('osm.http'):
+                    r = self.session.get(self.url + path, params=params)
+            except (ConnectionError, Timeout):
+                metrics.incr('osm.http.error')
+                if attempt == self.retries:
+                    raise
+            else:
+                metrics.incr('osm.http.{status}'.format(status=r.status_code))
+                if r.status_code not in self.RETRY_STATUS or attempt == self.retries:
+                    return r
+            metrics.incr('osm.http.retry')
+            time.sleep(self.backoff * 2 ** attempt)
 
 class OpenStreetMapGeocoder(object):
     HOUSE=0
     COUNTRY=18
 
-    def __init__(self):
+    def __init__(self, urls=None, max_in_flight=app_settings.NOMINATIM_MAX_IN_FLIGHT, rate=app_settings.NOMINATIM_RATE, retries=app_settings.NOMINATIM_RETRIES, cache=None, precision=app_settings.NOMINATIM_REVERSE_PRECISION):
+        """
+        :param urls: the Nominatim servers to spread requests across.  Defaults to app_settings.NOMINATIM_URLS
+        :param max_in_flight: the most concurrent requests to each server during concurrent bulk geocoding.
+        :param rate: the most requests per second to each server, or None for no limit.
+        :param retries: the number of times to retry a failed request.
+        :param cache: a cache of Nominatim responses, such as a ga_geocoder.cache.SQLiteCache, or None.
+        :param precision: the number of decimal places reverse geocoding coordinates are rounded to in cache keys.
+        """
         self.index = 0
+        self.endpoints = [_NominatimEndpoint(url, max_in_flight, rate, retries) for url in (urls or app_settings.NOMINATIM_URLS)]
+        self.cache = cache
+        self.precision = precision
+
+    def _get_endpoint(self):
+        self.index = (self.index+1) if (self.index+1) < len(self.endpoints) else 0
+        return self.endpoints[self.index]
+
+    def _request(self, path, params, key, endpoint=None):
+        """Return the decoded response to a Nominatim request, from the cache under key if possible"""
+        if self.cache is not None:
+            response = self.cache.get(key)
+            if response is not None:
+                metrics.incr('osm.cache.hit')
+                return response
+            metrics.incr('osm.cache.miss')
+
+        r = (endpoint or self._get_endpoint()).get(path, params=params)
+        if r.status_code == 200:
+            with metrics.timer('osm.decode'):
+                response = _json(r)
+            if self.cache is not None:
+                self.cache[key] = response
+            return response
+        else:
+            raise IOError(str((key, r.status_code, r.text)))
+
+    def _search(self, name, srid=None, endpoint=None):
+        key = 'search:' + ' '.join(name.lower().split())
+        locations = self._request("/search", {'q' : name, 'format' : 'json'}, key, endpoint)
+        if len(locations) == 0:
+            raise KeyError(name)
+        else:
+            # convert the response to GeoJSON, transforming all the locations' coordinates at once if need be.
+            coordinates = [[float(location['lon']), float(location['lat'])] for location in locations]
+            if srid and srid != 4326:
+                coordinates = reproject_points(coordinates, 4326, srid)[:, :2].tolist()
+
+            locations = [{
+                'type' : 'Feature',
+                "_id" : location['place_id'],
+                'geometry' : { "type" : "Point", "coordinates" : xy },
+                'properties' : dict(name=location['display_name'], **location),
+            } for location, xy in zip(locations, coordinates)]
+            location = locations[0]
+            location['properties']['alternates'] = locations[1:]
 
-    def _get_url(self):
-        self.index = (self.index+1) if (self.index+1) < len(app_settings.NOMINATIM_URLS) else 0
-        return app_settings.NOMINATIM_URLS[self.index]
+            return location
 
     def __getitem__(self, name):
         srid=None
-        transform = lambda x,y:[float(x),float(y)]
         if isinstance(name, tuple):
             name, srid = name
-            def transform(x, y):
-                a = Point(float(x), float(y), srid=4326)
-                a.transform(srid)
-                return [a.x, a.y]
-
-        r = requests.get(self._get_url() + "/search", params={'q' : name, 'format' : 'json'})
-        if r.status_code == requests.codes.ok:
-            locations = r.json
-            if len(locations) == 0:
-                raise KeyError(name)
-            else:
-                # convert the response to GeoJSON
-                locations = [{
-                    'type' : 'Feature',
-                    "_id" : location['place_id'],
-                    'geometry' : { "type" : "Point", "coordinates" : transform(location['lon'], location['lat']) },
-                    'properties' : dict(name=location['display_name'], **location),
-                } for location in locations]
-                location = locations[0]
-                location['properties']['alternates'] = locations[1:]
-
-                return location
-        else:
-            raise IOError(str((name, r.status_code, r.text)))
 
+        return self._search(name, srid)
 
     def bulk_geocode(self, names, srid=None):
         if srid:
@@ -344,29 +1060,112 @@ class OpenStreetMapGeocoder(object):
                 except KeyError:
                     pass
 
+    def bulk_geocode_concurrent(self, names, srid=None):
+        """Geocode an iterable of names with up to max_in_flight concurrent requests to each server, yielding
+        (index, name, location) triples as responses arrive, where index is the position of name in the input and
+        location is None if nothing was found.  Names are read from the input only as fast as they can be sent.  If a
+        request still fails after retrying, the IOError is raised here and no further requests are made."""
+        workers = []
+        inbox = Queue.Queue(maxsize=2 * sum(e.max_in_flight for e in self.endpoints))
+        outbox = Queue.Queue()
+        stopped = threading.Event()
+
+        def feed():
+            try:
+                for item in enumerate(names):
+                    while not stopped.is_set():
+                        try:
+                            inbox.put(item, timeout=0.1)
+                            break
+                        except Queue.Full:
+                            pass
+                    if stopped.is_set():
+                        break
+            except Exception as e:
+                outbox.put((None, None, e))
+            finally:
+                for _ in workers:
+                    inbox.put(None)
+
+        def work(endpoint):
+            for item in iter(inbox.get, None):
+                if stopped.is_set():
+                    continue
+                index, name = item
+                try:
+                    outbox.put((index, name, self._search(name, srid, endpoint)))
+                except KeyError:
+                    outbox.put((index, name, None))
+                except Exception as e:
+                    outbox.put((index, name, e))
+            outbox.put(StopIteration)
+
+        for endpoint in self.endpoints:
+            for _ in range(endpoint.max_in_flight):
+                workers.append(threading.Thread(target=work, args=(endpoint,)))
+        for thread in workers + [threading.Thread(target=feed)]:
+            thread.daemon = True
+            thread.start()
 
+        try:
+            running = len(workers)
+            while running:
+                result = outbox.get()
+                if result is StopIteration:
+                    running -= 1
+                elif isinstance(result[2], Exception):
+                    raise result[2]
+                else:
+                    yield result
+        finally:
+            stopped.set()
 
     def reverse_geocode(self, geometry, lod=HOUSE):
         if geometry.srid is not None and geometry.srid != 4326:
             geometry.transform(4326)
 
-        r = requests.get(self._get_url() + "/reverse", params={ "format" : "json", "zoom" : lod, "lon" : geometry.x, "lat" : geometry.y, "addressdetails" : 1 })
-        if r.status_code == requests.codes.ok:
-            location = r.json
-            if 'polygonpoints' in location:
-                geom = Polygon(tuple(
-                    [(float(x),float(y)) for x, y in location['polygonpoints']]
-                ), srid=4326)
-            else:
-                geom = Point(float(location['lon']), float(location['lat']), srid=4326)
+        key = 'reverse:{x:.{p}f},{y:.{p}f}:{lod}'.format(x=geometry.x, y=geometry.y, p=self.precision, lod=lod)
+        location = self._request("/reverse", { "format" : "json", "zoom" : lod, "lon" : geometry.x, "lat" : geometry.y, "addressdetails" : 1 }, key)
+        from django.contrib.gis.geos.geometry import Point, Polygon
+        if 'polygonpoints' in location:
+            geom = Polygon(tuple(
+                [(float(x),float(y)) for x, y in location['polygonpoints']]
+            ), srid=4326)
+        else:
+            geom = Point(float(location['lon']), float(location['lat']), srid=4326)
 
-            if geometry.srid is not None and geometry.srid != 4326:
-                geom.transform(geometry.srid)
+        if geometry.srid is not None and geometry.srid != 4326:
+            geom.transform(geometry.srid)
 
-            return {
-                'type' : "Feature",
-                'geometry' : geom.json,
-                'properties' : dict(_id=location['place_id'], **location)
-            }
+        return {
+            'type' : "Feature",
+            'geometry' : geom.json,
+            'properties' : dict(_id=location['place_id'], **location)
+        }
+
+#: The geocoder classes, by kind.
+GEOCODERS = {
+    'exact' : ExactGeocoder,
+    'trigram' : TrigramGeocoder,
+    'snapshot' : SnapshotGeocoder,
+    'osm' : OpenStreetMapGeocoder,
+}
+
+def bulk_results(coder, inputs, srid=None, chunk_size=1000):
+    """Geocode an iterable of inputs with any geocoder's bulk path, yielding an (input, result) pair for each input in
+    input order, where result is None if nothing was found.  Inputs are read only chunk_size ahead of the results, or as
+    far ahead as an exact geocoder prefetches."""
+    if isinstance(coder, (ExactGeocoder, SnapshotGeocoder)):
+        for item in coder.bulk_geocode(inputs, srid=srid, ordered=True):
+            yield item
+        return
+
+    for chunk in _chunk(inputs, chunk_size):
+        if isinstance(coder, OpenStreetMapGeocoder):
+            found = dict((index, location) for index, name, location in coder.bulk_geocode_concurrent(chunk, srid))
+            for index, name in enumerate(chunk):
+                yield name, found.get(index)
         else:
-            raise IOError(str(((geometry.x, geometry.y, geometry.srid), r.status_code, r.text)))
+            found = dict(coder.bulk_geocode(chunk, srid))
+            for code in chunk:
+                yield code, found.get(code)
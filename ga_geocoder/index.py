@@ -0,0 +1,231 @@
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from itertools import izip
+from operator import itemgetter
+import heapq
+import math
+import re
+
+from logging import getLogger
+
+log = getLogger(__name__)
+
+_NON_WORD = re.compile(r'[^0-9a-z]+')
+
+def idf(codes, df):
+    """The inverse document frequency weight of an ngram found in df of a corpus of codes"""
+    return math.log(1.0 + float(codes) / df)
+
+def document_frequencies(postings):
+    """Count the codes each ngram is found in, from (ngram, code, count) postings"""
+    return Counter(ngram for ngram, code, count in postings)
+
+def stop_ngrams(df, codes, fraction):
+    """Return the set of ngrams found in more than fraction of a corpus of codes, from a dict of the number of codes
+    each ngram is found in"""
+    return set(ngram for ngram, n in df.iteritems() if n > fraction * codes)
+
+def top_k(terms, k):
+    """MaxScore top-k retrieval, term at a time.  A code's score is the sum of weight * count over the query terms in
+    its postings.  Terms are visited in order of the most they can add to a score.  Once the terms left could not lift
+    an unseen code into the top k, their postings are no longer scanned; only the codes already scored are looked up,
+    and codes that can no longer reach the top k are dropped.
+
+    :param terms: a list of (weight, max_count, items, count) tuples, where items() iterates over the (code, count)
+        postings of the term, max_count is the largest count among them, and count(code) looks one up, or returns 0.
+    :param k: the number of codes to return.
+    :return: a list of at most k (code, score) pairs, best first.
+    """
+    terms = sorted(terms, key=lambda t: t[0] * t[1], reverse=True)
+    left = [0.0] * (len(terms) + 1)
+    for i in reversed(xrange(len(terms))):
+        left[i] = left[i+1] + terms[i][0] * terms[i][1]
+
+    scores = defaultdict(float)
+    threshold = 0.0
+    for i, (weight, max_count, items, count) in enumerate(terms):
+        if len(scores) < k or left[i] > threshold:
+            for code, c in items():
+                scores[code] += weight * c
+        else:
+            for code in scores.keys():
+                c = count(code)
+                if c:
+                    scores[code] += weight * c
+
+        if len(scores) >= k:
+            threshold = heapq.nlargest(k, scores.itervalues())[-1]
+            if len(scores) > k:
+                rest = left[i+1]
+                scores = defaultdict(float, ((code, score) for code, score in scores.iteritems() if score + rest >= threshold))
+
+    return heapq.nlargest(k, scores.iteritems(), key=itemgetter(1))
+
+def rank(ngrams, postings, codes, k):
+    """IDF weighted top-k retrieval over postings fetched from a store.
+
+    :param ngrams: the ngrams of the query.  Repeated ngrams are weighted by their repetitions.
+    :param postings: a dict of ngram -> [(code, count)], holding every posting of the query's ngrams.
+    :param codes: the number of codes in the corpus.
+    :return: a list of at most k (code, score) pairs, best first.
+    """
+    terms = []
+    for ngram, weight in Counter(ngrams).iteritems():
+        found = postings.get(ngram)
+        if found:
+            counts = dict(found)
+            terms.append((weight * idf(codes, len(found)), max(counts.itervalues()), counts.iteritems, lambda code, counts=counts: counts.get(code, 0)))
+    return top_k(terms, k)
+
+def normalize(name):
+    """Lower case a name, and reduce its punctuation and runs of spaces to single spaces"""
+    return _NON_WORD.sub(' ', name.lower()).strip()
+
+def edit_distance(a, b, k):
+    """Return the Levenshtein distance between two strings if it is at most k, or None.  Only the diagonal band of the
+    table within k of the main diagonal is computed, and the computation stops once every cell of a row exceeds k."""
+    if abs(len(a) - len(b)) > k:
+        return None
+    if len(a) > len(b):
+        a, b = b, a
+
+    n, m = len(a), len(b)
+    over = k + 1
+    previous = [j if j <= k else over for j in xrange(m + 1)]
+    for i in xrange(1, n + 1):
+        lo, hi = max(1, i - k), min(m, i + k)
+        current = [over] * (m + 1)
+        current[0] = i if i <= k else over
+        c = a[i-1]
+        for j in xrange(lo, hi + 1):
+            current[j] = min(over, previous[j-1] + (c != b[j-1]), previous[j] + 1, current[j-1] + 1)
+        if min(current[lo-1:hi+1]) > k:
+            return None
+        previous = current
+    return previous[m] if previous[m] <= k else None
+
+def similarity(a, b, threshold=0.0):
+    """The edit similarity of two strings, 1 - edit distance / the longer length, or None if it is below threshold.
+    The threshold bounds the edit distance, and so the cost of computing it."""
+    longest = max(len(a), len(b))
+    if not longest:
+        return 1.0
+    # the most edits that still score at least threshold, allowing for rounding so a score of exactly threshold passes.
+    d = edit_distance(a, b, longest - int(math.ceil(threshold * longest - 1e-9)))
+    return None if d is None else 1.0 - float(d) / longest
+
+class TrigramIndex(object):
+    """A compact in-process inverted index of ngram postings.  Ngrams and codes are interned into ints and each
+    ngram's postings are kept as a pair of parallel arrays of code ids and counts, so that a fuzzy lookup never
+    has to touch the database until the winning codes are known."""
+
+    def __init__(self):
+        self.ngram_ids = {}
+        self.code_ids = {}
+        self.codes = []
+        self.postings = []
+        self.counts = []
+        # the ids of ngrams whose postings have been added to since they were last sorted by code id, and the largest
+        # count in each ngram's postings as of that sort.
+        self._unsorted = set()
+        self._max_counts = {}
+
+    def __len__(self):
+        return len(self.codes)
+
+    def _ngram_id(self, ngram):
+        n = self.ngram_ids.get(ngram)
+        if n is None:
+            n = self.ngram_ids[ngram] = len(self.postings)
+            self.postings.append(array('l'))
+            self.counts.append(array('l'))
+        return n
+
+    def _code_id(self, code):
+        c = self.code_ids.get(code)
+        if c is None:
+            c = self.code_ids[code] = len(self.codes)
+            self.codes.append(code)
+        return c
+
+    def add(self, ngram, code, count=1):
+        """Add a single posting of code to the postings list of ngram"""
+        n = self._ngram_id(ngram)
+        self.postings[n].append(self._code_id(code))
+        self.counts[n].append(count)
+        self._unsorted.add(n)
+
+    def update(self, index):
+        """Add postings from a dict of ngram -> {code : count}, the structure built by TrigramGeocoder.bulk_load"""
+        for ngram, counter in index.items():
+            for code, count in counter.items():
+                self.add(ngram, code, count)
+
+    def search(self, ngrams, k=None):
+        """Score every code sharing an ngram with the query by the sum of its ngram counts.
+
+        :param ngrams: the ngrams of the query, as returned by a parser.  Repeated ngrams are counted repeatedly.
+        :param k: the number of best codes to return, or None for all of them.
+        :return: a list of (code, score) pairs, best first.
+        """
+        scores = defaultdict(int)
+        for ngram, weight in Counter(ngrams).items():
+            n = self.ngram_ids.get(ngram)
+            if n is None:
+                continue
+            for c, count in izip(self.postings[n], self.counts[n]):
+                scores[c] += count * weight
+
+        if k:
+            best = heapq.nlargest(k, scores.iteritems(), key=itemgetter(1))
+        else:
+            best = sorted(scores.iteritems(), key=itemgetter(1), reverse=True)
+        return [(self.codes[c], score) for c, score in best]
+
+    def _sort(self, n):
+        """Sort an ngram's postings by code id, so that single codes can be looked up in them by binary search"""
+        if n in self._unsorted:
+            pairs = sorted(izip(self.postings[n], self.counts[n]))
+            self.postings[n] = array('l', (c for c, count in pairs))
+            self.counts[n] = array('l', (count for c, count in pairs))
+            self._max_counts[n] = max(self.counts[n]) if pairs else 0
+            self._unsorted.discard(n)
+
+    def ranked(self, ngrams, k):
+        """IDF weighted top-k retrieval with MaxScore early termination.  See top_k.
+
+        :param ngrams: the ngrams of the query.  Repeated ngrams are weighted by their repetitions.
+        :return: a list of at most k (code, score) pairs, best first.
+        """
+        terms = []
+        for ngram, weight in Counter(ngrams).iteritems():
+            n = self.ngram_ids.get(ngram)
+            if n is None:
+                continue
+            self._sort(n)
+            postings, counts = self.postings[n], self.counts[n]
+
+            def count(c, postings=postings, counts=counts):
+                i = bisect_left(postings, c)
+                return counts[i] if i < len(postings) and postings[i] == c else 0
+
+            terms.append((weight * idf(len(self.codes), len(postings)), self._max_counts[n],
+                lambda postings=postings, counts=counts: izip(postings, counts), count))
+
+        return [(self.codes[c], score) for c, score in top_k(terms, k)]
+
+    @classmethod
+    def from_collection(cls, coll):
+        """Build an index from a Mongo collection of {ngram, code, count} documents"""
+        return cls.from_postings((doc['ngram'], doc['code'], doc['count']) for doc in coll.find({}, ['ngram', 'code', 'count']))
+
+    @classmethod
+    def from_postings(cls, postings):
+        """Build an index from (ngram, code, count) postings, such as those of a TrigramGeocoder's backend"""
+        index = cls()
+        for ngram, code, count in postings:
+            index.add(ngram, code, count)
+
+        log.debug('loaded {n} codes and {m} ngrams into memory'.format(n=len(index.codes), m=len(index.postings)))
+        return index
@@ -0,0 +1,137 @@
+from collections import defaultdict
+from importlib import import_module
+from threading import Lock
+import socket
+import time
+
+from logging import getLogger, DEBUG
+
+from ga_geocoder import app_settings
+
+log = getLogger(__name__)
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+class _Timer(object):
+    __slots__ = ('sink', 'name', 'started')
+
+    def __init__(self, sink, name):
+        self.sink = sink
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.sink.timing(self.name, time.time() - self.started)
+        return False
+
+class Metrics(object):
+    """Per-phase timers and counters, sent to a sink.  While the sink is None, timer() hands back a shared no-op context
+    manager and incr() returns immediately, so instrumented code pays only for the call."""
+
+    def __init__(self, sink=None):
+        self.sink = sink
+
+    def timer(self, name):
+        """A context manager that records the time spent inside it as a timing called name"""
+        if self.sink is None:
+            return _NULL_TIMER
+        return _Timer(self.sink, name)
+
+    def incr(self, name, n=1):
+        if self.sink is not None:
+            self.sink.incr(name, n)
+
+    def timing(self, name, seconds):
+        if self.sink is not None:
+            self.sink.timing(name, seconds)
+
+class MemorySink(object):
+    """Collects counters and timings in memory, for tests and for inspecting a job from a shell"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.counters = defaultdict(int)
+        self.timings = defaultdict(list)
+
+    def incr(self, name, n):
+        with self._lock:
+            self.counters[name] += n
+
+    def timing(self, name, seconds):
+        with self._lock:
+            self.timings[name].append(seconds)
+
+    def summary(self):
+        """Return a dict of counter values and, for each timing, its count, total, mean and max in seconds"""
+        with self._lock:
+            result = dict(self.counters)
+            for name, samples in self.timings.items():
+                result[name] = {
+                    'count' : len(samples),
+                    'total' : sum(samples),
+                    'mean' : sum(samples) / len(samples),
+                    'max' : max(samples),
+                }
+            return result
+
+    def clear(self):
+        with self._lock:
+            self.counters.clear()
+            self.timings.clear()
+
+class LoggingSink(object):
+    """Writes every counter increment and timing to a logger"""
+
+    def __init__(self, logger=log, level=DEBUG):
+        self.logger = logger
+        self.level = level
+
+    def incr(self, name, n):
+        self.logger.log(self.level, '{name} +{n}'.format(name=name, n=n))
+
+    def timing(self, name, seconds):
+        self.logger.log(self.level, '{name} {ms:.3f}ms'.format(name=name, ms=seconds * 1000))
+
+class StatsdSink(object):
+    """Sends counters and timings to a StatsD server over UDP.  Send errors are dropped, as StatsD clients do."""
+
+    def __init__(self, host='localhost', port=8125, prefix='ga_geocoder'):
+        self.address = (host, port)
+        self.prefix = prefix + '.' if prefix else ''
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, line):
+        try:
+            self.socket.sendto(line, self.address)
+        except socket.error:
+            pass
+
+    def incr(self, name, n):
+        self._send('{prefix}{name}:{n}|c'.format(prefix=self.prefix, name=name, n=n))
+
+    def timing(self, name, seconds):
+        self._send('{prefix}{name}:{ms:.3f}|ms'.format(prefix=self.prefix, name=name, ms=seconds * 1000))
+
+def _sink_from_settings(setting):
+    if not setting:
+        return None
+    path, kwargs = setting if isinstance(setting, (list, tuple)) else (setting, {})
+    module, name = path.rsplit('.', 1)
+    return getattr(import_module(module), name)(**kwargs)
+
+#: The metrics used throughout ga_geocoder.  Configured from app_settings.METRICS_SINK, and changed with configure()
+metrics = Metrics(_sink_from_settings(app_settings.METRICS_SINK))
+
+def configure(sink):
+    """Send ga_geocoder's metrics to sink, or turn them off if sink is None"""
+    metrics.sink = sink
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, make_option
+from ga_geocoder import benchmarks
+import json
+import sys
+
+class Command(BaseCommand):
+    args = "[benchmark ...]"
+    help = "Benchmarks the geocoders against synthetic data, an in-process Mongo stand-in (mongomock) and a stub Nominatim server, writing JSON results. Benchmarks are: " + ", ".join(sorted(benchmarks.BENCHMARKS))
+
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes', action='store', dest='sizes', default='1000,10000', help='Comma separated corpus sizes to run each benchmark at'),
+        make_option('--queries', action='store', dest='queries', default=1000, help='Number of queries timed per benchmark'),
+        make_option('--output', action='store', dest='output', default=None, help='File to write results to.  Defaults to stdout'),
+    )
+
+    def handle(self, *args, **options):
+        unknown = set(args) - set(benchmarks.BENCHMARKS)
+        if unknown:
+            raise ValueError("Unknown benchmarks: " + ", ".join(sorted(unknown)))
+
+        results = benchmarks.run(
+            sizes=[int(size) for size in options['sizes'].split(',')],
+            queries=int(options['queries']),
+            benchmarks=args or None
+        )
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+        else:
+            json.dump(results, sys.stdout, indent=2)
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, make_option
+from ga_geocoder import registry, utils
+
+def _format(filename, option):
+    """The format given by an option, or else guessed from a filename's extension"""
+    if option:
+        return option
+    return utils.CSV if filename.lower().endswith('.csv') else None
+
+class Command(BaseCommand):
+    args = "<name input output>"
+    help = "Geocodes every row of a CSV file, or every line of a text file, writing a GeoJSON text sequence or CSV with WKT geometries"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--column', action='store', dest='column', default=None, help='The CSV column to geocode'),
+        make_option('--input-format', action='store', dest='input_format', default=None, help='csv or lines.  Defaults to csv for .csv files'),
+        make_option('--output-format', action='store', dest='output_format', default=None, help='geojsonseq or csv.  Defaults to csv for .csv files'),
+        make_option('--srid', action='store', dest='srid', default=None, help='The srid to write geometries in'),
+        make_option('--rejects', action='store', dest='rejects', default=None, help='File to write rows with no match to'),
+    )
+
+    def handle(self, *args, **options):
+        name, input_filename, output_filename = args
+        input_format = _format(input_filename, options['input_format']) or utils.LINES
+        if input_format == utils.CSV and not options['column']:
+            raise ValueError("--column is required for CSV input")
+
+        coder = registry.open_geocoder(name)
+
+        def progress(rows, matched, seconds):
+            if int(options.get('verbosity', 1)) > 0:
+                self.stdout.write("{rows} rows geocoded, {matched} matched ({rate:.0f} rows/sec)\n".format(
+                    rows=rows, matched=matched, rate=rows / max(seconds, 1e-6)))
+
+        utils.geocode_file(
+            coder,
+            input_filename,
+            output_filename,
+            column=options['column'],
+            input_format=input_format,
+            output_format=_format(output_filename, options['output_format']) or utils.GEOJSONSEQ,
+            srid=int(options['srid']) if options['srid'] else None,
+            rejects_filename=options['rejects'],
+            progress=progress
+        )
@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand, make_option
 from ga_geocoder import utils
+import time
 
 class Command(BaseCommand):
     args = "<name method ogr_dataset layer field ...>"
@@ -10,15 +11,32 @@ class Command(BaseCommand):
         make_option('--long-codes', action='store_true',  dest='long_codes', default=False, help=''),
         make_option('--overwrite', action='store_true',  dest='append', default=False, help=''),
         make_option('--srid', action='store',  dest='srid', default=4326, help=''),
+        make_option('--batch-size', action='store',  dest='batch_size', default=1000, help='Number of features written to the geocoder at a time'),
+        make_option('--workers', action='store',  dest='workers', default=1, help='Number of processes reading the dataset in parallel'),
+        make_option('--tolerances', action='store',  dest='tolerances', default=None, help='Comma separated simplification tolerances to store levels of detail at'),
     )
 
     def handle(self, *args, **options):
-        options['name']=args[0]
-        options['method']=args[1]
-        options['ogr_filename']=args[2]
-        options['layer']=args[4]
-        options['field']=args[3]
-        options['srid']=int(options['srid'])
+        started = time.time()
 
-        utils.geocoder_from_ogr(**options)
+        def progress(features, batches):
+            if int(options.get('verbosity', 1)) > 0:
+                elapsed = max(time.time() - started, 1e-6)
+                self.stdout.write("{features} features in {batches} batches committed ({rate:.0f} features/sec)\n".format(
+                    features=features, batches=batches, rate=features / elapsed))
 
+        utils.geocoder_from_ogr(
+            name=args[0],
+            method=int(args[1]),
+            ogr_filename=args[2],
+            layer=args[4],
+            field=args[3],
+            srid=int(options['srid']),
+            append=options['append'],
+            case_sensitive=options['case_sensitive'],
+            long_codes=options['long_codes'],
+            batch_size=int(options['batch_size']),
+            progress=progress,
+            workers=int(options['workers']),
+            tolerances=[float(t) for t in options['tolerances'].split(',')] if options['tolerances'] else None
+        )
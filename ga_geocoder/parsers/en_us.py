@@ -2,17 +2,22 @@ __author__ = 'jeffersonheard'
 
 from ga_geocoder.parsers.independent import *
 
-address_trigrams_naive = tokens(compose_rhs(
+#: The number of distinct addresses whose parses are remembered by each parser
+MEMO_SIZE = 10000
+
+address_trigrams_naive = tokens(compile_pipeline(
     strip_punctuation,
     lower_case,
     split_numbers,
     squeeze_spaces,
-    trigrams
+    trigrams,
+    memo=MEMO_SIZE
 ))
 
-address_trigrams = tokens(compose_rhs(
+address_trigrams = tokens(compile_pipeline(
     strip_punctuation,
     lower_case,
     split_numbers,
-    compose_lhs(split_spaces, trigrams)
+    compose_lhs(split_spaces, trigrams),
+    memo=MEMO_SIZE
 ))
\ No newline at end of file
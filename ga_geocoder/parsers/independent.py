@@ -2,6 +2,12 @@ __author__ = 'jeffersonheard'
 
 import re
 from hashlib import md5
+from ga_geocoder.instrumentation import metrics
+
+_PUNCTUATION = re.compile(r'(?:[^A-z0-9]|\s+)')
+_NUMBERS = re.compile('[0-9]+')
+_SPACES = re.compile(r'\s+')
+_NUMBERS_AND_WORDS = re.compile(r'([0-9]+)|[^\s0-9]+')
 
 def compose_rhs(*functions):
     """return a function which applies input functions from left to right to an input string.  All functions should return
@@ -15,6 +21,8 @@ def compose_rhs(*functions):
             result.extend(tokens)
         return result, remainder
 
+    newfunc.composition = 'rhs'
+    newfunc.stages = functions
     return newfunc
 
 def compose_lhs(*functions):
@@ -25,9 +33,14 @@ def compose_lhs(*functions):
     def newfunc(input_string):
         tokens, input_string = functions[0](input_string)
         for func in functions[1:]:
-            tokens = reduce(list.__add__, (toks for toks, remainder in map(func, tokens)), [])
+            result = []
+            for token in tokens:
+                result.extend(func(token)[0])
+            tokens = result
         return tokens, input_string
 
+    newfunc.composition = 'lhs'
+    newfunc.stages = functions
     return newfunc
 
 def lower_case(input_string):
@@ -36,21 +49,21 @@ def lower_case(input_string):
 
 def strip_punctuation(input_string):
     """composable function that strips all non alphanumeric/whitespace characters from the input_string"""
-    return [], re.sub(r'(?:[^A-z0-9]|\s+)', ' ', input_string)
+    return [], _PUNCTUATION.sub(' ', input_string)
 
 def split_numbers(input_string):
     """Split out contiguous numbers"""
-    toks = re.findall('[0-9]+', input_string)
-    input_string = re.sub('[0-9]+', ' ', input_string)
+    toks = _NUMBERS.findall(input_string)
+    input_string = _NUMBERS.sub(' ', input_string)
     return toks, input_string
 
 def split_spaces(input_string):
     """Split tokens out based on chunks of spaces.  Will always leave an empty input string"""
-    return re.split(r'\s+', input_string.strip()), ''
+    return _SPACES.split(input_string.strip()), ''
 
 def squeeze_spaces(input_string):
     """Squeeze multiple spaces into one space."""
-    return [], re.sub(r'\s+', ' ', input_string)
+    return [], _SPACES.sub(' ', input_string)
 
 def trigrams(input_string):
     """Split an input string into overlapping trigrams"""
@@ -68,11 +81,163 @@ def tokens(func):
         if not input_str:
             return None
         else:
-            tk, _ = func(input_str)
+            with metrics.timer('parse'):
+                tk, _ = func(input_str)
             return tk if len(tk)>0 else None
 
     return newfunc
 
+# Single-pass equivalents of the composable functions above.  Each takes the list of tokens produced so far and the
+# remaining input string, appends its own tokens to the list and returns the new remainder.
+
+# strip_punctuation followed by lower_case, as one str.translate table for byte strings.
+_STRIP_LOWER = ''.join(chr(c).lower() if _PUNCTUATION.match(chr(c)) is None else ' ' for c in range(256))
+
+def _strip_lower(input_string):
+    if isinstance(input_string, str):
+        return input_string.translate(_STRIP_LOWER)
+    else:
+        return _PUNCTUATION.sub(' ', input_string).lower()
+
+_STRING_STAGES = {
+    strip_punctuation : lambda input_string: _PUNCTUATION.sub(' ', input_string),
+    lower_case : lambda input_string: input_string.lower(),
+    squeeze_spaces : lambda input_string: _SPACES.sub(' ', input_string),
+}
+
+def _compile_strings(functions):
+    """Fuse a run of string-only stages into one function of the input string"""
+    functions = list(functions)
+    steps = []
+    if functions[:2] == [strip_punctuation, lower_case]:
+        steps.append(_strip_lower)
+        functions = functions[2:]
+    steps.extend(_STRING_STAGES[func] for func in functions)
+
+    if len(steps) == 1:
+        step = steps[0]
+        return lambda toks, input_string: step(input_string)
+
+    def op(toks, input_string):
+        for step in steps:
+            input_string = step(input_string)
+        return input_string
+    return op
+
+def _split_numbers(toks, input_string):
+    toks.extend(_NUMBERS.findall(input_string))
+    return _NUMBERS.sub(' ', input_string)
+
+def _split_spaces(toks, input_string):
+    toks.extend(_SPACES.split(input_string.strip()))
+    return ''
+
+def _trigrams(toks, input_string):
+    n = len(input_string)
+    if n > 3:
+        toks.extend([input_string[x:x+3] for x in xrange(n-3)])
+    elif n:
+        toks.append(input_string)
+    return ''
+
+def _split_numbers_and_word_trigrams(toks, input_string):
+    # split_numbers followed by compose_lhs(split_spaces, trigrams) in one scan: numbers first, then words' trigrams.
+    words = []
+    for match in _NUMBERS_AND_WORDS.finditer(input_string):
+        if match.group(1):
+            toks.append(match.group(1))
+        else:
+            words.append(match.group())
+    for word in words:
+        _trigrams(toks, word)
+    return ''
+
+_TOKEN_STAGES = {
+    split_numbers : _split_numbers,
+    split_spaces : _split_spaces,
+    trigrams : _trigrams,
+}
+
+def _compile_stage(func):
+    if func in _TOKEN_STAGES:
+        return _TOKEN_STAGES[func]
+    elif func in _STRING_STAGES:
+        return _compile_strings([func])
+    elif getattr(func, 'composition', None) == 'lhs':
+        head = _compile_stage(func.stages[0])
+        tail = [_compile_stage(f) for f in func.stages[1:]]
+        def op(toks, input_string):
+            result = []
+            input_string = head(result, input_string)
+            for step in tail:
+                tokens, result = result, []
+                for token in tokens:
+                    step(result, token)
+            toks.extend(result)
+            return input_string
+        return op
+    else:
+        def op(toks, input_string):
+            tokens, input_string = func(input_string)
+            toks.extend(tokens)
+            return input_string
+        return op
+
+def _compile_stages(functions):
+    ops = []
+    functions = list(functions)
+    i = 0
+    while i < len(functions):
+        func = functions[i]
+        following = functions[i+1] if i+1 < len(functions) else None
+        if getattr(func, 'composition', None) == 'rhs':
+            ops.extend(_compile_stages(func.stages))
+            i += 1
+        elif func in _STRING_STAGES:
+            j = i
+            while j < len(functions) and functions[j] in _STRING_STAGES:
+                j += 1
+            ops.append(_compile_strings(functions[i:j]))
+            i = j
+        elif func is split_numbers and getattr(following, 'composition', None) == 'lhs' and tuple(following.stages) == (split_spaces, trigrams):
+            ops.append(_split_numbers_and_word_trigrams)
+            i += 2
+        else:
+            ops.append(_compile_stage(func))
+            i += 1
+    return ops
+
+def compile_pipeline(*functions, **kwargs):
+    """Compile the functions that would be given to compose_rhs into a single function returning the same (list, string)
+    pair.  Runs of the string-only stages are fused, the known tokenizers use precompiled regexes and append to one list
+    of tokens, and split_numbers followed by compose_lhs(split_spaces, trigrams) is done in a single scan.  Functions
+    other than the ones defined here are called as they are.
+
+    :param memo: if given, the results for the last `memo` distinct input strings are cached.
+    """
+    ops = _compile_stages(functions)
+
+    def newfunc(input_string):
+        toks = []
+        for op in ops:
+            input_string = op(toks, input_string)
+        return toks, input_string
+
+    memo = kwargs.get('memo')
+    if not memo:
+        return newfunc
+
+    from ga_geocoder.cache import LRUCache
+    cache = LRUCache(max_entries=memo)
+
+    def memoized(input_string):
+        result = cache.get(input_string)
+        if result is None:
+            result = cache[input_string] = newfunc(input_string)
+        return list(result[0]), result[1]
+
+    return memoized
+
 def ci_code(istr):
     """Take an input string and treat it as a case insensitive code"""
     return istr.strip().lower()
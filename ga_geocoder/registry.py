@@ -0,0 +1,70 @@
+# A per-process registry of open geocoders.  Opening a stored geocoder reads its kind and its parser settings from the
+# metadata in its store, and writes nothing.  Each geocoder is opened once per process, on first use, and shared from
+# then on, along with its store's connections and its HTTP sessions.  Processes forked after a geocoder was opened, such
+# as Celery's prefork workers, open their own rather than sharing a parent's connections.
+#
+# Nothing heavier than the settings is imported until a geocoder is first opened.
+
+from ga_geocoder import app_settings
+from threading import RLock
+import os
+
+from logging import getLogger
+
+log = getLogger(__name__)
+
+_geocoders = {}
+_pid = None
+_lock = RLock()
+
+def from_spec(spec):
+    """Open a geocoder from a dict of its kind and the arguments to open it with, e.g. { 'kind' : 'osm', 'rate' : None }"""
+    from ga_geocoder.geocoder import GEOCODERS
+
+    spec = dict(spec)
+    return GEOCODERS[spec.pop('kind')](**spec)
+
+def _open(name):
+    if app_settings.GEOCODER_SERVICES.get(name) is not None:
+        return from_spec(app_settings.GEOCODER_SERVICES[name])
+
+    from ga_geocoder.backends import backend_exists, open_backend
+    from ga_geocoder.geocoder import GEOCODERS
+
+    if not backend_exists(name):
+        raise KeyError(name)
+    store = open_backend(name)
+    if 'kind' not in store:
+        raise KeyError(name)
+    log.debug('opening {kind} geocoder {name}'.format(kind=store['kind'], name=name))
+    return GEOCODERS[store['kind']](name, backend=store)
+
+def open_geocoder(name):
+    """Return the geocoder called name, opening it on first use in this process.  Names given a spec in
+    app_settings.GEOCODER_SERVICES are opened as configured there, and any other name is looked up in the default
+    storage backend.  Raises KeyError if there is no such geocoder."""
+    global _pid
+    with _lock:
+        if _pid != os.getpid():
+            _geocoders.clear()
+            _pid = os.getpid()
+        if name not in _geocoders:
+            _geocoders[name] = _open(name)
+        return _geocoders[name]
+
+def open_service(name):
+    """Return the geocoder called name as open_geocoder does, but only if name is listed in
+    app_settings.GEOCODER_SERVICES.  Raises KeyError for any other name without touching a store, so names that come
+    from clients, such as over HTTP, can never open or create a collection or file."""
+    if name not in app_settings.GEOCODER_SERVICES:
+        raise KeyError(name)
+    return open_geocoder(name)
+
+def forget(name=None):
+    """Drop a geocoder, or every geocoder if name is None, from the registry, so it is opened afresh on next use, for
+    instance after it has been dropped or rebuilt by another process"""
+    with _lock:
+        if name is None:
+            _geocoders.clear()
+        else:
+            _geocoders.pop(name, None)
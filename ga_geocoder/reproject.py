@@ -0,0 +1,104 @@
+# Batch reprojection of GeoJSON.  Rather than round-tripping every feature through JSON text and a GEOS geometry, the
+# coordinates of a whole batch of geometries are gathered into one array, transformed in a single call to a cached OGR
+# coordinate transformation, and scattered back into new geometry dicts.
+
+import threading
+import numpy
+from ga_geocoder.instrumentation import metrics
+
+# OGR coordinate transformations are not safe to share between threads, so each thread keeps its own.
+_local = threading.local()
+
+def transformation(source, target):
+    """Return a cached osr.CoordinateTransformation from the source to the target srid"""
+    if not hasattr(_local, 'transformations'):
+        _local.transformations = {}
+
+    crx = _local.transformations.get((source, target))
+    if crx is None:
+        from osgeo import osr
+        srs = []
+        for srid in (source, target):
+            sr = osr.SpatialReference()
+            sr.ImportFromEPSG(srid)
+            if hasattr(sr, 'SetAxisMappingStrategy'):
+                # GDAL 3 would otherwise use the authority's latitude, longitude axis order for 4326.
+                sr.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            srs.append(sr)
+        crx = _local.transformations[source, target] = osr.CoordinateTransformation(*srs)
+    return crx
+
+def _is_position(coordinates):
+    return not isinstance(coordinates[0], (list, tuple))
+
+def _positions(geometry, out):
+    """Append every position in a GeoJSON geometry to out"""
+    if geometry is None:
+        return
+    elif geometry.get('type') == 'GeometryCollection':
+        for g in geometry['geometries']:
+            _positions(g, out)
+    else:
+        stack = [geometry['coordinates']]
+        while stack:
+            coordinates = stack.pop()
+            if not coordinates:
+                continue
+            elif _is_position(coordinates):
+                out.append(coordinates)
+            else:
+                stack.extend(reversed(coordinates))
+
+def _rebuild_coordinates(coordinates, transformed):
+    if not coordinates:
+        return []
+    elif _is_position(coordinates):
+        x, y, z = next(transformed)
+        return [x, y, z] if len(coordinates) > 2 else [x, y]
+    else:
+        return [_rebuild_coordinates(c, transformed) for c in coordinates]
+
+def _rebuild(geometry, transformed):
+    """Return a copy of geometry with its positions replaced, in order, by those from the transformed iterator"""
+    if geometry is None:
+        return None
+    elif geometry.get('type') == 'GeometryCollection':
+        return dict(geometry, geometries=[_rebuild(g, transformed) for g in geometry['geometries']])
+    else:
+        return dict(geometry, coordinates=_rebuild_coordinates(geometry['coordinates'], transformed))
+
+def reproject_points(points, source, target):
+    """Transform an (N, 2) or (N, 3) array of coordinates from the source to the target srid, returning an (N, 3) array"""
+    points = numpy.asarray(points, dtype=float)
+    if not len(points):
+        return numpy.zeros((0, 3))
+    metrics.incr('reproject.points', len(points))
+    with metrics.timer('reproject'):
+        # the osgeo bindings take a sequence of tuples, not an array.
+        return numpy.asarray(transformation(source, target).TransformPoints([tuple(p) for p in points]), dtype=float)
+
+def reproject_geometries(geometries, source, target):
+    """Transform a batch of GeoJSON geometry dicts from the source to the target srid, returning new geometry dicts"""
+    geometries = list(geometries)
+    if source == target:
+        return geometries
+
+    positions = []
+    for geometry in geometries:
+        _positions(geometry, positions)
+    if not positions:
+        return geometries
+
+    if any(len(p) > 2 for p in positions):
+        points = [(p[0], p[1], p[2] if len(p) > 2 else 0.0) for p in positions]
+    else:
+        points = [(p[0], p[1]) for p in positions]
+
+    transformed = iter(reproject_points(points, source, target).tolist())
+    return [_rebuild(geometry, transformed) for geometry in geometries]
+
+def reproject_features(features, source, target):
+    """Return copies of a batch of GeoJSON features with their geometries transformed from the source to the target srid"""
+    features = list(features)
+    geometries = reproject_geometries((f['geometry'] for f in features), source, target)
+    return [dict(f, geometry=g) for f, g in zip(features, geometries)]
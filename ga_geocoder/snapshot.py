@@ -0,0 +1,157 @@
+# Immutable snapshot files of exact geocoders, for sharing one static geocoder between many processes.  A snapshot is
+# opened with mmap, so every process reading it shares the same pages of the operating system's cache and opening one
+# reads nothing but the header.
+#
+# Layout, little-endian, with every section aligned to 8 bytes:
+#
+#   header            HEADER, below
+#   metadata          JSON: the geocoder's name, case_sensitive and long_codes
+#   key offsets       count + 1 uint64 offsets of each code in the keys section
+#   keys              the codes, utf-8 encoded and sorted bytewise
+#   payload offsets   count + 1 uint64 offsets of each feature in the payloads section
+#   payloads          the features as GeoJSON text, in key order
+#   envelopes         count (xmin, ymin, xmax, ymax) float64 rows, sorted by xmin
+#   envelope order    count uint32 key positions of the envelopes' features
+
+import json
+import mmap
+import os
+import struct
+import numpy
+
+from ga_geocoder.reproject import _positions
+
+from logging import getLogger
+
+log = getLogger(__name__)
+
+MAGIC = 'GAGEOSN1'
+
+# magic, srid, count, widest envelope, then the offsets of the metadata (and its length) and of each section.
+HEADER = struct.Struct('<8sIIdQQQQQQQQ')
+
+# the offsets of an entry and of the one after it: where the entry starts and ends.
+_SPAN = struct.Struct('<QQ')
+
+def _pad(f):
+    f.write('\0' * (-f.tell() % 8))
+    return f.tell()
+
+def _envelope(geometry):
+    positions = []
+    _positions(geometry, positions)
+    if not positions:
+        return (numpy.nan,) * 4
+    xy = numpy.array([p[:2] for p in positions], dtype=float)
+    return xy[:, 0].min(), xy[:, 1].min(), xy[:, 0].max(), xy[:, 1].max()
+
+def write_snapshot(path, features, srid, metadata=None):
+    """Write an iterable of GeoJSON features, each with its code as '_id', to a snapshot file.  The file is written
+    beside path and moved into place, so processes that have the old snapshot open keep reading it undisturbed.
+
+    :return: the number of features written.
+    """
+    entries = []
+    for feature in features:
+        code = feature['_id']
+        key = code.encode('utf-8') if isinstance(code, unicode) else str(code)
+        entries.append((key, json.dumps(feature, separators=(',', ':')), _envelope(feature.get('geometry'))))
+    entries.sort(key=lambda e: e[0])
+
+    count = len(entries)
+    envelopes = numpy.array([envelope for key, payload, envelope in entries], dtype='<f8').reshape(count, 4)
+    order = numpy.argsort(envelopes[:, 0], kind='mergesort').astype('<u4')
+    widths = envelopes[:, 2] - envelopes[:, 0]
+    widths = widths[~numpy.isnan(widths)]
+    max_width = float(widths.max()) if len(widths) else 0.0
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write('\0' * HEADER.size)
+
+        meta = json.dumps(metadata or {})
+        meta_offset = _pad(f)
+        f.write(meta)
+
+        sections = []
+        for blobs in ([key for key, payload, envelope in entries], [payload for key, payload, envelope in entries]):
+            offsets = numpy.cumsum([0] + [len(blob) for blob in blobs]).astype('<u8')
+            sections.append(_pad(f))
+            f.write(offsets.tostring())
+            sections.append(_pad(f))
+            for blob in blobs:
+                f.write(blob)
+
+        sections.append(_pad(f))
+        f.write(envelopes[order].tostring())
+        sections.append(_pad(f))
+        f.write(order.tostring())
+
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, srid, count, max_width, meta_offset, len(meta), *sections))
+
+    os.rename(tmp, path)
+    log.debug('wrote {n} features to {path}'.format(n=count, path=path))
+    return count
+
+class Snapshot(object):
+    """A read-only, memory-mapped snapshot file.  Lookups binary search the sorted keys without reading anything else,
+    and payloads are sliced straight out of the map."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, self.srid, self.count, self.max_width, meta_offset, meta_length, key_offsets, keys, payload_offsets,
+            payloads, envelopes, order) = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError('{path} is not a geocoder snapshot'.format(path=path))
+
+        self.metadata = json.loads(self._map[meta_offset:meta_offset + meta_length])
+        self._key_offsets = key_offsets
+        self._keys = keys
+        self._payload_offsets = payload_offsets
+        self._payloads = payloads
+        self._envelopes = numpy.frombuffer(self._map, dtype='<f8', count=self.count * 4, offset=envelopes).reshape(self.count, 4)
+        self._order = numpy.frombuffer(self._map, dtype='<u4', count=self.count, offset=order)
+
+    def __len__(self):
+        return self.count
+
+    def key(self, i):
+        start, end = _SPAN.unpack_from(self._map, self._key_offsets + 8 * i)
+        return self._map[self._keys + start:self._keys + end]
+
+    def find(self, code):
+        """Return the position of a code in the snapshot, or -1"""
+        key = code.encode('utf-8') if isinstance(code, unicode) else str(code)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < self.count and self.key(lo) == key else -1
+
+    def payload(self, i):
+        """The GeoJSON text of the feature at a position, as a buffer onto the map rather than a copy"""
+        start, end = _SPAN.unpack_from(self._map, self._payload_offsets + 8 * i)
+        return buffer(self._map, self._payloads + start, end - start)
+
+    def feature(self, i):
+        return json.loads(str(self.payload(i)))
+
+    def keys(self):
+        return [self.key(i) for i in xrange(self.count)]
+
+    def overlapping(self, extent):
+        """Return the positions of the features whose envelopes intersect an (xmin, ymin, xmax, ymax) extent.  Envelopes
+        are sorted by xmin, so only those starting between xmin - the widest envelope and xmax are tested."""
+        xmin, ymin, xmax, ymax = extent
+        lo = numpy.searchsorted(self._envelopes[:, 0], xmin - self.max_width, side='left')
+        hi = numpy.searchsorted(self._envelopes[:, 0], xmax, side='right')
+        e = self._envelopes[lo:hi]
+        hits = (e[:, 2] >= xmin) & (e[:, 1] <= ymax) & (e[:, 3] >= ymin)
+        return self._order[lo:hi][hits].tolist()
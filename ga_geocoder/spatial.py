@@ -0,0 +1,167 @@
+import json
+import math
+import numpy
+
+from logging import getLogger
+
+log = getLogger(__name__)
+
+def _union(envelopes):
+    xmins, ymins, xmaxs, ymaxs = zip(*envelopes)
+    return min(xmins), min(ymins), max(xmaxs), max(ymaxs)
+
+def _intersects(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def _pack(entries, capacity, leaf):
+    """One Sort-Tile-Recursive pass: tile (envelope, child) entries into nodes of at most capacity children each"""
+    slices = int(math.ceil(math.sqrt(math.ceil(len(entries) / float(capacity)))))
+    per_slice = slices * capacity
+
+    nodes = []
+    entries = sorted(entries, key=lambda e: e[0][0] + e[0][2])
+    for i in range(0, len(entries), per_slice):
+        tile = sorted(entries[i:i+per_slice], key=lambda e: e[0][1] + e[0][3])
+        for j in range(0, len(tile), capacity):
+            children = tile[j:j+capacity]
+            nodes.append((_union([envelope for envelope, child in children]), (leaf, children)))
+    return nodes
+
+def points_in_rings(xs, ys, rings, block=1000000):
+    """Even-odd ray casting test of arrays of point coordinates against a set of rings, such as the shell and holes of
+    a polygon.  Vectorized over both points and edges, a block of at most `block` point-edge pairs at a time."""
+    inside = numpy.zeros(len(xs), dtype=bool)
+    edges = [numpy.asarray(ring, dtype=float)[:, :2] for ring in rings if len(ring) > 1]
+    if not edges or not len(xs):
+        return inside
+
+    edges = numpy.vstack([numpy.hstack([ring[:-1], ring[1:]]) for ring in edges])
+    x0, y0, x1, y1 = edges[:, 0], edges[:, 1], edges[:, 2], edges[:, 3]
+    step = max(1, block // len(edges))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        for i in range(0, len(xs), step):
+            px = xs[i:i+step, numpy.newaxis]
+            py = ys[i:i+step, numpy.newaxis]
+            crosses = ((y0 > py) != (y1 > py)) & (px < (x1 - x0) * (py - y0) / (y1 - y0) + x0)
+            inside[i:i+step] = crosses.sum(axis=1) % 2 == 1
+    return inside
+
+def points_in_geometry(xs, ys, geometry):
+    """Test arrays of point coordinates against a GeoJSON Polygon or MultiPolygon, returning a boolean array, or None for
+    other geometry types"""
+    if geometry['type'] == 'Polygon':
+        return points_in_rings(xs, ys, geometry['coordinates'])
+    elif geometry['type'] == 'MultiPolygon':
+        inside = numpy.zeros(len(xs), dtype=bool)
+        for polygon in geometry['coordinates']:
+            inside |= points_in_rings(xs, ys, polygon)
+        return inside
+    else:
+        return None
+
+class STRtree(object):
+    """A static R-tree, bulk loaded with the Sort-Tile-Recursive algorithm from (envelope, item) pairs, where an envelope
+    is an (xmin, ymin, xmax, ymax) tuple."""
+
+    def __init__(self, items, capacity=10):
+        entries = [(tuple(envelope), item) for envelope, item in items]
+        self.size = len(entries)
+        self.root = None
+
+        if entries:
+            nodes = _pack(entries, capacity, True)
+            while len(nodes) > 1:
+                nodes = _pack(nodes, capacity, False)
+            self.root = nodes[0]
+
+    def __len__(self):
+        return self.size
+
+    def query(self, envelope):
+        """Yield every item whose envelope intersects the query envelope"""
+        if self.root is None:
+            return
+
+        stack = [self.root]
+        while stack:
+            node_envelope, (leaf, children) = stack.pop()
+            if _intersects(node_envelope, envelope):
+                if leaf:
+                    for child_envelope, item in children:
+                        if _intersects(child_envelope, envelope):
+                            yield item
+                else:
+                    stack.extend(children)
+
+def parse_geometry(data, srid=None):
+    """Parse GeoJSON, WKT or WKB with GEOS.  GEOS is imported on first use, so importing ga_geocoder does not load it."""
+    from django.contrib.gis.geos.geometry import GEOSGeometry
+    return GEOSGeometry(data, srid=srid)
+
+class SpatialIndex(object):
+    """An in-process index of GeoJSON features for reverse geocoding.  Candidates are found by envelope in an STRtree and
+    then tested exactly against cached prepared geometries."""
+
+    def __init__(self, features, srid):
+        self.srid = srid
+
+        self.entries = []
+        for feature in features:
+            g = parse_geometry(json.dumps(feature['geometry']), srid)
+            self.entries.append((g.extent, (feature, g.prepared)))
+        self.tree = STRtree(self.entries)
+
+        log.debug('indexed {n} features'.format(n=len(self.tree)))
+
+    def __len__(self):
+        return len(self.tree)
+
+    def candidates(self, geometry):
+        """Yield (feature, prepared geometry) pairs for every feature whose envelope intersects that of the geometry"""
+        return self.tree.query(geometry.extent)
+
+    def query(self, geometry):
+        """Return the first feature containing a point, or intersecting any other geometry, or None"""
+        if geometry.srid is not None and geometry.srid != self.srid:
+            geometry = geometry.transform(self.srid, clone=True)
+
+        test = 'contains' if geometry.geom_type == 'Point' else 'intersects'
+        for feature, prepared in self.candidates(geometry):
+            if getattr(prepared, test)(geometry):
+                return feature
+        return None
+
+    def join(self, xs, ys):
+        """Find the feature containing each of a batch of points, given as arrays of coordinates in the index's srid.
+        Points are sorted along x so that each feature is tested, in one vectorized pass, against only the points within
+        its envelope.  Returns a list holding a feature or None for each point."""
+        xs = numpy.asarray(xs, dtype=float)
+        ys = numpy.asarray(ys, dtype=float)
+        order = numpy.argsort(xs, kind='mergesort')
+        sx = xs[order]
+        sy = ys[order]
+        found = numpy.empty(len(xs), dtype=int)
+        found.fill(-1)
+
+        for i, ((xmin, ymin, xmax, ymax), (feature, prepared)) in enumerate(self.entries):
+            lo = numpy.searchsorted(sx, xmin, side='left')
+            hi = numpy.searchsorted(sx, xmax, side='right')
+            if lo == hi:
+                continue
+
+            near = numpy.arange(lo, hi)
+            near = near[(sy[lo:hi] >= ymin) & (sy[lo:hi] <= ymax) & (found[lo:hi] < 0)]
+            if not len(near):
+                continue
+
+            inside = points_in_geometry(sx[near], sy[near], feature['geometry'])
+            if inside is None:
+                from django.contrib.gis.geos.geometry import Point
+                inside = numpy.array([prepared.contains(Point(x, y, srid=self.srid)) for x, y in zip(sx[near], sy[near])], dtype=bool)
+            found[near[inside]] = i
+
+        result = [None] * len(xs)
+        for position, i in zip(order, found):
+            if i >= 0:
+                result[position] = self.entries[i][1][0]
+        return result
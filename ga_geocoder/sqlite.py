@@ -0,0 +1,33 @@
+# SQLite connections can't be shared between threads, so the SQLite response cache and storage backend open one per
+# thread that uses them, on first use.
+
+import sqlite3
+import threading
+
+class LocalConnection(object):
+    """A connection to a SQLite database for each thread, opened on first use in WAL mode, so that readers are not
+    blocked by a writer in another thread or process.
+
+    :param path: the database file.
+    :param timeout: the number of seconds to wait for another process's lock on the database.
+    """
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def get(self):
+        """The calling thread's connection"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=self.timeout)
+            db.execute('PRAGMA journal_mode=WAL')
+        return db
+
+    def close(self):
+        """Close the calling thread's connection, if it has one"""
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            db.close()
+            self._local.db = None
@@ -1,3 +1,209 @@
-from celery.task import task
+from celery import chord, shared_task
+from celery.result import AsyncResult
+from celery.utils import uuid
+from contextlib import contextmanager
+from ga_geocoder import app_settings, registry
+from ga_geocoder.backends import _mongo_db
+from ga_geocoder.geocoder import bulk_results
+from ga_geocoder.instrumentation import metrics
+import json
+import os
+import shutil
 
-# write celery tasks here
+from logging import getLogger
+
+log = getLogger(__name__)
+
+# Distributed bulk geocoding.  geocode_job splits a list of inputs, or a file of them one per line, into shards.  Each
+# shard is geocoded by a geocode_shard task on whichever worker picks it up, and its results are written to a part file
+# beside the output file or to an output collection.  A shard that fails is retried as a task of its own, with
+# exponential backoff, on whichever worker is free.  A chord runs merge_shards once every shard has succeeded, to join
+# the part files into the output in input order.
+#
+# A job's geocoder is given by name, and opened through ga_geocoder.registry once per worker process, or as a dict of
+# its kind and the arguments to open it with, e.g. { 'kind' : 'osm', 'urls' : ['http://localhost:8080'] }
+
+def _open(spec):
+    return registry.open_geocoder(spec) if isinstance(spec, basestring) else registry.from_spec(spec)
+
+def _read_lines(path, start, stop):
+    """Yield the lines of a utf-8 file that start in the byte range [start, stop)"""
+    with open(path, 'rb') as f:
+        if start:
+            # skip the rest of the line that started before us; it belongs to the shard before.
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < stop:
+            line = f.readline()
+            if not line:
+                break
+            yield line.rstrip('\r\n').decode('utf-8')
+
+def _file_shards(path, shard_bytes):
+    size = os.path.getsize(path)
+    return [{ 'path' : path, 'start' : start, 'stop' : min(start + shard_bytes, size) } for start in xrange(0, max(size, 1), shard_bytes)]
+
+def _part(output, index):
+    return '{output}.{index:05d}.part'.format(output=output, index=index)
+
+def _collection(name):
+    return _mongo_db()[name]
+
+@contextmanager
+def _file_writer(output, index):
+    """Write a shard's results as lines of JSON to a part file, which is only moved into place once they are all written"""
+    part = _part(output, index)
+    try:
+        with open(part + '.tmp', 'wb') as f:
+            yield lambda row, code, result: f.write(json.dumps({ 'input' : code, 'result' : result }) + '\n')
+    except Exception:
+        # a failed shard leaves nothing behind; a retry writes it afresh.
+        os.remove(part + '.tmp')
+        raise
+    os.rename(part + '.tmp', part)
+
+@contextmanager
+def _collection_writer(name, index, batch_size=1000):
+    """Write a shard's results as documents numbered by shard and row, replacing any left by an earlier attempt"""
+    collection = _collection(name)
+    collection.ensure_index([('shard', 1), ('row', 1)])
+    collection.remove({ 'shard' : index })
+    batch = []
+
+    def write(row, code, result):
+        batch.append({ 'shard' : index, 'row' : row, 'input' : code, 'result' : result })
+        if len(batch) == batch_size:
+            collection.insert(batch)
+            del batch[:]
+
+    yield write
+    if batch:
+        collection.insert(batch)
+
+def _run_shard(job, index, shard, report=None):
+    coder = _open(job['geocoder'])
+    inputs = shard['inputs'] if 'inputs' in shard else _read_lines(shard['path'], shard['start'], shard['stop'])
+    writer = _file_writer(job['output'], index) if job.get('output') else _collection_writer(job['collection'], index)
+
+    rows = found = 0
+    with metrics.timer('task.shard'), writer as write:
+        for code, result in bulk_results(coder, inputs, job.get('srid')):
+            write(rows, code, result)
+            rows += 1
+            found += result is not None
+            if report and not rows % 1000:
+                report(rows)
+    metrics.incr('task.rows', rows)
+    return { 'index' : index, 'rows' : rows, 'found' : found }
+
+@shared_task(bind=True, max_retries=app_settings.TASK_RETRIES)
+def geocode_shard(self, job, index, shard):
+    """Geocode one shard of a job, retrying it up to job['retries'] times if it fails, after job['retry_delay'] seconds,
+    doubling each time.  Once the retries are exhausted the error is raised, and fails the job."""
+    retries = self.request.retries
+    report = None if self.request.is_eager else lambda rows: self.update_state(state='PROGRESS', meta={ 'rows' : rows })
+    try:
+        return _run_shard(job, index, shard, report)
+    except Exception as e:
+        log.exception('shard {index} failed'.format(index=index))
+        metrics.incr('task.shard.error')
+        if retries >= job['retries']:
+            raise
+        metrics.incr('task.shard.retry')
+        if self.request.is_eager:
+            # celery runs an eager retry at once but drops its result, so eager jobs retry in place.
+            return geocode_shard.apply((job, index, shard), retries=retries + 1).get()
+        raise self.retry(exc=e, countdown=job['retry_delay'] * 2 ** retries, max_retries=job['retries'])
+
+@shared_task
+def merge_shards(results, job):
+    """Join the part files of a job's shards into the output file, in input order.
+
+    :return: the number of shards, rows and rows found.
+    """
+    results = sorted(results, key=lambda r: r['index'])
+    if job.get('output'):
+        output = job['output']
+        with open(output + '.tmp', 'wb') as f:
+            for r in results:
+                with open(_part(output, r['index']), 'rb') as part:
+                    shutil.copyfileobj(part, f)
+        os.rename(output + '.tmp', output)
+        for r in results:
+            os.remove(_part(output, r['index']))
+
+    return {
+        'shards' : len(results),
+        'rows' : sum(r['rows'] for r in results),
+        'found' : sum(r['found'] for r in results),
+    }
+
+class Job(object):
+    """A geocoding job started by geocode_job: the result of its merge step, and the ids of its shards' tasks"""
+
+    def __init__(self, result, shard_ids):
+        self.result = result
+        self.shard_ids = shard_ids
+
+    def get(self, **kwargs):
+        """Wait for the job to finish, and return the summary returned by merge_shards"""
+        return self.result.get(**kwargs)
+
+    def progress(self):
+        """Return the number of shards, how many of them have finished, and the number of rows geocoded so far"""
+        if self.result.ready():
+            summary = self.result.result if self.result.successful() else {}
+            return { 'shards' : len(self.shard_ids), 'finished' : len(self.shard_ids), 'rows' : summary.get('rows') }
+
+        finished = rows = 0
+        for task_id in self.shard_ids:
+            result = AsyncResult(task_id)
+            if result.state == 'SUCCESS':
+                finished += 1
+                rows += result.result.get('rows', 0)
+            elif result.state == 'PROGRESS':
+                rows += result.info['rows']
+        return { 'shards' : len(self.shard_ids), 'finished' : finished, 'rows' : rows }
+
+def geocode_job(geocoder, inputs=None, path=None, output=None, collection=None, srid=None,
+                shard_size=app_settings.TASK_SHARD_SIZE, shard_bytes=app_settings.TASK_SHARD_BYTES,
+                retries=app_settings.TASK_RETRIES, retry_delay=app_settings.TASK_RETRY_DELAY):
+    """Geocode a list of inputs, or a utf-8 file of them one per line, across the Celery workers.
+
+    :param geocoder: the name of a geocoder, or the kind of geocoder and the arguments to open it with, as a dict.
+        Every worker opens its own.
+    :param output: a file to write the results to, as a line of JSON for each input, in input order:
+        {"input" : ..., "result" : ...}, where result is null if nothing was found.  Workers must share its directory.
+        Give either output or collection.
+    :param collection: a collection in the ga_geocoder database to write the results to, as documents with the input
+        and result, numbered by shard and row.  Give either output or collection.
+    :param shard_size: the number of inputs from a list in each shard.
+    :param shard_bytes: the number of bytes of a file in each shard.  Workers read their own shards from the file.
+    :param retries: the number of times a failed shard is retried before the job fails.
+    :param retry_delay: the number of seconds before a failed shard's first retry.  The delay doubles with each retry.
+    :return: a Job.
+    """
+    if (inputs is None) == (path is None):
+        raise ValueError('geocode_job needs either inputs or a path')
+    if (output is None) == (collection is None):
+        raise ValueError('geocode_job needs either an output file or a collection')
+
+    if path is not None:
+        shards = _file_shards(path, shard_bytes)
+    else:
+        inputs = list(inputs)
+        shards = [{ 'inputs' : inputs[i:i + shard_size] } for i in xrange(0, max(len(inputs), 1), shard_size)]
+
+    job = {
+        'geocoder' : geocoder,
+        'srid' : srid,
+        'output' : os.path.abspath(output) if output else None,
+        'collection' : collection,
+        'retries' : retries,
+        'retry_delay' : retry_delay,
+    }
+    shard_ids = [uuid() for _ in shards]
+    log.debug('geocoding {n} shards'.format(n=len(shards)))
+    header = [geocode_shard.subtask((job, index, shard), task_id=task_id) for index, (shard, task_id) in enumerate(zip(shards, shard_ids))]
+    result = chord(header)(merge_shards.subtask((job,)))
+    return Job(result, shard_ids)
@@ -0,0 +1,101 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse, parse_qs
+import json
+import threading
+import zlib
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class StubNominatim(object):
+    """A local stand-in for a Nominatim server, answering /search and /reverse requests with made up but deterministic
+    locations.  Queries containing "nowhere" find nothing, and the first `failures` requests get a 503 response.
+
+    Use it as a context manager, or call start() and stop(), and point an OpenStreetMapGeocoder at its url::
+
+        with StubNominatim() as nominatim:
+            coder = OpenStreetMapGeocoder(urls=[nominatim.url], rate=None)
+    """
+
+    def __init__(self, failures=0, latency=0):
+        self.failures = failures
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return 'http://{host}:{port}'.format(host=host, port=port)
+
+    def _count(self):
+        with self._lock:
+            self.requests += 1
+            return self.requests
+
+    def search(self, q):
+        if 'nowhere' in q.lower():
+            return []
+        h = zlib.crc32(q) & 0xffffffff
+        return [{
+            'place_id' : str(h),
+            'display_name' : q,
+            'lon' : str(-80 + (h % 10000) / 10000.0),
+            'lat' : str(35 + (h // 10000 % 10000) / 10000.0),
+        }]
+
+    def reverse(self, lon, lat, zoom):
+        return {
+            'place_id' : '{lon:.4f},{lat:.4f},{zoom}'.format(lon=lon, lat=lat, zoom=zoom),
+            'display_name' : 'Somewhere',
+            'lon' : str(lon),
+            'lat' : str(lat),
+        }
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                n = stub._count()
+                if stub.latency:
+                    threading.Event().wait(stub.latency)
+
+                url = urlparse(self.path)
+                params = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+                if n <= stub.failures:
+                    status, body = 503, {'error' : 'overloaded'}
+                elif url.path == '/search':
+                    status, body = 200, stub.search(params.get('q', ''))
+                elif url.path == '/reverse':
+                    status, body = 200, stub.reverse(float(params['lon']), float(params['lat']), int(params.get('zoom', 0)))
+                else:
+                    status, body = 404, {'error' : 'not found'}
+
+                body = json.dumps(body)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
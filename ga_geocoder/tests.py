@@ -6,11 +6,31 @@ Replace this with more appropriate tests for your application.
 """
 
 from django.test import TestCase
-from django.contrib.gis.geos import Point
+from django.contrib.gis.geos import GEOSGeometry, Point
 from unittest import skip
+from collections import Counter, defaultdict
+import csv
+import json
+import numpy
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
 
-from ga_geocoder import utils, geocoder
+from celery import current_app
+from ga_geocoder import app_settings, registry, utils, geocoder, benchmarks, tasks, views
+from ga_geocoder.backends import SQLiteBackend
+from ga_geocoder.cache import LRUCache, SQLiteCache
+from ga_geocoder.index import TrigramIndex, edit_distance, idf, normalize, rank, similarity
+from ga_geocoder.instrumentation import configure, MemorySink
+from ga_geocoder.spatial import STRtree, points_in_geometry
+from ga_geocoder.testing import StubNominatim
 from ga_geocoder.parsers import independent, en_us
+from ga_geocoder.reproject import _positions, reproject_features
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
 
 
 class IndependentParserTest(TestCase):
@@ -83,8 +103,290 @@ class UsEnParserTest(TestCase):
         self.assertNotEqual(e, f)
         self.assertListEqual(a[0:2], ['123','27707'])
 
+class TrigramIndexTest(TestCase):
+    addresses = [
+        "3926 Swarthmore Rd Durham NC 27707",
+        "3927 Swarthmore Rd Durham NC 27707",
+        "100 Europa Dr. Chapel Hill, NC",
+    ]
+
+    def setUp(self):
+        self.index = TrigramIndex()
+        for address in self.addresses:
+            for ngram in en_us.address_trigrams(address):
+                self.index.add(ngram, address)
+
+    def test_search(self):
+        ranked = self.index.search(en_us.address_trigrams("3926 Swarthmore Road Durham"))
+        self.assertEqual(ranked[0][0], self.addresses[0])
+        self.assertNotIn(self.addresses[2], [code for code, score in ranked])
+
+    def test_top_k(self):
+        ranked = self.index.search(en_us.address_trigrams("Swarthmore Durham NC"), k=1)
+        self.assertEqual(len(ranked), 1)
+
+    def test_miss(self):
+        self.assertListEqual(self.index.search(['zzz', 'qqq']), [])
+
+    def test_ranked(self):
+        ranked = self.index.ranked(en_us.address_trigrams("3926 Swarthmore Road Durham"), 2)
+        self.assertEqual(ranked[0][0], self.addresses[0])
+        self.assertEqual(len(ranked), 2)
+        self.assertListEqual(self.index.ranked(['zzz', 'qqq'], 2), [])
+
+    def test_early_termination_is_exact(self):
+        rnd = random.Random(0)
+        ngrams = ['n{i}'.format(i=i) for i in range(100)]
+        postings = defaultdict(list)
+        index = TrigramIndex()
+        for code in range(500):
+            for ngram in set(ngrams[min(99, int(rnd.expovariate(0.05)))] for _ in range(10)):
+                count = rnd.randint(1, 3)
+                index.add(ngram, code, count)
+                postings[ngram].append((code, count))
+
+        for _ in range(50):
+            query = [ngrams[min(99, int(rnd.expovariate(0.05)))] for _ in range(8)]
+            scores = defaultdict(float)
+            for ngram, weight in Counter(query).items():
+                for code, count in postings[ngram]:
+                    scores[code] += weight * idf(500, len(postings[ngram])) * count
+            exhaustive = sorted(scores.values(), reverse=True)[:5]
+            for ranked in (index.ranked(query, 5), rank(query, postings, 500, 5)):
+                self.assertEqual(len(ranked), len(exhaustive))
+                for (code, score), best in zip(ranked, exhaustive):
+                    self.assertAlmostEqual(score, best)
+                    self.assertAlmostEqual(score, scores[code])
+
+    def test_edit_distance(self):
+        def levenshtein(a, b):
+            row = range(len(b) + 1)
+            for i, x in enumerate(a):
+                previous, row = row, [i + 1]
+                for j, y in enumerate(b):
+                    row.append(min(previous[j + 1] + 1, row[j] + 1, previous[j] + (x != y)))
+            return row[-1]
+
+        rnd = random.Random(0)
+        for _ in range(500):
+            a = ''.join(rnd.choice('abc') for _ in range(rnd.randint(0, 8)))
+            b = ''.join(rnd.choice('abc') for _ in range(rnd.randint(0, 8)))
+            k = rnd.randint(0, 8)
+            d = levenshtein(a, b)
+            self.assertEqual(edit_distance(a, b, k), d if d <= k else None)
+
+    def test_similarity(self):
+        self.assertEqual(normalize('1 Main St., Durham'), '1 main st durham')
+        self.assertEqual(similarity('main st', 'main st'), 1.0)
+        self.assertAlmostEqual(similarity('main st', 'mian st'), 5 / 7.0)
+        self.assertIsNone(similarity('main st', 'mian st', threshold=0.8))
+
+        # a score of exactly the threshold passes.
+        self.assertAlmostEqual(similarity('abcde', 'abcdx', threshold=0.8), 0.8)
+        self.assertAlmostEqual(similarity('main st', 'mian st', threshold=5 / 7.0), 5 / 7.0)
+        self.assertIsNone(similarity('abcde', 'abcxx', threshold=0.8))
+        self.assertAlmostEqual(similarity('abcde', 'vwxyz', threshold=0.0), 0.0)
+
+class ChunkTest(TestCase):
+    def test_chunk(self):
+        chunks = list(geocoder._chunk(range(5), 2))
+        self.assertEqual(chunks, [[0, 1], [2, 3], [4]])
+
+    def test_sizer(self):
+        sizer = geocoder._ChunkSizer(size=1000, seconds=0.25, max_bytes=1000000)
+        sizer.observe(1000, 0.05, 100)
+        self.assertEqual(sizer.size, 3000)
+        sizer.observe(3000, 1.0, 100)
+        self.assertEqual(sizer.size, 1875)
+        sizer.observe(1875, 0.01, 10000)
+        self.assertEqual(sizer.size, 987)
+        self.assertEqual([len(c) for c in sizer.chunks(range(2000))], [987, 987, 26])
+
+    def test_prefetch(self):
+        chunks = list(geocoder._chunk(range(100), 10))
+        results = list(geocoder._prefetch(chunks, sum, 3))
+        self.assertEqual(results, [(chunk, sum(chunk)) for chunk in chunks])
+
+        def fail(chunk):
+            raise IOError(chunk[0])
+        self.assertRaises(IOError, lambda: list(geocoder._prefetch(chunks, fail, 3)))
+
+        # the threads have finished once the caller is done, even if it stops early.
+        threads = threading.active_count()
+        prefetched = geocoder._prefetch(chunks, sum, 3)
+        next(prefetched)
+        self.assertEqual(threading.active_count(), threads + 3)
+        prefetched.close()
+        self.assertEqual(threading.active_count(), threads)
+
+class LRUCacheTest(TestCase):
+    def test_lru_eviction(self):
+        cache = LRUCache(max_entries=2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache.get('a')
+        cache['c'] = 3
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_byte_limit(self):
+        cache = LRUCache(max_entries=None, max_bytes=10, sizeof=len)
+        cache['a'] = 'xxxxxx'
+        cache['b'] = 'yyyyyy'
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.bytes, 6)
+
+    def test_ttl(self):
+        cache = LRUCache(ttl=-1)
+        cache['a'] = 1
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['misses'], 1)
+
+class SQLiteCacheTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_hits_do_not_write(self):
+        cache = SQLiteCache(self.path, max_entries=10)
+        cache['a'] = [1]
+        changes = cache._db.total_changes
+        for _ in range(5):
+            self.assertEqual(cache['a'], [1])
+        self.assertEqual(cache._db.total_changes, changes)
+        self.assertEqual(cache.stats()['hits'], 5)
+
+    def test_lru_eviction(self):
+        cache = SQLiteCache(self.path, max_entries=2, touch_interval=0)
+        cache['a'] = 1
+        cache['b'] = 2
+        time.sleep(0.01)
+        cache['a']
+        cache['c'] = 3
+        cache.evict()
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual((cache['a'], cache['c']), (1, 3))
+
+class STRtreeTest(TestCase):
+    def test_query(self):
+        items = [((x, y, x + 1.5, y + 1.5), (x, y)) for x in range(50) for y in range(50)]
+        tree = STRtree(items)
+        envelope = (10.2, 20.2, 12.8, 21.0)
+        expected = set(item for (xmin, ymin, xmax, ymax), item in items
+            if xmin <= envelope[2] and envelope[0] <= xmax and ymin <= envelope[3] and envelope[1] <= ymax)
+        self.assertSetEqual(set(tree.query(envelope)), expected)
+        self.assertListEqual(list(tree.query((-10, -10, -5, -5))), [])
+
+    def test_empty(self):
+        self.assertListEqual(list(STRtree([]).query((0, 0, 1, 1))), [])
+
+    def test_points_in_geometry(self):
+        donut = { 'type' : 'Polygon', 'coordinates' : [
+            [[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]],
+            [[4, 4], [6, 4], [6, 6], [4, 6], [4, 4]],
+        ]}
+        xs = numpy.array([1.0, 5.0, 15.0, 9.5])
+        ys = numpy.array([1.0, 5.0, 5.0, 0.5])
+        self.assertListEqual(points_in_geometry(xs, ys, donut).tolist(), [True, False, False, True])
+
+        multi = { 'type' : 'MultiPolygon', 'coordinates' : [donut['coordinates'], [[[14, 4], [16, 4], [16, 6], [14, 6], [14, 4]]]] }
+        self.assertListEqual(points_in_geometry(xs, ys, multi).tolist(), [True, False, True, True])
+        self.assertIsNone(points_in_geometry(xs, ys, { 'type' : 'Point', 'coordinates' : [0, 0] }))
+
+class ReprojectTest(TestCase):
+    geometries = [
+        { 'type' : 'Point', 'coordinates' : [-78.9597, 35.93484] },
+        json.loads(benchmarks.tract_features(1)[0][1]),
+    ]
+
+    def positions(self, geometry):
+        out = []
+        _positions(geometry, out)
+        return out
+
+    def test_matches_geos(self):
+        for geometry in self.geometries:
+            expected = json.loads(GEOSGeometry(json.dumps(geometry), srid=4326).transform(3857, clone=True).json)
+            feature = reproject_features([{ '_id' : 'a', 'geometry' : geometry }], 4326, 3857)[0]
+            self.assertEqual(feature['geometry']['type'], geometry['type'])
+            for (x, y), (ex, ey) in zip(self.positions(feature['geometry']), self.positions(expected)):
+                self.assertAlmostEqual(x, ex, places=3)
+                self.assertAlmostEqual(y, ey, places=3)
+
+    def test_axis_order(self):
+        # 4326 coordinates are longitude, latitude, so Durham is west of Greenwich and north of the equator.
+        x, y = reproject_features([{ 'geometry' : self.geometries[0] }], 4326, 3857)[0]['geometry']['coordinates']
+        self.assertLess(x, -8000000)
+        self.assertGreater(y, 4000000)
+
+        back = reproject_features([{ 'geometry' : { 'type' : 'Point', 'coordinates' : [x, y] } }], 3857, 4326)[0]
+        for a, b in zip(back['geometry']['coordinates'], self.geometries[0]['coordinates']):
+            self.assertAlmostEqual(a, b)
+
+class CompiledPipelineTest(TestCase):
+    pipelines = [
+        (independent.strip_punctuation, independent.lower_case, independent.split_numbers, independent.compose_lhs(independent.split_spaces, independent.trigrams)),
+        (independent.strip_punctuation, independent.lower_case, independent.split_numbers, independent.squeeze_spaces, independent.trigrams),
+        (independent.lower_case, independent.strip_punctuation, independent.split_numbers, independent.compose_lhs(independent.split_spaces, independent.trigrams)),
+        (independent.compose_rhs(independent.strip_punctuation, independent.lower_case), independent.split_numbers, independent.compose_lhs(independent.split_spaces)),
+        (independent.split_numbers, independent.split_spaces),
+        (independent.squeeze_spaces, lambda s: (['x'], s + 'y'), independent.trigrams),
+    ]
+    corpus = [
+        '', ' ', '123 Abc. St., 27707', '3926 Swarthmore Rd Durham NC 27707', '1600 N. Damen Ave., Chicago, IL',
+        'abc123def 45\tG', u'Caf\xe9 12 Rue', '[\\]^_`{|}', 'ab', 'abcd', '  a  b ', '12 34', 'X\nY\r\nZZZZZ', '\xe9\xff abc',
+    ]
+
+    def test_equivalence(self):
+        for pipeline in self.pipelines:
+            composed = independent.compose_rhs(*pipeline)
+            compiled = independent.compile_pipeline(*pipeline)
+            memoized = independent.compile_pipeline(*pipeline, memo=4)
+            for text in self.corpus + self.corpus:
+                self.assertEqual(compiled(text), composed(text), text)
+                self.assertEqual(memoized(text), composed(text), text)
+
+    def test_memo_results_are_copies(self):
+        parser = independent.tokens(independent.compile_pipeline(independent.split_numbers, memo=4))
+        parser('1 2 3').append('4')
+        self.assertListEqual(parser('1 2 3'), ['1', '2', '3'])
+
+class BenchmarkTest(TestCase):
+    def test_synthetic_fixtures(self):
+        features = benchmarks.tract_features(50)
+        self.assertEqual(len(set(code for code, geometry in features)), 50)
+        self.assertEqual(len(benchmarks.tract_points(features, 10)), 10)
+        self.assertEqual(len(set(benchmarks.address_corpus(200))), 200)
+
+    def test_percentile(self):
+        samples = range(1, 101)
+        self.assertEqual(benchmarks.percentile(samples, 0.5), 51)
+        self.assertEqual(benchmarks.percentile(samples, 0.99), 99)
+        self.assertIsNone(benchmarks.percentile([], 0.5))
+
+    def test_parser_benchmark(self):
+        results = benchmarks.bench_parsers(100, 50)
+        for result in results:
+            self.assertEqual(result['ops'], 50)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+
+    def test_without_mongomock(self):
+        has_mongomock = benchmarks.has_mongomock
+        benchmarks.has_mongomock = lambda: False
+        try:
+            results = benchmarks.run(sizes=[100], queries=10, benchmarks=['parsers', 'exact'])
+        finally:
+            benchmarks.has_mongomock = has_mongomock
+        self.assertEqual(results['skipped'], ['exact'])
+        self.assertTrue(all(result['name'].startswith('parsers.') for result in results['results']))
+
 class ExactGeocoderTest(TestCase):
-    test_file = '/Users/jeffersonheard/Source/ga_geocoder/ga_geocoder/fixtures/tl_2010_37063_tract10.shp'
+    test_file = os.path.join(FIXTURES, 'tl_2010_37063_tract10.shp')
     test_layer = 'tl_2010_37063_tract10'
     test_field = 'GEOID10'
     test_codes = ["37063002025","37063002028","37063002024","37063002023"]
@@ -109,11 +411,345 @@ class ExactGeocoderTest(TestCase):
         code = self.coder.reverse_geocode(swarthmore)
         self.assertIsNotNone(code)
 
+    def test_bulk_reverse_geocode(self):
+        points = [(-78.9597, 35.93484), (0, 0), (-78.9597, 35.93484)]
+        k = list(self.coder.bulk_reverse_geocode(points))
+        self.assertListEqual([index for index, code in k], [0, 1, 2])
+        self.assertIsNotNone(k[0][1])
+        self.assertIsNone(k[1][1])
+        self.assertEqual(k[0][1], k[2][1])
+
+    def test_indexed_reverse_geocode(self):
+        swarthmore = Point(-78.9597, 35.93484, srid=4326)
+        self.coder.spatial_index = True
+        try:
+            code = self.coder.reverse_geocode(swarthmore)
+            self.assertIsNotNone(code)
+            self.assertIsNone(self.coder.reverse_geocode(Point(0, 0, srid=4326)))
+        finally:
+            self.coder.spatial_index = False
+
+    def test_parallel_load(self):
+        coder = utils.geocoder_from_ogr(self.test_layer + '_parallel', utils.EXACT, self.test_file, self.test_layer, self.test_field, batch_size=10, workers=2)
+        try:
+            self.assertEqual(sorted(coder.keys()), sorted(self.coder.keys()))
+        finally:
+            coder.drop()
+
     @classmethod
     def tearDownClass(cls):
         """Drop geocoder and confirm it's gone"""
         cls.coder.drop()
 
+class SQLiteBackendTest(TestCase):
+    def setUp(self):
+        self.features = benchmarks.tract_features(100)
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'geocoder.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_exact(self):
+        coder = geocoder.ExactGeocoder('tracts', backend=SQLiteBackend('tracts', path=self.path))
+        self.assertEqual(coder.bulk_load(self.features, lambda x: x), 100)
+
+        code = self.features[5][0]
+        self.assertEqual(coder[code]['properties']['code'], code)
+        self.assertEqual(coder[code]['geometry']['type'], 'Polygon')
+        self.assertEqual(len(list(coder.bulk_geocode([code, self.features[6][0], 'missing']))), 2)
+        self.assertEqual(len(coder.keys()), 100)
+
+        x, y = benchmarks.tract_points(self.features[5:6], 1)[0]
+        self.assertEqual(coder.reverse_geocode(Point(x, y, srid=4326))['_id'], code)
+
+        del coder[code]
+        self.assertRaises(KeyError, lambda: coder[code])
+        coder.drop()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_streaming_bulk_load(self):
+        coder = geocoder.ExactGeocoder('tracts', backend=SQLiteBackend('tracts', path=self.path))
+        pulled = []
+        def source():
+            for code, geometry in self.features:
+                pulled.append(code)
+                yield code, geometry
+
+        # each batch is written before the next is read from the source.
+        progress = []
+        self.assertEqual(coder.bulk_load(source(), lambda x: x, batch_size=30, progress=lambda n, batches: progress.append((n, batches, len(pulled)))), 100)
+        self.assertEqual(progress, [(30, 1, 30), (60, 2, 60), (90, 3, 90), (100, 4, 100)])
+        self.assertEqual(len(coder.keys()), 100)
+
+    def test_ordered_bulk_geocode(self):
+        codes = [self.features[1][0], 'missing', self.features[2][0], self.features[1][0]]
+        for cache in (None, LRUCache(100)):
+            coder = geocoder.ExactGeocoder('tracts', backend=SQLiteBackend('tracts', path=self.path), cache=cache)
+            coder.bulk_load(self.features, lambda x: x)
+            sink = MemorySink()
+            configure(sink)
+            try:
+                k = list(coder.bulk_geocode(codes, ordered=True))
+            finally:
+                configure(None)
+
+            self.assertEqual([code for code, feature in k], codes)
+            self.assertEqual([feature and feature['_id'] for code, feature in k], [codes[0], None, codes[2], codes[0]])
+            self.assertEqual([code for code, feature in coder.bulk_geocode(codes)], [codes[0], codes[2]])
+            self.assertEqual(sink.summary()['exact.db.find']['count'], 1)
+            if cache is not None:
+                self.assertEqual(sink.summary()['exact.cache.miss'], 3)
+            coder.drop()
+
+    def test_prefetch(self):
+        coder = geocoder.ExactGeocoder('tracts', backend=SQLiteBackend('tracts', path=self.path))
+        coder.bulk_load(self.features, lambda x: x)
+        codes = [code for code, geometry in self.features] + ['missing']
+        expected = list(coder.bulk_geocode(codes, ordered=True, prefetch=0, chunk_size=1000))
+        self.assertEqual(list(coder.bulk_geocode(codes, ordered=True, prefetch=3, chunk_size=7)), expected)
+        self.assertEqual(len(list(coder.bulk_geocode(iter(codes)))), 100)
+
+    def test_reopen(self):
+        geocoder.ExactGeocoder('tracts', backend=SQLiteBackend('tracts', path=self.path)).bulk_load(self.features[:10], lambda x: x)
+        coder = geocoder.ExactGeocoder('tracts', backend=SQLiteBackend('tracts', path=self.path))
+        self.assertEqual(len(coder.keys()), 10)
+        self.assertEqual(coder.store['kind'], 'exact')
+
+    def test_trigram(self):
+        addresses = benchmarks.address_corpus(50)
+        geometry = '{"type": "Point", "coordinates": [-78.9597, 35.93484]}'
+        coder = geocoder.TrigramGeocoder('addresses', backend=SQLiteBackend('addresses', path=self.path))
+        coder.bulk_load(dict((a, geometry) for a in addresses), lambda x: x)
+
+        self.assertEqual(coder[addresses[0]]['_id'], addresses[0])
+        fuzzy = coder[addresses[0][:-1]]
+        self.assertEqual(fuzzy['features'][0]['_id'], addresses[0])
+        self.assertEqual(len(coder.query(addresses[0][:-1], limit=3)['features']), 3)
+        self.assertEqual(coder.stats['codes'], 50)
+        self.assertIn('nc', coder.stop)
+
+        # single item writes go straight through to the store by default.
+        del coder[addresses[0]]
+        self.assertFalse(coder.store.existing([addresses[0]]))
+        self.assertNotIn(addresses[0], [code for ngram, code, count in coder.store.postings()])
+
+    def test_trigram_bulk_geocode(self):
+        addresses = benchmarks.address_corpus(50)
+        geometry = '{"type": "Point", "coordinates": [-78.9597, 35.93484]}'
+        coder = geocoder.TrigramGeocoder('addresses', backend=SQLiteBackend('addresses', path=self.path))
+        coder.bulk_load(dict((a, geometry) for a in addresses), lambda x: x)
+
+        calls = Counter()
+        def counted(method):
+            def call(*args):
+                calls[method.__name__] += 1
+                return method(*args)
+            return call
+        coder.store.features = counted(coder.store.features)
+        coder.store.postings = counted(coder.store.postings)
+
+        # exact matches, approximate matches and codes matching nothing, over three chunks.
+        fuzzy = { addresses[7][:-1] : addresses[7], addresses[9][:-1] : addresses[9] }
+        codes = [addresses[3], addresses[7][:-1], 'zzzz qqqq', addresses[9][:-1], addresses[11]] * 500
+        results = list(coder.bulk_geocode(codes))
+        self.assertEqual([code for code, result in results], [code for code in codes if code != 'zzzz qqqq'])
+        for code, result in results[:4]:
+            if code in fuzzy:
+                self.assertEqual(result['type'], 'FeatureCollection')
+                self.assertEqual(result['features'][0]['_id'], fuzzy[code])
+            else:
+                self.assertEqual(result['_id'], code)
+
+        # one query for each chunk's exact matches, one for its postings and one for its candidates.
+        self.assertEqual(calls, Counter(features=6, postings=3))
+
+    def test_incremental_stats(self):
+        addresses = benchmarks.address_corpus(60)
+        geometry = '{"type": "Point", "coordinates": [-78.9597, 35.93484]}'
+        coder = geocoder.TrigramGeocoder('addresses', backend=SQLiteBackend('addresses', path=self.path))
+        coder.bulk_load(dict((a, geometry) for a in addresses[:40]), lambda x: x)
+
+        # a second load counts the ngrams of its own codes, and only those that are new, without rescanning postings.
+        postings = coder.store.postings
+        scans = []
+        def scan(ngrams=None):
+            scans.append(ngrams)
+            return postings(ngrams)
+        coder.store.postings = scan
+        coder.bulk_load(dict((a, geometry) for a in addresses[30:]), lambda x: x)
+        coder.store.postings = postings
+        self.assertNotIn(None, scans)
+
+        df = dict(coder.store['ngram_df'])
+        self.assertEqual(df, dict(Counter(ngram for ngram, code, count in coder.store.postings())))
+        self.assertEqual(coder.stats['codes'], 60)
+
+    def test_delete_and_reload(self):
+        addresses = benchmarks.address_corpus(20)
+        geometry = '{"type": "Point", "coordinates": [-78.9597, 35.93484]}'
+        coder = geocoder.TrigramGeocoder('addresses', backend=SQLiteBackend('addresses', path=self.path))
+        coder.bulk_load(dict((a, geometry) for a in addresses), lambda x: x)
+
+        # single item deletes and writes keep the document frequencies and stats as bulk_load leaves them.
+        del coder[addresses[0]]
+        del coder[addresses[1]]
+        self.assertEqual(coder.stats['codes'], 18)
+        coder.bulk_load({ addresses[0] : geometry }, lambda x: x)
+        coder[addresses[1]] = Point(-78.9597, 35.93484, srid=4326)
+        self.assertEqual(coder.stats['codes'], 20)
+
+        df = dict(coder.store['ngram_df'])
+        self.assertEqual(df, dict(Counter(ngram for ngram, code, count in coder.store.postings())))
+        reopened = geocoder.TrigramGeocoder('addresses', backend=SQLiteBackend('addresses', path=self.path))
+        self.assertEqual(reopened.stop, coder.stop)
+
+    def test_memory_index_reload(self):
+        addresses = benchmarks.address_corpus(20)
+        geometry = '{"type": "Point", "coordinates": [-78.9597, 35.93484]}'
+        coder = geocoder.TrigramGeocoder('addresses', backend=SQLiteBackend('addresses', path=self.path), memory_index=True)
+        coder.bulk_load(dict((a, geometry) for a in addresses[:15]), lambda x: x)
+        query = addresses[0][:-1]
+        scores = [f['properties']['score'] for f in coder.query(query)['features']]
+
+        # reloading codes that are already stored leaves their scores as they were, and new codes are found.
+        coder.bulk_load(dict((a, geometry) for a in addresses[:5]), lambda x: x)
+        self.assertEqual([f['properties']['score'] for f in coder.query(query)['features']], scores)
+        coder.bulk_load(dict((a, geometry) for a in addresses[10:]), lambda x: x)
+        rebuilt = geocoder.TrigramGeocoder('addresses', backend=SQLiteBackend('addresses', path=self.path), memory_index=True)
+        self.assertEqual(coder.query(query), rebuilt.query(query))
+        self.assertEqual(coder.query(addresses[19][:-1])['features'][0]['_id'], addresses[19])
+
+    def test_misspelled_stop_ngrams(self):
+        addresses = benchmarks.address_corpus(200)
+        geometry = '{"type": "Point", "coordinates": [-78.9597, 35.93484]}'
+        coder = geocoder.TrigramGeocoder('addresses', backend=SQLiteBackend('addresses', path=self.path))
+        coder.bulk_load(dict((a, geometry) for a in addresses), lambda x: x)
+
+        # the only ngram of the query that is not a stop ngram is one no code has, so it is searched for by all of them.
+        query = 'Chicgo IL 60622'
+        self.assertEqual([ngram for ngram in coder.parser(query) if ngram not in coder.stop], ['icg'])
+        features = coder.query(query)['features']
+        self.assertTrue(features)
+        self.assertTrue(all('Chicago IL 60622' in f['_id'] for f in features))
+        self.assertTrue(dict(coder.bulk_geocode([query]))[query]['features'])
+
+    def test_rerank(self):
+        addresses = benchmarks.address_corpus(50)
+        geometry = '{"type": "Point", "coordinates": [-78.9597, 35.93484]}'
+        coder = geocoder.TrigramGeocoder('addresses', backend=SQLiteBackend('addresses', path=self.path), rerank=20, threshold=0.9)
+        coder.bulk_load(dict((a, geometry) for a in addresses), lambda x: x)
+
+        query = benchmarks.misspell(addresses[0], random.Random(0))
+        features = coder.query(query)['features']
+        self.assertEqual(features[0]['_id'], addresses[0])
+        self.assertEqual(features[0]['properties']['score'], similarity(normalize(query), normalize(addresses[0])))
+        self.assertTrue(all(f['properties']['score'] >= 0.9 for f in features))
+
+        matches = dict(coder.bulk_geocode([query]))
+        self.assertEqual(matches[query]['features'][0]['_id'], addresses[0])
+
+    def test_write_buffer(self):
+        geometry = Point(-78.9597, 35.93484, srid=4326)
+        coder = geocoder.TrigramGeocoder('addresses', backend=SQLiteBackend('addresses', path=self.path), flush_size=3, flush_interval=60)
+        coder.bulk_load({ '1 Main St Durham NC' : geometry })
+        postings = sorted(coder.store.postings())
+
+        coder['2 Main St Durham NC'] = geometry
+        coder['1 Main St Durham NC'] = Point(-78, 35, srid=4326)
+        self.assertEqual(len(coder._pending), 2)
+        self.assertFalse(coder.store.existing(['2 Main St Durham NC']))
+
+        # reads see buffered writes, and rewriting a code leaves its postings as they were.
+        self.assertEqual(coder['1 Main St Durham NC']['geometry']['coordinates'], [-78, 35])
+        self.assertFalse(coder._pending)
+        del coder['2 Main St Durham NC']
+        coder.flush()
+        self.assertEqual(sorted(coder.store.postings()), postings)
+
+        for n in range(3):
+            coder['{n} Elm St Durham NC'.format(n=n)] = geometry
+        self.assertFalse(coder._pending)
+        self.assertEqual(len(coder.store.codes()), 4)
+
+class LevelOfDetailTest(TestCase):
+    def setUp(self):
+        self.features = benchmarks.tract_features(20)
+        self.path = tempfile.mktemp(suffix='.sqlite')
+        self.coder = geocoder.ExactGeocoder('tracts', backend=SQLiteBackend('tracts', path=self.path), tolerances=[0.001, 0.004])
+        self.coder.bulk_load(self.features, lambda x: x)
+        self.code = self.features[3][0]
+
+    def tearDown(self):
+        self.coder.drop()
+
+    def test_variants(self):
+        full = self.coder[self.code]
+        self.assertNotIn('variants', full)
+        self.assertEqual(self.coder[self.code, None, geocoder.ExactGeocoder.CENTROID]['geometry']['type'], 'Point')
+        self.assertEqual(len(self.coder[self.code, None, geocoder.ExactGeocoder.BBOX]['geometry']['coordinates'][0]), 5)
+
+        simplified = self.coder[self.code, None, 1]
+        self.assertEqual(simplified['properties'], full['properties'])
+        self.assertLess(len(simplified['geometry']['coordinates'][0]), len(full['geometry']['coordinates'][0]))
+
+    def test_bulk_geocode(self):
+        codes = [code for code, geometry in self.features[:5]]
+        k = list(self.coder.bulk_geocode(codes, detail=geocoder.ExactGeocoder.CENTROID))
+        self.assertEqual(len(k), 5)
+        for code, feature in k:
+            self.assertEqual(feature['geometry']['type'], 'Point')
+
+    def test_unknown_detail(self):
+        self.assertRaises(ValueError, lambda: self.coder[self.code, None, 2])
+        self.assertEqual(geocoder.ExactGeocoder('tracts', backend=SQLiteBackend('tracts', path=self.path)).tolerances, [0.001, 0.004])
+
+class SnapshotGeocoderTest(TestCase):
+    def setUp(self):
+        self.features = benchmarks.tract_features(200)
+        self.dir = tempfile.mkdtemp()
+        self.db = os.path.join(self.dir, 'tracts.sqlite')
+        self.path = os.path.join(self.dir, 'tracts.snapshot')
+        coder = geocoder.ExactGeocoder('tracts', backend=SQLiteBackend('tracts', path=self.db))
+        coder.bulk_load(self.features, lambda x: x)
+        self.assertEqual(coder.export_snapshot(self.path), 200)
+        coder.drop()
+        self.coder = geocoder.SnapshotGeocoder(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_lookup(self):
+        self.assertEqual(len(self.coder), 200)
+        for code, geometry in self.features[::17]:
+            self.assertEqual(self.coder[code]['_id'], code)
+            self.assertEqual(json.loads(str(self.coder.raw(code)))['_id'], code)
+        self.assertRaises(KeyError, lambda: self.coder['37063999999'])
+        self.assertEqual(sorted(self.coder.keys()), sorted(code for code, geometry in self.features))
+
+    def test_bulk_geocode(self):
+        codes = [code for code, geometry in self.features[:10]] + ['missing']
+        self.assertEqual([code for code, feature in self.coder.bulk_geocode(codes)], codes[:-1])
+        ordered = list(self.coder.bulk_geocode(codes + codes[:1], ordered=True))
+        self.assertEqual([feature and feature['_id'] for code, feature in ordered], codes[:-1] + [None, codes[0]])
+
+    def test_reverse_geocode(self):
+        for feature in self.features[::23]:
+            x, y = benchmarks.tract_points([feature], 1)[0]
+            self.assertEqual(self.coder.reverse_geocode(Point(x, y, srid=4326))['_id'], feature[0])
+        self.assertIsNone(self.coder.reverse_geocode(Point(0, 0, srid=4326)))
+
+    def test_read_only(self):
+        def assign():
+            self.coder['37063000001'] = None
+        self.assertRaises(TypeError, assign)
+
+    def test_no_levels_of_detail(self):
+        code = self.features[0][0]
+        self.assertEqual(self.coder[code, None, None]['_id'], code)
+        self.assertRaises(ValueError, lambda: self.coder[code, None, geocoder.ExactGeocoder.CENTROID])
+        self.assertRaises(ValueError, lambda: list(self.coder.bulk_geocode([code], detail=0)))
+
 class OSMGeocoderTest(TestCase):
     address = "3926 Swarthmore Rd Durham NC 27707"
     test_addresses = [
@@ -142,4 +778,337 @@ class OSMGeocoderTest(TestCase):
     def test_reverse_geocode(self):
         swarthmore = Point(-78.9597, 35.93484, srid=4326)
         code = self.coder.reverse_geocode(swarthmore)
-        self.assertIsNotNone(code)
\ No newline at end of file
+        self.assertIsNotNone(code)
+
+class ConcurrentOSMGeocoderTest(TestCase):
+    test_addresses = ["{n} Swarthmore Rd Durham NC 27707".format(n=n) for n in range(50)] + ["nowhere at all"]
+
+    def setUp(self):
+        self.nominatim = StubNominatim().start()
+        self.coder = geocoder.OpenStreetMapGeocoder(urls=[self.nominatim.url], max_in_flight=8, rate=None)
+
+    def tearDown(self):
+        self.nominatim.stop()
+
+    def test_bulk_geocode_concurrent(self):
+        k = list(self.coder.bulk_geocode_concurrent(self.test_addresses))
+        self.assertEqual(sorted(index for index, name, location in k), range(len(self.test_addresses)))
+        for index, name, location in k:
+            self.assertEqual(name, self.test_addresses[index])
+            if name.startswith('nowhere'):
+                self.assertIsNone(location)
+            else:
+                self.assertEqual(location['properties']['display_name'], name)
+
+    def test_retry(self):
+        self.nominatim.failures = 2
+        for endpoint in self.coder.endpoints:
+            endpoint.backoff = 0.01
+        self.assertIsNotNone(self.coder[self.test_addresses[0]])
+        self.assertEqual(self.nominatim.requests, 3)
+
+    def test_retries_exhausted(self):
+        self.nominatim.failures = 100
+        for endpoint in self.coder.endpoints:
+            endpoint.backoff = 0.01
+        with self.assertRaises(IOError):
+            list(self.coder.bulk_geocode_concurrent(self.test_addresses))
+
+    def test_response_cache(self):
+        path = tempfile.mkdtemp()
+        try:
+            self.coder.cache = SQLiteCache(os.path.join(path, 'responses.sqlite'))
+            self.coder[self.test_addresses[0]]
+            self.coder[' ' + self.test_addresses[0].upper()]
+            self.assertRaises(KeyError, lambda: self.coder['nowhere at all'])
+            self.assertRaises(KeyError, lambda: self.coder['Nowhere  at all'])
+            self.assertEqual(self.nominatim.requests, 2)
+            self.assertEqual(self.coder.cache.stats()['hits'], 2)
+        finally:
+            shutil.rmtree(path)
+
+class GeocodeFileTest(TestCase):
+    def setUp(self):
+        self.features = benchmarks.tract_features(30)
+        self.path = tempfile.mktemp(suffix='.sqlite')
+        self.coder = geocoder.ExactGeocoder('tracts', backend=SQLiteBackend('tracts', path=self.path))
+        self.coder.bulk_load(self.features, lambda x: x)
+        self.codes = [code for code, geometry in self.features] * 2 + ['37063999999']
+
+        self.input = tempfile.mktemp(suffix='.csv')
+        with open(self.input, 'wb') as f:
+            f.write('id,tract\n' + ''.join('{i},{code}\n'.format(i=i, code=code) for i, code in enumerate(self.codes)))
+        self.output = tempfile.mktemp()
+        self.rejects = tempfile.mktemp(suffix='.csv')
+
+    def tearDown(self):
+        self.coder.drop()
+        for path in (self.input, self.output, self.rejects):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_csv(self):
+        progress = []
+        n = utils.geocode_file(self.coder, self.input, self.output, column='tract', output_format=utils.CSV,
+                               rejects_filename=self.rejects, progress=lambda *args: progress.append(args), progress_every=20)
+        self.assertEqual(n, (61, 60))
+        self.assertEqual([rows for rows, matched, seconds in progress], [20, 40, 60, 61])
+
+        with open(self.output, 'rb') as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual([row['id'] for row in rows], [str(i) for i in range(60)])
+        self.assertEqual([row['match'] for row in rows], self.codes[:-1])
+        self.assertTrue(rows[0]['wkt'].startswith('POLYGON'))
+        with open(self.rejects, 'rb') as f:
+            self.assertEqual(list(csv.DictReader(f)), [{ 'id' : '60', 'tract' : '37063999999' }])
+
+    def test_geojsonseq(self):
+        utils.geocode_file(self.coder, self.input, self.output, column='tract')
+        with open(self.output, 'rb') as f:
+            records = f.read().split('\x1e')[1:]
+        features = [json.loads(record) for record in records]
+        self.assertEqual(len(features), 60)
+        self.assertEqual(features[3]['properties'], { 'id' : '3', 'tract' : self.codes[3], 'match' : self.codes[3], 'score' : None })
+        self.assertEqual(features[3]['geometry']['type'], 'Polygon')
+
+class GeocodeJobTest(TestCase):
+    test_addresses = ["{n} Swarthmore Rd Durham NC 27707".format(n=n) for n in range(40)] + ["nowhere at all"]
+
+    def setUp(self):
+        self.eager = current_app.conf.CELERY_ALWAYS_EAGER
+        current_app.conf.CELERY_ALWAYS_EAGER = True
+        self.nominatim = StubNominatim().start()
+        self.spec = { 'kind' : 'osm', 'urls' : [self.nominatim.url], 'rate' : None, 'retries' : 0 }
+        self.dir = tempfile.mkdtemp()
+        self.output = os.path.join(self.dir, 'results.json')
+
+    def tearDown(self):
+        current_app.conf.CELERY_ALWAYS_EAGER = self.eager
+        self.nominatim.stop()
+        shutil.rmtree(self.dir)
+
+    def results(self):
+        with open(self.output) as f:
+            return [json.loads(line) for line in f]
+
+    def test_file_job(self):
+        path = tempfile.mktemp(suffix='.txt')
+        with open(path, 'w') as f:
+            f.write('\n'.join(self.test_addresses) + '\n')
+        try:
+            job = tasks.geocode_job(self.spec, path=path, output=self.output, shard_bytes=100)
+            self.assertEqual(job.get(), { 'shards' : len(job.shard_ids), 'rows' : 41, 'found' : 40 })
+            self.assertGreater(len(job.shard_ids), 10)
+            self.assertEqual(job.progress()['rows'], 41)
+        finally:
+            os.remove(path)
+
+        results = self.results()
+        self.assertEqual([r['input'] for r in results], self.test_addresses)
+        self.assertEqual(results[0]['result']['properties']['display_name'], self.test_addresses[0])
+        self.assertIsNone(results[-1]['result'])
+        self.assertFalse([name for name in os.listdir(os.path.dirname(self.output)) if name.startswith(os.path.basename(self.output) + '.')])
+
+    def test_retry(self):
+        self.nominatim.failures = 1
+        job = tasks.geocode_job(self.spec, inputs=self.test_addresses, output=self.output, shard_size=10, retry_delay=0)
+        self.assertEqual(job.get()['rows'], 41)
+        self.assertEqual([r['input'] for r in self.results()], self.test_addresses)
+
+    def test_retries_exhausted(self):
+        self.nominatim.failures = 1000
+        job = lambda: tasks.geocode_job(self.spec, inputs=self.test_addresses, output=self.output, shard_size=10, retries=1, retry_delay=0)
+        self.assertRaises(IOError, lambda: job().get())
+        self.assertFalse(os.listdir(self.dir))
+
+class HTTPTest(TestCase):
+    urls = 'ga_geocoder.urls'
+
+    def setUp(self):
+        self.features = benchmarks.tract_features(20)
+        self.path = tempfile.mktemp(suffix='.sqlite')
+        self.nominatim = StubNominatim().start()
+        self.services = app_settings.GEOCODER_SERVICES
+        app_settings.GEOCODER_SERVICES = {
+            'tracts' : { 'kind' : 'exact', 'name' : 'tracts', 'backend' : SQLiteBackend('tracts', path=self.path) },
+            'osm' : { 'kind' : 'osm', 'urls' : [self.nominatim.url], 'rate' : None },
+        }
+        registry.forget()
+        views._geocoder('tracts').bulk_load(self.features, lambda x: x)
+
+    def tearDown(self):
+        views._geocoder('tracts').drop()
+        registry.forget()
+        app_settings.GEOCODER_SERVICES = self.services
+        self.nominatim.stop()
+
+    def lines(self, response):
+        content = ''.join(response.streaming_content) if getattr(response, 'streaming', False) else response.content
+        return [json.loads(line) for line in content.splitlines()]
+
+    def test_geocode(self):
+        code = self.features[4][0]
+        response = self.client.get('/tracts/geocode/', { 'q' : code })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['_id'], code)
+        self.assertIn('max-age=3600', response['Cache-Control'])
+
+        cached = self.client.get('/tracts/geocode/', { 'q' : code }, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+        missing = self.client.get('/tracts/geocode/', { 'q' : '<script>alert(1)</script>' })
+        self.assertEqual(missing.status_code, 404)
+        self.assertTrue(missing['Content-Type'].startswith('text/plain'))
+        self.assertEqual(self.client.get('/missing/geocode/', { 'q' : code }).status_code, 404)
+        self.assertEqual(self.client.get('/osm/geocode/', { 'q' : '1 Main St' }).status_code, 200)
+
+    def test_reverse_geocode(self):
+        x, y = benchmarks.tract_points(self.features[2:3], 1)[0]
+        response = self.client.get('/tracts/reverse/', { 'x' : x, 'y' : y })
+        self.assertEqual(json.loads(response.content)['_id'], self.features[2][0])
+        self.assertEqual(self.client.get('/tracts/reverse/', { 'x' : 0, 'y' : 0 }).status_code, 404)
+        self.assertEqual(self.client.get('/tracts/reverse/', { 'x' : 0 }).status_code, 400)
+
+    def test_bulk_geocode(self):
+        codes = [self.features[1][0], '37063999999', self.features[1][0]]
+        response = self.client.post('/tracts/geocode/batch/', '\n'.join(codes), content_type='text/plain')
+        results = self.lines(response)
+        self.assertEqual([r['input'] for r in results], codes)
+        self.assertEqual([r['result'] and r['result']['_id'] for r in results], [codes[0], None, codes[0]])
+
+        response = self.client.post('/osm/geocode/batch/', 'somewhere\nnowhere at all', content_type='text/plain')
+        self.assertEqual([r['result'] is None for r in self.lines(response)], [False, True])
+        self.assertEqual(self.client.get('/tracts/geocode/batch/').status_code, 405)
+
+    def test_bulk_reverse_geocode(self):
+        points = benchmarks.tract_points(self.features, 5) + [(0, 0)]
+        response = self.client.post('/tracts/reverse/batch/', '\n'.join('{x},{y}'.format(x=x, y=y) for x, y in points), content_type='text/plain')
+        codes = [r['code'] for r in self.lines(response)]
+        self.assertEqual(len(codes), 6)
+        self.assertTrue(all(codes[:5]))
+        self.assertIsNone(codes[5])
+        self.assertEqual(self.client.post('/tracts/reverse/batch/', '1;2', content_type='text/plain').status_code, 400)
+
+        # geocoders without a bulk reverse path are asked point by point.
+        response = self.client.post('/osm/reverse/batch/', '-78.9597,35.93484\n-79.5,36', content_type='text/plain')
+        self.assertEqual([r['code'] for r in self.lines(response)], ['-78.9597,35.9348,0', '-79.5000,36.0000,0'])
+
+class _ReadOnlyMetadata(SQLiteBackend):
+    def __setitem__(self, key, value):
+        raise AssertionError('wrote {key}'.format(key=key))
+
+class RegistryTest(TestCase):
+    def setUp(self):
+        self.settings = app_settings.GEO_INDEX_PATH, app_settings.GEOCODER_BACKEND
+        app_settings.GEO_INDEX_PATH = tempfile.mkdtemp()
+        app_settings.GEOCODER_BACKEND = 'ga_geocoder.backends.SQLiteBackend'
+        registry.forget()
+        self.coder = geocoder.ExactGeocoder('tracts', case_sensitive=True)
+        self.coder.bulk_load(benchmarks.tract_features(10), lambda x: x)
+
+    def tearDown(self):
+        registry.forget()
+        self.coder.drop()
+        os.rmdir(app_settings.GEO_INDEX_PATH)
+        app_settings.GEO_INDEX_PATH, app_settings.GEOCODER_BACKEND = self.settings
+
+    def test_open(self):
+        coder = registry.open_geocoder('tracts')
+        self.assertIsInstance(coder, geocoder.ExactGeocoder)
+        self.assertIs(coder.parse, self.coder.parse)
+        self.assertEqual(len(coder.keys()), 10)
+        self.assertIs(registry.open_geocoder('tracts'), coder)
+
+        registry.forget('tracts')
+        self.assertIsNot(registry.open_geocoder('tracts'), coder)
+
+    def test_no_write_on_open(self):
+        coder = geocoder.ExactGeocoder('tracts', backend=_ReadOnlyMetadata('tracts'))
+        self.assertIs(coder.parse, self.coder.parse)
+
+    def test_no_write_on_open_legacy(self):
+        # a store created before geocoders had levels of detail has no tolerances.
+        legacy = SQLiteBackend('legacy')
+        for key, value in (('kind', 'exact'), ('name', 'legacy'), ('case_sensitive', False), ('long_codes', False)):
+            legacy[key] = value
+        try:
+            coder = geocoder.ExactGeocoder('legacy', tolerances=[0.01], backend=_ReadOnlyMetadata('legacy'))
+            self.assertIsNone(coder.tolerances)
+            self.assertIsNone(registry.open_geocoder('legacy').tolerances)
+            self.assertNotIn('tolerances', legacy)
+        finally:
+            legacy.drop()
+
+    def test_missing(self):
+        self.assertRaises(KeyError, lambda: registry.open_geocoder('tracts_missing'))
+        self.assertFalse(SQLiteBackend.exists('tracts_missing'))
+
+    def test_services_only(self):
+        self.assertRaises(KeyError, lambda: registry.open_service('tracts'))
+        self.assertIsNone(views._geocoder('tracts'))
+        self.assertRaises(KeyError, lambda: registry.open_service('tracts_missing'))
+        self.assertFalse(SQLiteBackend.exists('tracts_missing'))
+
+        services = app_settings.GEOCODER_SERVICES
+        app_settings.GEOCODER_SERVICES = { 'tracts' : None }
+        try:
+            self.assertIs(views._geocoder('tracts'), registry.open_geocoder('tracts'))
+            self.assertEqual(len(views._geocoder('tracts').keys()), 10)
+        finally:
+            app_settings.GEOCODER_SERVICES = services
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        self.sink = MemorySink()
+        configure(self.sink)
+
+    def tearDown(self):
+        configure(None)
+
+    def test_parse_timer(self):
+        en_us.address_trigrams_naive('1 Swarthmore Rd Durham NC 27707')
+        en_us.address_trigrams_naive('')
+        summary = self.sink.summary()
+        self.assertEqual(summary['parse']['count'], 1)
+        self.assertGreaterEqual(summary['parse']['max'], 0)
+
+    def test_http_phases(self):
+        with StubNominatim(failures=1) as nominatim:
+            coder = geocoder.OpenStreetMapGeocoder(urls=[nominatim.url], rate=None, cache=LRUCache())
+            coder.endpoints[0].backoff = 0.01
+            coder['1 Swarthmore Rd Durham NC 27707']
+            coder['1 Swarthmore Rd Durham NC 27707']
+
+        summary = self.sink.summary()
+        self.assertEqual(summary['osm.http']['count'], 2)
+        self.assertEqual(summary['osm.http.503'], 1)
+        self.assertEqual(summary['osm.http.200'], 1)
+        self.assertEqual(summary['osm.http.retry'], 1)
+        self.assertEqual(summary['osm.cache.hit'], 1)
+        self.assertEqual(summary['osm.cache.miss'], 1)
+
+    def test_db_counts(self):
+        path = tempfile.mktemp(suffix='.sqlite')
+        features = benchmarks.tract_features(10)
+        exact = geocoder.ExactGeocoder('tracts', backend=SQLiteBackend('tracts', path=path))
+        exact.bulk_load(features, lambda x: x)
+        exact[features[0][0]]
+        list(exact.bulk_geocode([code for code, geometry in features[:4]] + ['missing']))
+        exact.drop()
+
+        addresses = benchmarks.address_corpus(10)
+        trigram = geocoder.TrigramGeocoder('addresses', backend=SQLiteBackend('addresses', path=path))
+        trigram.bulk_load(dict((a, features[0][1]) for a in addresses), lambda x: x)
+        found = trigram.query(addresses[0][:-1])['features']
+        trigram.drop()
+
+        summary = self.sink.summary()
+        self.assertEqual(summary['exact.db.find']['count'], 2)
+        self.assertEqual(summary['exact.db.docs'], 5)
+        self.assertEqual(summary['trigram.db.find']['count'], 1)
+        self.assertEqual(summary['trigram.db.docs'], len(found))
+        self.assertGreater(summary['trigram.db.postings.docs'], 0)
+
+    def test_off(self):
+        configure(None)
+        en_us.address_trigrams_naive('1 Swarthmore Rd Durham NC 27707')
+        self.assertEqual(self.sink.summary(), {})
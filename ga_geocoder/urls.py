@@ -1,5 +1,8 @@
 from django.conf.urls.defaults import patterns, include, url
 
-urlpatterns = patterns('',
-    # url(r'^thingie/', include(api.urls)), 
+urlpatterns = patterns('ga_geocoder.views',
+    url(r'^(?P<name>[\w.-]+)/geocode/$', 'geocode', name='ga_geocoder_geocode'),
+    url(r'^(?P<name>[\w.-]+)/geocode/batch/$', 'bulk_geocode', name='ga_geocoder_bulk_geocode'),
+    url(r'^(?P<name>[\w.-]+)/reverse/$', 'reverse_geocode', name='ga_geocoder_reverse_geocode'),
+    url(r'^(?P<name>[\w.-]+)/reverse/batch/$', 'bulk_reverse_geocode', name='ga_geocoder_bulk_reverse_geocode'),
 )
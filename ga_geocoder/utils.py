@@ -1,5 +1,12 @@
+from collections import deque
+from django.contrib.gis.geos import GEOSGeometry
 from osgeo import osr, ogr
-from ga_geocoder.geocoder import ExactGeocoder
+from ga_geocoder.geocoder import ExactGeocoder, bulk_results
+from ga_geocoder.instrumentation import metrics
+import csv
+import json
+import multiprocessing
+import time
 
 EXACT=0
 
@@ -7,7 +14,8 @@ from logging import getLogger
 
 log = getLogger(__name__)
 
-def geocoder_from_ogr(name, method, ogr_filename, layer, field, srid=4326, append=False, case_sensitive=False, long_codes=False):
+def _open_layer(ogr_filename, layer, srid):
+    """Open a layer of an OGR dataset and create a coordinate transformation from it to the target srid"""
     ds = ogr.Open(ogr_filename)
 
     if not ds:
@@ -21,22 +29,196 @@ def geocoder_from_ogr(name, method, ogr_filename, layer, field, srid=4326, appen
     s_srs = layer.GetSpatialRef()
     crx = osr.CoordinateTransformation(s_srs, t_srs)
 
-    coding = {}
-    for feature in layer:
+    # the datasource has to outlive the layer, so hand it back to the caller to hold on to.
+    return ds, layer, crx
+
+def _read_features(features, field, crx):
+    for feature in features:
         code = feature.__getattr__(field)
 
         if code:
             g = feature.GetGeometryRef()
-            g.Transform(crx)
-            coding[code] = g.ExportToJson()
+            with metrics.timer('ogr.transform'):
+                g.Transform(crx)
+            with metrics.timer('ogr.serialize'):
+                geojson = g.ExportToJson()
+            metrics.incr('ogr.features')
+            yield code, geojson
+
+# the datasource, layer and coordinate transformation of a worker process, opened once by _open_worker.
+_worker = None
+
+def _open_worker(ogr_filename, layer, srid):
+    global _worker
+    _worker = _open_layer(ogr_filename, layer, srid)
+
+def _read_range(args):
+    """Read, transform and serialize the features at indexes [start, stop) of a layer.  Runs in a worker process, with
+    the layer opened by _open_worker."""
+    field, start, stop = args
+    ds, layer, crx = _worker
+    layer.SetNextByIndex(start)
+
+    def features():
+        for _ in xrange(start, stop):
+            feature = layer.GetNextFeature()
+            if feature is None:
+                break
+            yield feature
+
+    return list(_read_features(features(), field, crx))
+
+def _read_parallel(ogr_filename, layer, field, srid, count, workers, batch_size):
+    """Read a layer's features in ranges of batch_size across a pool of worker processes, yielding them in layer order.
+    At most two ranges per worker are in flight, so a slow writer holds back the readers."""
+    pool = multiprocessing.Pool(workers, initializer=_open_worker, initargs=(ogr_filename, layer, srid))
+    try:
+        pending = deque()
+        for start in xrange(0, count, batch_size):
+            pending.append(pool.apply_async(_read_range, ((field, start, start + batch_size),)))
+            if len(pending) >= workers * 2:
+                for item in pending.popleft().get():
+                    yield item
+        while pending:
+            for item in pending.popleft().get():
+                yield item
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    pool.join()
+
+def geocoder_from_ogr(name, method, ogr_filename, layer, field, srid=4326, append=False, case_sensitive=False, long_codes=False, batch_size=1000, progress=None, workers=1, tolerances=None):
+    """Create a geocoder from a layer of an OGR dataset, using field as the code for each feature.  Features are streamed
+    from the layer into the geocoder batch_size at a time, and progress, if given, is called as progress(features,
+    batches) after every batch.  With more than one worker, features are read, transformed and serialized by a pool of
+    worker processes, each working on a range of the layer's features.  If tolerances are given, each feature is also
+    stored with a centroid, a bounding box and geometries simplified to those tolerances."""
+    ds, lyr, crx = _open_layer(ogr_filename, layer, srid)
 
-    log.info("Ingested {n} codes".format(n=len(coding)))
+    if workers > 1:
+        # reading in ranges needs the feature count, and a driver that can seek to a feature without reading the ones
+        # before it.  Otherwise every range costs as much as reading the layer up to it.
+        count = lyr.GetFeatureCount()
+        if count < 0 or not lyr.TestCapability(ogr.OLCFastSetNextByIndex):
+            log.warning("{layer} can't be read in ranges; reading it in one process".format(layer=layer))
+            workers = 1
+
+    if workers > 1:
+        features = _read_parallel(ogr_filename, layer, field, srid, count, workers, batch_size)
+    else:
+        features = _read_features(lyr, field, crx)
 
     if method == EXACT:
-        coder = ExactGeocoder(name, case_sensitive, long_codes, srid, clear=not append)
-        coder.bulk_load(coding, lambda x: x)
+        coder = ExactGeocoder(name, case_sensitive, long_codes, srid, clear=not append, tolerances=tolerances)
+        n = coder.bulk_load(features, lambda x: x, batch_size=batch_size, progress=progress)
     else:
         raise NotImplemented("Only exact geocoders are supported at this time")
 
+    log.info("Ingested {n} codes".format(n=n))
+
+    return coder
+
+#: Input and output file formats for geocode_file
+CSV='csv'
+LINES='lines'
+GEOJSONSEQ='geojsonseq'
+
+def _match(result):
+    """The best feature of a geocoding result, which may be a feature collection of approximate matches"""
+    if result.get('type') == 'FeatureCollection':
+        return result['features'][0]
+    return result
+
+class _GeoJSONSeqWriter(object):
+    """Writes a GeoJSON text sequence (RFC 8142): each row's properties with its match's geometry, one feature a line"""
+
+    def __init__(self, f, fields):
+        self.f = f
+
+    def write(self, row, match):
+        self.f.write('\x1e' + json.dumps({
+            'type' : 'Feature',
+            'geometry' : match.get('geometry'),
+            'properties' : dict(row, match=match.get('_id'), score=match.get('properties', {}).get('score')),
+        }) + '\n')
+
+class _CSVWriter(object):
+    """Writes each row's columns, followed by the code of its match and its match's geometry as WKT"""
+
+    def __init__(self, f, fields):
+        self.writer = csv.writer(f)
+        self.fields = fields
+        self.writer.writerow(fields + ['match', 'wkt'])
+
+    def write(self, row, match):
+        geometry = match.get('geometry')
+        wkt = GEOSGeometry(json.dumps(geometry)).wkt if geometry else ''
+        self.writer.writerow([row[field] for field in self.fields] + [match.get('_id', ''), wkt])
+
+def _read_rows(f, input_format, column):
+    """Return the field names of an input file and an iterator of its rows, as dicts, and the column to geocode"""
+    if input_format == CSV:
+        reader = csv.DictReader(f)
+        fields = reader.fieldnames or []
+        if column not in fields:
+            raise ValueError("no column {column} in the input; columns are {fields}".format(column=column, fields=fields))
+        return fields, reader, column
+
+    return ['input'], ({ 'input' : line.rstrip('\r\n') } for line in f), 'input'
+
+def geocode_file(coder, input_filename, output_filename, column=None, input_format=CSV, output_format=GEOJSONSEQ, srid=None, rejects_filename=None, progress=None, progress_every=10000):
+    """Geocode every row of a CSV file, or every line of a text file, through a geocoder's bulk path, writing each row
+    with the geometry of its match as it goes.  Rows are read only as far ahead of the results as the geocoder fetches,
+    so memory use does not depend on the size of the input.
+
+    :param column: the CSV column to geocode.
+    :param output_format: GEOJSONSEQ, for a GeoJSON text sequence of features with the rows as their properties, or CSV,
+        for the rows' columns followed by the code of their match and its geometry as WKT.
+    :param srid: the srid to write geometries in.  Defaults to the geocoder's.
+    :param rejects_filename: if given, rows with no match are written here, in the input's format.  Otherwise they are
+        dropped.
+    :param progress: if given, called as progress(rows, matched, seconds) every progress_every rows and at the end.
+    :return: the number of rows read and of rows matched.
+    """
+    with open(input_filename, 'rb') as input, open(output_filename, 'wb') as output:
+        fields, rows, column = _read_rows(input, input_format, column)
+        writer = (_CSVWriter if output_format == CSV else _GeoJSONSeqWriter)(output, fields)
+
+        rejects = open(rejects_filename, 'wb') if rejects_filename else None
+        if rejects and input_format == CSV:
+            reject = csv.DictWriter(rejects, fields)
+            reject.writeheader()
+            reject = reject.writerow
+        elif rejects:
+            reject = lambda row: rejects.write(row['input'] + '\n')
+
+        # the rows whose values are with the geocoder, waiting for their results, which come back in the same order.
+        pending = deque()
+        def values():
+            for row in rows:
+                pending.append(row)
+                yield row[column]
+
+        started = time.time()
+        n = matched = 0
+        try:
+            for value, result in bulk_results(coder, values(), srid):
+                row = pending.popleft()
+                n += 1
+                if result:
+                    matched += 1
+                    writer.write(row, _match(result))
+                elif rejects:
+                    reject(row)
+                if progress and not n % progress_every:
+                    progress(n, matched, time.time() - started)
+        finally:
+            if rejects:
+                rejects.close()
 
-    return coder
\ No newline at end of file
+    if progress:
+        progress(n, matched, time.time() - started)
+    log.info("Geocoded {n} rows, {matched} matched".format(n=n, matched=matched))
+    return n, matched
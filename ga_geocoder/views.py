@@ -1 +1,139 @@
-# Create your views here.
+from django.contrib.gis.geos import Point
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotFound, HttpResponseNotModified
+from django.utils.cache import patch_cache_control
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+from ga_geocoder import app_settings, registry
+from ga_geocoder.geocoder import bulk_results
+from hashlib import md5
+from itertools import izip
+import json
+
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # before Django 1.5, an HttpResponse streams an iterator it is given as long as no middleware reads its content.
+    StreamingHttpResponse = HttpResponse
+
+from logging import getLogger
+
+log = getLogger(__name__)
+
+# HTTP geocoding against the geocoders named in app_settings.GEOCODER_SERVICES, opened through ga_geocoder.registry.
+# Any other name is a 404, whether or not a geocoder is stored under it:
+#
+#   GET  <name>/geocode/?q=...[&srid=...]          the feature for q
+#   GET  <name>/reverse/?x=...&y=...[&srid=...]    the feature at a point, given in srid or 4326
+#   POST <name>/geocode/batch/[?srid=...]          one input per line of the body
+#   POST <name>/reverse/batch/[?srid=...]          one "x,y" point per line of the body
+#
+# Single lookups are cacheable, with an ETag and a Cache-Control max-age of app_settings.GEOCODER_HTTP_MAX_AGE.  Batch
+# responses are streamed as a line of JSON for each input, in input order, as the geocoder's bulk path produces them.
+
+NDJSON = 'application/x-ndjson'
+# error messages quote what the client sent, so they are never served as HTML.
+TEXT = 'text/plain; charset=utf-8'
+
+def _geocoder(name):
+    """The geocoder served as name, or None if there is no such service"""
+    try:
+        return registry.open_service(name)
+    except KeyError:
+        return None
+
+def _srid(request):
+    srid = request.GET.get('srid')
+    return int(srid) if srid else None
+
+def _cacheable(request, result):
+    """Respond with a JSON result that clients and caches may keep, or with 304 if the client already has it"""
+    body = json.dumps(result)
+    etag = '"{digest}"'.format(digest=md5(body).hexdigest())
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(body, content_type='application/json')
+    response['ETag'] = etag
+    patch_cache_control(response, public=True, max_age=app_settings.GEOCODER_HTTP_MAX_AGE)
+    return response
+
+def _lines(request):
+    """The non-blank lines of a request's body, decoded"""
+    for line in request.body.splitlines():
+        line = line.strip()
+        if line:
+            yield line.decode('utf-8')
+
+def _point(line):
+    x, y = line.split(',')[:2] if ',' in line else (line, None)
+    return [float(x), float(y)]
+
+def _ndjson(items):
+    for item in items:
+        yield json.dumps(item) + '\n'
+
+@require_GET
+def geocode(request, name):
+    coder = _geocoder(name)
+    if coder is None:
+        return HttpResponseNotFound('no geocoder named {name}'.format(name=name), content_type=TEXT)
+    if not request.GET.get('q'):
+        return HttpResponseBadRequest('q is required', content_type=TEXT)
+
+    try:
+        result = coder[request.GET['q'], _srid(request)]
+    except KeyError:
+        return HttpResponseNotFound('nothing found for {q}'.format(q=request.GET['q'].encode('utf-8')), content_type=TEXT)
+    return _cacheable(request, result)
+
+@require_GET
+def reverse_geocode(request, name):
+    coder = _geocoder(name)
+    if coder is None:
+        return HttpResponseNotFound('no geocoder named {name}'.format(name=name), content_type=TEXT)
+    try:
+        point = Point(float(request.GET['x']), float(request.GET['y']), srid=_srid(request) or 4326)
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest('x and y are required', content_type=TEXT)
+
+    result = coder.reverse_geocode(point)
+    if result is None:
+        return HttpResponseNotFound('nothing found at {x},{y}'.format(x=point.x, y=point.y), content_type=TEXT)
+    return _cacheable(request, result)
+
+@csrf_exempt
+@require_POST
+def bulk_geocode(request, name):
+    """Stream {"input" : ..., "result" : ...} for each line of the body, where result is null if nothing was found"""
+    coder = _geocoder(name)
+    if coder is None:
+        return HttpResponseNotFound('no geocoder named {name}'.format(name=name), content_type=TEXT)
+
+    results = bulk_results(coder, _lines(request), _srid(request))
+    return StreamingHttpResponse(_ndjson({ 'input' : code, 'result' : result } for code, result in results), content_type=NDJSON)
+
+def _reverse_results(coder, points, srid):
+    """Reverse geocode a list of (x, y) points, yielding the code of the feature at each, or None, in order"""
+    if hasattr(coder, 'bulk_reverse_geocode'):
+        for index, code in coder.bulk_reverse_geocode(points, srid):
+            yield code
+    else:
+        for x, y in points:
+            feature = coder.reverse_geocode(Point(x, y, srid=srid or 4326))
+            # OpenStreetMapGeocoder keeps its features' ids in their properties.
+            yield feature.get('_id', feature.get('properties', {}).get('_id')) if feature is not None else None
+
+@csrf_exempt
+@require_POST
+def bulk_reverse_geocode(request, name):
+    """Stream {"point" : [x, y], "code" : ...} for each "x,y" line of the body, where code is null if nothing was found"""
+    coder = _geocoder(name)
+    if coder is None:
+        return HttpResponseNotFound('no geocoder named {name}'.format(name=name), content_type=TEXT)
+    try:
+        points = [_point(line) for line in _lines(request)]
+    except (TypeError, ValueError):
+        return HttpResponseBadRequest('every line must be a point, as x,y', content_type=TEXT)
+
+    results = _reverse_results(coder, points, _srid(request))
+    return StreamingHttpResponse(_ndjson({ 'point' : point, 'code' : code } for point, code in izip(points, results)), content_type=NDJSON)